@@ -1,18 +1,39 @@
+import json
 import os
+import weakref
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_wtf.csrf import CSRFProtect
 from flask_cors import CORS
-from openai import OpenAI
-import google.generativeai as genai
+from . import providers
 
 db = SQLAlchemy()
 login_manager = LoginManager()
 csrf = CSRFProtect()
 cors = CORS()
-openai_client = None
-gemini_client = None
+_apps = weakref.WeakSet()
+
+def __getattr__(name):
+    # The provider clients are built on first use; see ``providers``.
+    if name in providers.CLIENTS:
+        return getattr(providers, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def _dispose_engines():
+    # Pooled connections opened by a preloading master must not be shared with its workers.
+    for app in list(_apps):
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=_dispose_engines)
+
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
 
 def create_app():
     app = Flask(__name__)
@@ -28,6 +49,130 @@ def create_app():
     app.config['REMEMBER_COOKIE_SECURE'] = False
     app.config['REMEMBER_COOKIE_DURATION'] = 2592000
     app.config['PERMANENT_SESSION_LIFETIME'] = 2592000
+    app.config['PROVIDER_TIMEOUT'] = float(os.environ.get('PROVIDER_TIMEOUT', 120))
+    app.config['PROVIDER_CONNECT_TIMEOUT'] = float(os.environ.get('PROVIDER_CONNECT_TIMEOUT', 5))
+    app.config['PROVIDER_MAX_CONNECTIONS'] = int(os.environ.get('PROVIDER_MAX_CONNECTIONS', 100))
+    app.config['PROVIDER_MAX_KEEPALIVE'] = int(os.environ.get('PROVIDER_MAX_KEEPALIVE', 20))
+    app.config['PROVIDER_KEEPALIVE_EXPIRY'] = float(os.environ.get('PROVIDER_KEEPALIVE_EXPIRY', 60))
+    app.config['PROVIDER_MAX_RETRIES'] = int(os.environ.get('PROVIDER_MAX_RETRIES', 2))
+    app.config['PROVIDER_PREWARM'] = env_flag('PROVIDER_PREWARM')
+    # Seconds an alias request waits for a first token before hedging; 0 disables hedging.
+    app.config['ROUTER_HEDGE_AFTER'] = float(os.environ.get('ROUTER_HEDGE_AFTER', 0))
+    app.config['ASGI_WSGI_THREADS'] = int(os.environ.get('ASGI_WSGI_THREADS', 8))
+    app.config['COMPLETION_CACHE_ENABLED'] = env_flag('COMPLETION_CACHE_ENABLED')
+    app.config['COMPLETION_CACHE_TTL'] = int(os.environ.get('COMPLETION_CACHE_TTL', 3600))
+    app.config['COMPLETION_CACHE_SIZE'] = int(os.environ.get('COMPLETION_CACHE_SIZE', 1024))
+    app.config['COMPLETION_CACHE_SHARED_SIZE'] = int(os.environ.get('COMPLETION_CACHE_SHARED_SIZE', 20000))
+    app.config['COMPLETION_CACHE_PATH'] = os.environ.get(
+        'COMPLETION_CACHE_PATH', os.path.join(app.instance_path, 'completion_cache.sqlite3'))
+    app.config['SINGLE_FLIGHT_ENABLED'] = env_flag('SINGLE_FLIGHT_ENABLED', True)
+    app.config['SINGLE_FLIGHT_TIMEOUT'] = float(os.environ.get('SINGLE_FLIGHT_TIMEOUT', 60))
+    app.config['SINGLE_FLIGHT_PATH'] = os.environ.get(
+        'SINGLE_FLIGHT_PATH', os.path.join(app.instance_path, 'singleflight.sqlite3'))
+    app.config['CONVERSATION_CACHE_SIZE'] = int(os.environ.get('CONVERSATION_CACHE_SIZE', 1024))
+    app.config['CONVERSATION_CACHE_TTL'] = int(os.environ.get('CONVERSATION_CACHE_TTL', 1800))
+    app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+    app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 300))
+    app.config['USER_VERSIONS_PATH'] = os.environ.get(
+        'USER_VERSIONS_PATH', os.path.join(app.instance_path, 'user_versions.sqlite3'))
+    # At most PASSWORD_HASH_WORKERS hashes run at once; attempts past workers + queue get a 503.
+    # Keep workers + queue below gunicorn's --threads so a login flood leaves threads for other requests.
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 4))
+    app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 30))
+    # Login attempts allowed per burst and the seconds a full burst takes to refill.
+    app.config['LOGIN_ACCOUNT_BURST'] = int(os.environ.get('LOGIN_ACCOUNT_BURST', 10))
+    app.config['LOGIN_ACCOUNT_PERIOD'] = float(os.environ.get('LOGIN_ACCOUNT_PERIOD', 300))
+    app.config['LOGIN_IP_BURST'] = int(os.environ.get('LOGIN_IP_BURST', 60))
+    app.config['LOGIN_IP_PERIOD'] = float(os.environ.get('LOGIN_IP_PERIOD', 60))
+    # Proxies in front of the app that append to X-Forwarded-For (1 behind the Replit proxy).
+    app.config['TRUSTED_PROXY_HOPS'] = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+    app.config['RATE_LIMIT_PATH'] = os.environ.get(
+        'RATE_LIMIT_PATH', os.path.join(app.instance_path, 'ratelimits.sqlite3'))
+    # Chat generations per user and per model: concurrent requests and tokens per minute; 0 is unlimited.
+    app.config['QUOTA_USER_CONCURRENCY'] = int(os.environ.get('QUOTA_USER_CONCURRENCY', 4))
+    app.config['QUOTA_USER_TPM'] = int(os.environ.get('QUOTA_USER_TPM', 200000))
+    app.config['QUOTA_MODEL_CONCURRENCY'] = int(os.environ.get('QUOTA_MODEL_CONCURRENCY', 0))
+    app.config['QUOTA_MODEL_TPM'] = int(os.environ.get('QUOTA_MODEL_TPM', 0))
+    # Per-model overrides, e.g. {"gpt-4o": {"concurrency": 32, "tpm": 800000}}.
+    app.config['QUOTA_MODELS'] = json.loads(os.environ.get('QUOTA_MODELS', '{}'))
+    app.config['QUOTA_LEASE_TTL'] = int(os.environ.get('QUOTA_LEASE_TTL', 900))
+    app.config['QUOTA_PATH'] = os.environ.get('QUOTA_PATH', os.path.join(app.instance_path, 'quotas.sqlite3'))
+    # /api/chat/batch: items per request, concurrent items per provider, and seconds an item waits for a quota.
+    app.config['BATCH_MAX_ITEMS'] = int(os.environ.get('BATCH_MAX_ITEMS', 100))
+    app.config['BATCH_MAX_BODY_BYTES'] = int(os.environ.get('BATCH_MAX_BODY_BYTES', 4 * 1024 * 1024))
+    app.config['BATCH_CONCURRENCY'] = int(os.environ.get('BATCH_CONCURRENCY', 8))
+    # Per-provider overrides, e.g. {"gemini": 2}.
+    app.config['BATCH_PROVIDER_CONCURRENCY'] = json.loads(os.environ.get('BATCH_PROVIDER_CONCURRENCY', '{}'))
+    app.config['BATCH_QUOTA_WAIT'] = float(os.environ.get('BATCH_QUOTA_WAIT', 30))
+    # Background image and TTS jobs: threads per worker process (0 leaves jobs to `flask jobs-worker`),
+    # attempts per job with doubling retry delays, and seconds finished jobs are kept.
+    app.config['JOBS_PATH'] = os.environ.get('JOBS_PATH', os.path.join(app.instance_path, 'jobs.sqlite3'))
+    app.config['JOBS_WORKERS'] = int(os.environ.get('JOBS_WORKERS', 2))
+    app.config['JOBS_POLL_INTERVAL'] = float(os.environ.get('JOBS_POLL_INTERVAL', 1.0))
+    app.config['JOBS_MAX_ATTEMPTS'] = int(os.environ.get('JOBS_MAX_ATTEMPTS', 3))
+    app.config['JOBS_RETRY_DELAY'] = float(os.environ.get('JOBS_RETRY_DELAY', 5))
+    app.config['JOBS_RETRY_MAX_DELAY'] = float(os.environ.get('JOBS_RETRY_MAX_DELAY', 300))
+    app.config['JOBS_MAX_PENDING'] = int(os.environ.get('JOBS_MAX_PENDING', 20))
+    app.config['JOBS_RETENTION'] = int(os.environ.get('JOBS_RETENTION', 24 * 3600))
+    # A running job is queued again after this many seconds even if its worker looks alive.
+    app.config['JOBS_LEASE'] = float(os.environ.get('JOBS_LEASE', 900))
+    app.config['JOBS_EVENTS_POLL_INTERVAL'] = float(os.environ.get('JOBS_EVENTS_POLL_INTERVAL', 0.5))
+    app.config['JOBS_EVENTS_TIMEOUT'] = float(os.environ.get('JOBS_EVENTS_TIMEOUT', 300))
+    app.config['JOBS_EVENTS_RETRY'] = float(os.environ.get('JOBS_EVENTS_RETRY', 2))
+    # Workers share their metrics through this file so any of them can answer /metrics for all.
+    app.config['METRICS_PATH'] = os.environ.get('METRICS_PATH', os.path.join(app.instance_path, 'metrics.sqlite3'))
+    app.config['METRICS_PUSH_INTERVAL'] = float(os.environ.get('METRICS_PUSH_INTERVAL', 5))
+    # Scrapers send it as a bearer token; without it only signed-in administrators read /metrics.
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+    # Accounts allowed to profile requests and read the profiles.
+    app.config['ADMIN_EMAILS'] = {email.strip().lower() for email in os.environ.get('ADMIN_EMAILS', '').split(',')
+                                  if email.strip()}
+    # Requests from admins sending PROFILE_HEADER, and this fraction of all requests, are profiled.
+    app.config['PROFILE_HEADER'] = os.environ.get('PROFILE_HEADER', 'X-Profile')
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+    app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 200))
+    # Chat turns are journalled and written to the database in batches behind the response.
+    app.config['PERSIST_WRITE_BEHIND'] = env_flag('PERSIST_WRITE_BEHIND', True)
+    app.config['PERSIST_BATCH_SIZE'] = int(os.environ.get('PERSIST_BATCH_SIZE', 100))
+    app.config['PERSIST_FLUSH_INTERVAL'] = float(os.environ.get('PERSIST_FLUSH_INTERVAL', 0.2))
+    app.config['PERSIST_JOURNAL_PATH'] = os.environ.get(
+        'PERSIST_JOURNAL_PATH', os.path.join(app.instance_path, 'turns.sqlite3'))
+    # Usage records are buffered and inserted in batches with their hourly and daily rollups.
+    app.config['USAGE_WRITE_BEHIND'] = env_flag('USAGE_WRITE_BEHIND', True)
+    app.config['USAGE_BATCH_SIZE'] = int(os.environ.get('USAGE_BATCH_SIZE', 500))
+    app.config['USAGE_FLUSH_INTERVAL'] = float(os.environ.get('USAGE_FLUSH_INTERVAL', 1.0))
+    app.config['USAGE_MAX_QUEUE'] = int(os.environ.get('USAGE_MAX_QUEUE', 10000))
+    app.config['USAGE_MAX_ATTEMPTS'] = int(os.environ.get('USAGE_MAX_ATTEMPTS', 3))
+    # Trimming strategy for prompts over budget: none, window, pinned or summary.
+    app.config['CONTEXT_STRATEGY'] = os.environ.get('CONTEXT_STRATEGY', 'pinned')
+    # Cap on prompt tokens below the model's context window; 0 uses the whole window.
+    app.config['CONTEXT_MAX_TOKENS'] = int(os.environ.get('CONTEXT_MAX_TOKENS', 0))
+    app.config['CONTEXT_REPLY_TOKENS'] = int(os.environ.get('CONTEXT_REPLY_TOKENS', 4096))
+    app.config['CONTEXT_SUMMARY_TOKENS'] = int(os.environ.get('CONTEXT_SUMMARY_TOKENS', 512))
+    app.config['CONTEXT_ESTIMATE_MARGIN'] = float(os.environ.get('CONTEXT_ESTIMATE_MARGIN', 0.1))
+    app.config['TTS_CACHE_DIR'] = os.environ.get('TTS_CACHE_DIR', os.path.join(app.instance_path, 'tts_cache'))
+    app.config['TTS_CACHE_MAX_BYTES'] = int(os.environ.get('TTS_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+    # /voice/tts/stream: characters per synthesized segment (the first is kept shorter to start playback
+    # sooner) and segments synthesized at once ahead of the one being sent.
+    app.config['TTS_STREAM_SEGMENT_CHARS'] = int(os.environ.get('TTS_STREAM_SEGMENT_CHARS', 300))
+    app.config['TTS_STREAM_FIRST_CHARS'] = int(os.environ.get('TTS_STREAM_FIRST_CHARS', 120))
+    app.config['TTS_STREAM_WINDOW'] = int(os.environ.get('TTS_STREAM_WINDOW', 3))
+    app.config['IMAGE_CACHE_DIR'] = os.environ.get('IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'images'))
+    app.config['IMAGE_CACHE_MAX_BYTES'] = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+    app.config['IMAGE_CACHE_MAX_AGE'] = int(os.environ.get('IMAGE_CACHE_MAX_AGE', 30 * 24 * 3600))
+    # Whisper accepts files up to 25 MB; the body limit leaves room for the multipart envelope.
+    app.config['STT_MAX_BYTES'] = int(os.environ.get('STT_MAX_BYTES', 25 * 1024 * 1024))
+    app.config['STT_MAX_SECONDS'] = int(os.environ.get('STT_MAX_SECONDS', 900))
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 26 * 1024 * 1024))
+    app.config['CHAT_MAX_BODY_BYTES'] = int(os.environ.get('CHAT_MAX_BODY_BYTES', 1024 * 1024))
+    app.config['STT_CACHE_TTL'] = int(os.environ.get('STT_CACHE_TTL', 7 * 24 * 3600))
+    app.config['STT_CACHE_SIZE'] = int(os.environ.get('STT_CACHE_SIZE', 1024))
+    app.config['STT_CACHE_SHARED_SIZE'] = int(os.environ.get('STT_CACHE_SHARED_SIZE', 20000))
+    app.config['STT_CACHE_PATH'] = os.environ.get(
+        'STT_CACHE_PATH', os.path.join(app.instance_path, 'transcripts.sqlite3'))
 
     db.init_app(app)
     login_manager.init_app(app)
@@ -39,23 +184,15 @@ def create_app():
         r"/health": {"origins": "*"}
     })
 
-    global openai_client
-    openai_api_key = os.environ.get("OPENAI_API_KEY")
-    if openai_api_key:
-        openai_client = OpenAI(api_key=openai_api_key)
-
-    global gemini_client
-    gemini_api_key = os.environ.get("GEMINI_API_KEY")
-    if gemini_api_key:
-        genai.configure(api_key=gemini_api_key)
-        gemini_client = genai.GenerativeModel('gemini-pro')
-        app.config['NANO_BANANA_AVAILABLE'] = True
-    else:
-        app.config['NANO_BANANA_AVAILABLE'] = False
+    providers.init_app(app)
 
     with app.app_context():
-        from . import routes
+        from . import routes, migrations, monitoring, profiling, jobs
+        monitoring.init_app(app)
+        profiling.init_app(app)
         routes.register_routes(app)
-        db.create_all()
+        migrations.init_app(app)
+        jobs.init_app(app)
 
+    _apps.add(app)
     return app
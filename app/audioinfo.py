@@ -0,0 +1,159 @@
+"""Read the duration of an audio upload from its container headers.
+
+Only the headers are parsed, so a limit can be enforced before the upload is
+sent anywhere. Supports WAV, MP3 (Xing/Info frame count or a constant bitrate
+estimate), Ogg Opus/Vorbis and WebM/Matroska files that carry a Duration
+element. Returns None when the duration cannot be determined.
+"""
+import os
+import struct
+
+MP3_BITRATES = {
+    # (MPEG-1, layer III) and (MPEG-2/2.5, layer III) in kbit/s
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG-1
+    2: [22050, 24000, 16000],  # MPEG-2
+    0: [11025, 12000, 8000],   # MPEG-2.5
+}
+
+EBML_SEGMENT = 0x18538067
+EBML_INFO = 0x1549A966
+EBML_TIMECODE_SCALE = 0x2AD7B1
+EBML_DURATION = 0x4489
+EBML_CLUSTER = 0x1F43B675
+
+
+def audio_duration(stream):
+    """Return the duration of ``stream`` in seconds, or None if unknown."""
+    start = stream.tell()
+    try:
+        head = stream.read(16)
+        stream.seek(start)
+        if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+            return _wav_duration(stream)
+        if head[:4] == b'OggS':
+            return _ogg_duration(stream)
+        if head[:4] == b'\x1a\x45\xdf\xa3':
+            return _ebml_duration(stream)
+        if head[:3] == b'ID3' or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+            return _mp3_duration(stream)
+        return None
+    except (struct.error, ValueError, IndexError, ZeroDivisionError):
+        return None
+    finally:
+        stream.seek(start)
+
+
+def _size(stream):
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+def _wav_duration(stream):
+    stream.read(12)
+    byte_rate = None
+    while True:
+        header = stream.read(8)
+        if len(header) < 8:
+            return None
+        chunk_id, chunk_size = struct.unpack('<4sI', header)
+        if chunk_id == b'fmt ':
+            byte_rate = struct.unpack('<I', stream.read(16)[8:12])[0]
+            stream.seek(chunk_size - 16 + (chunk_size & 1), os.SEEK_CUR)
+        elif chunk_id == b'data':
+            return chunk_size / byte_rate if byte_rate else None
+        else:
+            stream.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+def _mp3_duration(stream):
+    size = _size(stream)
+    offset = 0
+    header = stream.read(10)
+    if header[:3] == b'ID3':
+        offset = 10 + ((header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9])
+    stream.seek(offset)
+    data = stream.read(4096)
+    index = 0
+    while index + 4 <= len(data) and not (data[index] == 0xFF and data[index + 1] & 0xE0 == 0xE0):
+        index += 1
+    frame = data[index:index + 4]
+    version = (frame[1] >> 3) & 0x03
+    bitrate = MP3_BITRATES[1 if version == 3 else 2][frame[2] >> 4] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][(frame[2] >> 2) & 0x03]
+    samples_per_frame = 1152 if version == 3 else 576
+
+    # A Xing/Info header in the first frame holds the exact frame count.
+    for tag in (b'Xing', b'Info'):
+        position = data.find(tag, index, index + 64)
+        if position != -1 and struct.unpack('>I', data[position + 4:position + 8])[0] & 0x1:
+            frames = struct.unpack('>I', data[position + 8:position + 12])[0]
+            return frames * samples_per_frame / sample_rate
+    return (size - offset - index) * 8 / bitrate
+
+
+def _ogg_duration(stream):
+    first_page = stream.read(4096)
+    if b'OpusHead' in first_page:
+        position = first_page.index(b'OpusHead')
+        pre_skip = struct.unpack('<H', first_page[position + 10:position + 12])[0]
+        sample_rate = 48000
+    elif b'\x01vorbis' in first_page:
+        position = first_page.index(b'\x01vorbis')
+        pre_skip = 0
+        sample_rate = struct.unpack('<I', first_page[position + 12:position + 16])[0]
+    else:
+        return None
+    size = _size(stream)
+    stream.seek(max(0, size - 65536))
+    tail = stream.read()
+    last_page = tail.rfind(b'OggS')
+    if last_page == -1:
+        return None
+    granule = struct.unpack('<q', tail[last_page + 6:last_page + 14])[0]
+    return max(0, granule - pre_skip) / sample_rate
+
+
+def _read_vint(stream, keep_marker):
+    first = stream.read(1)
+    if not first:
+        raise ValueError('Unexpected end of EBML data')
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first[0] & mask:
+        length += 1
+        mask >>= 1
+    if length > 8:
+        raise ValueError('Invalid EBML varint')
+    value = first[0] if keep_marker else first[0] & (mask - 1)
+    for byte in stream.read(length - 1):
+        value = (value << 8) | byte
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, unknown
+
+
+def _ebml_duration(stream):
+    scale = 1000000
+    duration = None
+    end = None
+    while end is None or stream.tell() < end:
+        element_id, _ = _read_vint(stream, keep_marker=True)
+        size, unknown = _read_vint(stream, keep_marker=False)
+        if element_id in (EBML_SEGMENT, EBML_INFO):
+            if element_id == EBML_INFO and not unknown:
+                end = stream.tell() + size
+            continue
+        if element_id == EBML_CLUSTER:
+            break
+        data = stream.read(size)
+        if element_id == EBML_TIMECODE_SCALE:
+            scale = int.from_bytes(data, 'big')
+        elif element_id == EBML_DURATION:
+            duration = struct.unpack('>f' if size == 4 else '>d', data)[0]
+    return duration * scale / 1e9 if duration is not None else None
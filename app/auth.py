@@ -0,0 +1,158 @@
+"""Bounded password hashing, and login throttling.
+
+Werkzeug's password hashes are deliberately slow. At most
+``PASSWORD_HASH_WORKERS`` run at once, on the requests' own threads
+(hashlib releases the GIL while it works); ``PASSWORD_HASH_QUEUE`` more
+wait up to ``PASSWORD_HASH_TIMEOUT`` seconds for a turn, and past that
+``HashingBusy`` is raised at once. The slots are per process, so this
+bounds the hashing threads of a gthread or ASGI worker; under sync
+workers a request still holds its worker while its own hash runs.
+Hashes made with other parameters than ``PASSWORD_HASH_METHOD`` are
+replaced on the user's next successful login.
+
+Login and signup attempts spend a token from a bucket per client address
+and, for logins, per account, shared by the workers on the host. An
+attempt with an empty bucket is refused before any hashing happens. Behind
+``TRUSTED_PROXY_HOPS`` proxies the client address is read from
+``X-Forwarded-For`` the way ``werkzeug.middleware.proxy_fix.ProxyFix`` does.
+
+Administrators are the accounts listed in ``ADMIN_EMAILS``.
+"""
+import hmac
+import os
+import threading
+from functools import wraps
+
+from flask import current_app, jsonify, request
+from flask_login import current_user
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from . import metrics
+from .limits import TokenBuckets
+
+metrics.describe('password_hashes_total', 'Password hashes by operation (hash, verify) and result.')
+metrics.describe('login_throttled_total', 'Login and signup attempts refused by a token bucket, by scope.')
+
+
+class HashingBusy(Exception):
+    """Every password hashing slot is taken."""
+
+
+class PasswordHasher:
+    def __init__(self, method, workers, queue, timeout):
+        self.method = method
+        self.timeout = timeout
+        self._running = threading.BoundedSemaphore(workers)
+        self._admitted = threading.BoundedSemaphore(workers + queue)
+        self._prefix = None
+
+    def run(self, operation, fn, *args):
+        if not self._admitted.acquire(blocking=False):
+            metrics.inc('password_hashes_total', operation=operation, result='busy')
+            raise HashingBusy()
+        try:
+            if not self._running.acquire(timeout=self.timeout):
+                metrics.inc('password_hashes_total', operation=operation, result='busy')
+                raise HashingBusy()
+            try:
+                result = fn(*args)
+            finally:
+                self._running.release()
+        finally:
+            self._admitted.release()
+        metrics.inc('password_hashes_total', operation=operation, result='ok')
+        return result
+
+    def hash(self, password):
+        return self.run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self.run('verify', check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Whether ``pwhash`` was made with other parameters than the configured method."""
+        if self._prefix is None:
+            # Werkzeug fills in its defaults, e.g. 'scrypt' is stored as 'scrypt:32768:8:1'.
+            self._prefix = self.hash('').split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._prefix
+
+
+def password_hasher():
+    """Return this process's password hasher, rebuilt after a fork."""
+    app = current_app._get_current_object()
+    hasher = app.extensions.get('password_hasher')
+    if hasher is None or hasher[0] != os.getpid():
+        hasher = app.extensions['password_hasher'] = (os.getpid(), PasswordHasher(
+            app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'],
+            app.config['PASSWORD_HASH_QUEUE'], app.config['PASSWORD_HASH_TIMEOUT']
+        ))
+    return hasher[1]
+
+
+def rate_limits():
+    """Return the token buckets shared by the workers on the host."""
+    app = current_app._get_current_object()
+    buckets = app.extensions.get('rate_limits')
+    if buckets is None:
+        buckets = app.extensions['rate_limits'] = TokenBuckets(app.config['RATE_LIMIT_PATH'])
+    return buckets
+
+
+def client_address():
+    """The request's client address, taken from ``X-Forwarded-For`` behind trusted proxies."""
+    hops = current_app.config['TRUSTED_PROXY_HOPS']
+    if hops:
+        forwarded = [value.strip() for value in request.headers.get('X-Forwarded-For', '').split(',')]
+        # Each trusted proxy appends the address it saw; anything further left is client-supplied.
+        if len(forwarded) >= hops and forwarded[-hops]:
+            return forwarded[-hops]
+    return request.remote_addr
+
+
+def throttle_login(address, account=None):
+    """Spend login tokens for ``address`` and ``account``; return seconds to wait, or 0 if allowed."""
+    config = current_app.config
+    buckets = rate_limits()
+    checks = [('ip', address, config['LOGIN_IP_BURST'], config['LOGIN_IP_PERIOD'])]
+    if account:
+        checks.append(('account', account.lower(), config['LOGIN_ACCOUNT_BURST'], config['LOGIN_ACCOUNT_PERIOD']))
+    for scope, key, burst, period in checks:
+        wait = buckets.take(f'login:{scope}:{key}', burst, period)
+        if wait:
+            metrics.inc('login_throttled_total', scope=scope)
+            return wait
+    return 0
+
+
+def is_admin(user):
+    if not user.is_authenticated:
+        return False
+    return user.email.lower() in current_app.config['ADMIN_EMAILS']
+
+
+def admin_required(view):
+    """Like ``login_required``, then refuse accounts missing from ``ADMIN_EMAILS`` with a 403."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return current_app.login_manager.unauthorized()
+        if not is_admin(current_user):
+            return jsonify({"error": "Administrators only"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def admin_or_token_required(setting):
+    """Like ``admin_required``, also admitting requests sending ``Bearer <config[setting]>`` when it is set."""
+    def decorator(view):
+        protected = admin_required(view)
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            token = current_app.config[setting]
+            sent = request.headers.get('Authorization', '')
+            if token and hmac.compare_digest(sent.encode(), f'Bearer {token}'.encode()):
+                return view(*args, **kwargs)
+            return protected(*args, **kwargs)
+        return wrapper
+    return decorator
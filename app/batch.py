@@ -0,0 +1,195 @@
+"""Independent chat prompts answered concurrently for ``/api/chat/batch``.
+
+A batch is a list of items shaped like ``/api/chat`` bodies without a
+conversation: ``message``, optional ``model``, ``messages`` and generation
+parameters, and an optional ``id`` echoed back. Items run at the same
+time, at most ``BATCH_CONCURRENCY`` per provider (``BATCH_PROVIDER_CONCURRENCY``
+overrides it per provider), through the same cache, single-flight, quota
+and usage code as ``/api/chat``. Each finished item is sent as one NDJSON
+line, in completion order, with its ``index`` in the request; a failed
+item reports its ``status`` and ``error`` and the others carry on. An item
+held back by a quota waits up to ``BATCH_QUOTA_WAIT`` seconds for it before
+failing with 429. Nothing is saved as a conversation.
+"""
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from . import metrics, providers, router
+from .chat import arun_completion, build_conversation, completion_key, fit_context, run_completion, token_counts
+from .providers import provider_for
+from .quotas import QuotaExceeded, admit
+from .usage import record_usage
+
+NDJSON_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+metrics.describe('chat_batch_items_total', 'Batch chat items by HTTP-style status.')
+
+
+class ItemFailed(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_items(data, max_items):
+    """Return the batch's items; raises ValueError when the body is not a usable batch."""
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError("'items' must be a non-empty list")
+    if len(items) > max_items:
+        raise ValueError(f'At most {max_items} items can be sent in one batch')
+    return items
+
+
+def concurrency(config, provider):
+    return config['BATCH_PROVIDER_CONCURRENCY'].get(provider, config['BATCH_CONCURRENCY'])
+
+
+def prepare(item, asynchronous):
+    """Return ``(route, message, messages, params)`` for ``item`` or raise ``ItemFailed``."""
+    if not isinstance(item, dict) or not isinstance(item.get('message'), str):
+        raise ItemFailed("Missing 'message' field", 400)
+    route = router.resolve(item.get('model', 'gpt-4o'), asynchronous=asynchronous)
+    if route is None:
+        raise ItemFailed("Invalid model", 400)
+    if route.error:
+        raise ItemFailed(route.error, 503)
+    return route, item['message'], item.get('messages', []), providers.generation_params(item)
+
+
+def lane(item):
+    """The provider whose concurrency limit ``item`` counts against."""
+    model = item.get('model', 'gpt-4o') if isinstance(item, dict) else None
+    if model in router.ALIASES:
+        model = router.ALIASES[model][0]
+    return provider_for(model) if isinstance(model, str) else None
+
+
+def line(index, item, result=None, error=None):
+    payload = {"index": index}
+    if isinstance(item, dict) and 'id' in item:
+        payload["id"] = item['id']
+    if error is not None:
+        status = error.status if isinstance(error, ItemFailed) else 429 if isinstance(error, QuotaExceeded) else 500
+        payload.update(status=status, error=str(error))
+    else:
+        payload.update(status=200, **result)
+    metrics.inc('chat_batch_items_total', status=str(payload['status']))
+    return json.dumps(payload) + '\n'
+
+
+def admit_waiting(user_id, route, prompt_tokens, deadline):
+    """``admit``, waiting out quota refusals until ``deadline``."""
+    while True:
+        try:
+            return admit(user_id, route, prompt_tokens)
+        except QuotaExceeded as e:
+            if time.monotonic() + e.wait > deadline:
+                raise
+            time.sleep(e.wait)
+
+
+def complete_item(user_id, item, wait_for_quota):
+    route, message, messages, params = prepare(item, asynchronous=False)
+    prompt, context_counts = fit_context(route, messages, message, params)
+    cache_key = completion_key(item, route.requested, build_conversation(route.provider, prompt, message), params)
+    prompt_tokens = context_counts['prompt_tokens_after_trim']
+    admission = admit_waiting(user_id, route, prompt_tokens, time.monotonic() + wait_for_quota)
+    started = time.monotonic()
+    tokens = None
+    try:
+        text, usage, served_model, cached = run_completion(route, prompt, message, params, cache_key)
+        counts = token_counts(route, usage, prompt_tokens, text)
+        tokens = 0 if cached else counts['total_tokens']
+    finally:
+        admission.settle(tokens)
+    record_usage(user_id, served_model or route.models[0], 'chat_batch', counts, time.monotonic() - started, cached)
+    return {"response": text, "model": served_model or route.requested, "cached": cached,
+            "usage": {**(usage or {}), **context_counts}}
+
+
+def run_batch(app, user_id, items):
+    """Yield an NDJSON line per item as each finishes, running them on threads."""
+    config = app.config
+    lanes = {}
+    for item in items:
+        provider = lane(item)
+        if provider not in lanes:
+            lanes[provider] = threading.BoundedSemaphore(concurrency(config, provider))
+
+    def run(item):
+        with app.app_context(), lanes[lane(item)]:
+            return complete_item(user_id, item, config['BATCH_QUOTA_WAIT'])
+
+    workers = sum(concurrency(config, provider) for provider in lanes)
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(items)), thread_name_prefix='chat-batch')
+    try:
+        pending = {executor.submit(run, item): index for index, item in enumerate(items)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                error = future.exception()
+                yield line(index, items[index], None if error else future.result(), error)
+    finally:
+        # A client that went away cancels the items that have not started.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def acomplete_item(user_id, item, wait_for_quota):
+    route, message, messages, params = prepare(item, asynchronous=True)
+    prompt, context_counts = await asyncio.to_thread(fit_context, route, messages, message, params)
+    cache_key = completion_key(item, route.requested, build_conversation(route.provider, prompt, message), params)
+    prompt_tokens = context_counts['prompt_tokens_after_trim']
+    deadline = time.monotonic() + wait_for_quota
+    while True:
+        try:
+            admission = await asyncio.to_thread(admit, user_id, route, prompt_tokens)
+            break
+        except QuotaExceeded as e:
+            if time.monotonic() + e.wait > deadline:
+                raise
+            await asyncio.sleep(e.wait)
+    started = time.monotonic()
+    tokens = None
+    try:
+        text, usage, served_model, cached = await arun_completion(route, prompt, message, params, cache_key)
+        counts = token_counts(route, usage, prompt_tokens, text)
+        tokens = 0 if cached else counts['total_tokens']
+    finally:
+        await asyncio.to_thread(admission.settle, tokens)
+    await asyncio.to_thread(record_usage, user_id, served_model or route.models[0], 'chat_batch', counts,
+                            time.monotonic() - started, cached)
+    return {"response": text, "model": served_model or route.requested, "cached": cached,
+            "usage": {**(usage or {}), **context_counts}}
+
+
+async def arun_batch(config, user_id, items):
+    """Async ``run_batch``: items are tasks on the running loop."""
+    lanes = {}
+    for item in items:
+        provider = lane(item)
+        if provider not in lanes:
+            lanes[provider] = asyncio.Semaphore(concurrency(config, provider))
+
+    async def run(index, item):
+        try:
+            async with lanes[lane(item)]:
+                return index, await acomplete_item(user_id, item, config['BATCH_QUOTA_WAIT']), None
+        except Exception as e:
+            return index, None, e
+
+    tasks = [asyncio.ensure_future(run(index, item)) for index, item in enumerate(items)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, result, error = await next_done
+            yield line(index, items[index], result, error)
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,133 @@
+"""Content-addressed files on local disk with a size cap and LRU eviction.
+
+Blobs live at ``<root>/<key[:2]>/<key>`` and are written atomically, so every
+worker on the host can share one store. A read bumps the file's mtime and
+eviction removes the least recently read blobs until the store fits in
+``max_bytes`` again.
+
+Eviction walks the whole store, so writes do not run it. Each process keeps
+a running total of the bytes stored, seeded by its first sweep and bumped by
+its own writes, and sweeps again when a write takes the total past
+``max_bytes`` or ``sweep_interval`` seconds after its last sweep, which
+picks up other workers' writes and expires old blobs.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+SWEEP_INTERVAL = 300
+
+
+def content_key(*parts):
+    """Return a stable hex digest for ``parts``."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    def __init__(self, root, max_bytes, max_age=None, sweep_interval=SWEEP_INTERVAL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._total = None
+        self._swept = 0.0
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        if not key or not all(c in '0123456789abcdef' for c in key):
+            raise ValueError('Invalid blob key')
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """Return the path of blob ``key`` or None if it is not stored."""
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+            if self.max_age is not None and stat.st_mtime < time.time() - self.max_age:
+                os.remove(path)
+                self._grow(-stat.st_size)
+                return None
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, data):
+        """Store ``data`` (bytes or an iterable of bytes) as ``key`` and return its path."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            replaced = os.stat(path).st_size
+        except FileNotFoundError:
+            replaced = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in [data] if isinstance(data, (bytes, bytearray)) else data:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        if not self._grow(size - replaced):
+            self.evict(keep=key)
+        return path
+
+    def _grow(self, size):
+        """Add ``size`` to the running total; False when it is time to sweep instead."""
+        with self._lock:
+            if (self._total is None or self._total + size > self.max_bytes
+                    or time.monotonic() - self._swept >= self.sweep_interval):
+                return False
+            self._total += size
+            return True
+
+    def evict(self, keep=None):
+        """Delete expired and least recently used blobs until the store fits its cap."""
+        blobs = []
+        total = 0
+        cutoff = time.time() - self.max_age if self.max_age is not None else None
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith('.tmp-'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if cutoff is not None and stat.st_mtime < cutoff and entry.name != keep:
+                    self._remove(entry.path)
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, entry.name, entry.path))
+                total += stat.st_size
+
+        blobs.sort()
+        for _, size, name, path in blobs:
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            self._remove(path)
+            total -= size
+        with self._lock:
+            self._total, self._swept = total, time.monotonic()
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
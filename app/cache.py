@@ -0,0 +1,212 @@
+"""TTL + LRU caches: a per-process tier in front of a tier shared by workers.
+
+``TieredCache`` accepts any shared backend with ``get(key)`` and
+``set(key, value, ttl=None)``; ``SQLiteCache`` is the default one and keeps
+its entries in a single SQLite file that every gunicorn worker on the host
+opens. Values must be JSON serialisable.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Thread-safe in-process cache bounded by entry count and age."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def connect_sqlite(path):
+    """Open a SQLite state file for use by several processes at once."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+def owner_alive(owner, host):
+    """Whether the process named by ``owner`` (``'host:pid'``) may still be running.
+
+    Processes on other hosts are assumed alive.
+    """
+    owner_host, _, pid = owner.rpartition(':')
+    if owner_host != host or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SQLiteStore:
+    """State shared by every worker on the host through one SQLite file.
+
+    Subclasses create their tables in ``create``; each thread gets its own
+    connection, reopened after a fork.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def create(self, connection):
+        pass
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = connect_sqlite(self.path)
+            self.create(connection)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """Yield the connection inside a write transaction taken up front."""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+
+class SQLiteCache(SQLiteStore):
+    """Cache shared by every worker on the host through one SQLite file."""
+
+    def __init__(self, path, max_entries, ttl, table='cache'):
+        super().__init__(path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.table = table
+
+    def create(self, connection):
+        connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.table} ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+            'expires_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        connection.execute(
+            f'CREATE INDEX IF NOT EXISTS ix_{self.table}_accessed ON {self.table} (accessed_at)'
+        )
+
+    def get(self, key):
+        now = time.time()
+        try:
+            connection = self._connection()
+            row = connection.execute(
+                f'SELECT value FROM {self.table} WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(f'UPDATE {self.table} SET accessed_at = ? WHERE key = ?', (now, key))
+            return json.loads(row[0])
+        except sqlite3.Error:
+            logger.exception('Shared cache read failed')
+            return None
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        try:
+            with self.transaction() as connection:
+                connection.execute(
+                    f'INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) '
+                    'VALUES (?, ?, ?, ?)',
+                    (key, json.dumps(value), expires_at, now)
+                )
+                connection.execute(f'DELETE FROM {self.table} WHERE expires_at <= ?', (now,))
+                connection.execute(
+                    f'DELETE FROM {self.table} WHERE key IN ('
+                    f'SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+        except sqlite3.Error:
+            logger.exception('Shared cache write failed')
+
+    def delete(self, key):
+        try:
+            self._connection().execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+        except sqlite3.Error:
+            logger.exception('Shared cache delete failed')
+
+
+class TieredCache:
+    """Look up the process-local tier first, then the shared one."""
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key):
+        """Return ``(value, tier)``; ``tier`` is 'local', 'shared' or None on a miss."""
+        value = self.local.get(key)
+        if value is not None:
+            return value, 'local'
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+                return value, 'shared'
+        return None, None
+
+    def set(self, key, value, ttl=None):
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
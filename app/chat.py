@@ -0,0 +1,472 @@
+"""Chat turn helpers shared by the Flask routes and the async gateway."""
+import asyncio
+import hashlib
+import json
+import time
+
+from flask import current_app
+
+from . import context, db, metrics, providers, router
+from .cache import LRUCache, SQLiteCache, TieredCache
+from .models import Conversation, Message, conversation_title, head_hash, message_text
+from .persistence import TurnJournal, TurnWriter
+from .providers import provider_for
+from .singleflight import FlightBoard, acoalesced, coalesced
+
+REPLAY_CHUNK_CHARS = 48
+
+metrics.describe('completion_cache_requests_total', 'Completion cache lookups by result and tier.')
+metrics.describe('single_flight_requests_total', 'Generations by single-flight role (leader or follower).')
+metrics.describe('conversation_cache_requests_total', 'Stored conversation history lookups by result.')
+metrics.describe('context_trims_total', 'Prompts trimmed to fit the context budget, by strategy.')
+metrics.describe('chat_streams_in_flight', 'Chat streams being sent to clients.')
+metrics.histogram('chat_stream_ttft_seconds', 'Time from the upstream call to the first streamed token, by model.')
+metrics.histogram('chat_stream_chunk_gap_seconds', 'Time between streamed chunks, by model.',
+                  buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+CHAT_PATHS = ('/api/chat', '/api/chat/stream')
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+
+def build_conversation(provider, messages, message):
+    """Return ``messages`` plus the new user ``message`` in ``provider``'s message format."""
+    conversation = [provider_message(provider, m) for m in messages] if messages else []
+    if provider == 'gemini':
+        conversation.append({"role": "user", "parts": [message]})
+    else:
+        conversation.append({"role": "user", "content": message})
+    return conversation
+
+
+def provider_message(provider, message):
+    # Routed requests may replay a history written for the other provider.
+    if provider == 'gemini' and 'content' in message and 'parts' not in message:
+        role = 'model' if message.get('role') == 'assistant' else message.get('role', 'user')
+        return {"role": role, "parts": [message['content']]}
+    if provider != 'gemini' and 'parts' in message and 'content' not in message:
+        role = 'assistant' if message.get('role') == 'model' else message.get('role', 'user')
+        return {"role": role, "content": message_text(message)}
+    return message
+
+
+def fit_context(route, messages, message, params):
+    """Return ``(messages, counts)`` with the history trimmed to fit every model of ``route``.
+
+    ``counts`` holds the prompt tokens before and after trimming, for the
+    response's usage block.
+    """
+    config = current_app.config
+    reply_tokens = params.get('max_tokens') or config['CONTEXT_REPLY_TOKENS']
+    limit = context.budget(route.models, reply_tokens, config['CONTEXT_MAX_TOKENS'],
+                           config['CONTEXT_ESTIMATE_MARGIN'])
+    strategy = config['CONTEXT_STRATEGY']
+    turn = {"role": "user", "content": message}
+    kept, before, after = context.trim(route.models[0], list(messages or []) + [turn], limit, strategy,
+                                       config['CONTEXT_SUMMARY_TOKENS'])
+    if after < before:
+        metrics.inc('context_trims_total', strategy=strategy)
+    return kept[:-1], {'prompt_tokens_before_trim': before, 'prompt_tokens_after_trim': after}
+
+
+def with_context_usage(events, counts):
+    """Yield stream events with the trimming ``counts`` added to the usage event."""
+    reported = False
+    for event in events:
+        if 'usage' in event:
+            event = {'usage': {**event['usage'], **counts}}
+            reported = True
+        yield event
+    if not reported:
+        yield {'usage': counts}
+
+
+async def awith_context_usage(events, counts):
+    reported = False
+    async for event in events:
+        if 'usage' in event:
+            event = {'usage': {**event['usage'], **counts}}
+            reported = True
+        yield event
+    if not reported:
+        yield {'usage': counts}
+
+
+def token_counts(route, usage, prompt_tokens, text):
+    """Return the request's prompt, completion and total tokens, estimated where the provider sent none."""
+    if usage and usage.get('total_tokens'):
+        return {name: usage.get(name) or 0 for name in ('prompt_tokens', 'completion_tokens', 'total_tokens')}
+    completion_tokens = context.text_tokens(context.encoding_name(route.models[0]), text)
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens}
+
+
+def finished(events, finish):
+    """Yield stream events, then call ``finish(text, usage, model, cached)`` however the stream ends."""
+    parts, seen = [], {}
+    metrics.adjust('chat_streams_in_flight', 1)
+    try:
+        for event in events:
+            parts.append(event.get('content', ''))
+            seen.update((name, event[name]) for name in ('usage', 'model', 'cached') if name in event)
+            yield event
+    finally:
+        metrics.adjust('chat_streams_in_flight', -1)
+        finish(''.join(parts), seen.get('usage'), seen.get('model'), seen.get('cached', False))
+
+
+async def afinished(events, finish):
+    parts, seen = [], {}
+    metrics.adjust('chat_streams_in_flight', 1)
+    try:
+        async for event in events:
+            parts.append(event.get('content', ''))
+            seen.update((name, event[name]) for name in ('usage', 'model', 'cached') if name in event)
+            yield event
+    finally:
+        metrics.adjust('chat_streams_in_flight', -1)
+        await asyncio.to_thread(finish, ''.join(parts), seen.get('usage'), seen.get('model'),
+                                seen.get('cached', False))
+
+
+def sse(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def body_limit(config, path):
+    """Return the largest request body accepted on ``path``."""
+    if path in CHAT_PATHS:
+        return config['CHAT_MAX_BODY_BYTES']
+    if path == '/api/chat/batch':
+        return config['BATCH_MAX_BODY_BYTES']
+    return config['MAX_CONTENT_LENGTH']
+
+
+def find_conversation(user_id, conversation_id):
+    return Conversation.query.filter_by(id=conversation_id, user_id=user_id).first()
+
+
+def conversation_cache():
+    """Return this process's cache of ``{conversation_id: (message_count, messages)}``."""
+    app = current_app._get_current_object()
+    cache = app.extensions.get('conversation_cache')
+    if cache is None:
+        cache = app.extensions['conversation_cache'] = LRUCache(
+            app.config['CONVERSATION_CACHE_SIZE'], app.config['CONVERSATION_CACHE_TTL']
+        )
+    return cache
+
+
+def conversation_history(user_id, conversation_id):
+    """Return the messages of a user's conversation, or None if there is no such conversation.
+
+    The hot copy kept per process is used while its message count matches the
+    row's, so a turn saved by another worker is never missed. Turns this worker
+    accepted but has not written yet are added at the end.
+    """
+    conversation = find_conversation(user_id, conversation_id)
+    if conversation is None:
+        return None
+    cache = conversation_cache()
+    entry = cache.get(conversation.id)
+    if entry is not None and entry[0] == conversation.message_count:
+        metrics.inc('conversation_cache_requests_total', result='hit')
+        return entry[1] + turn_writer().unwritten(conversation.id, conversation.head_hash)
+    metrics.inc('conversation_cache_requests_total', result='miss')
+    messages = conversation.to_messages()[:conversation.message_count]
+    cache.set(conversation.id, (conversation.message_count, messages))
+    return messages + turn_writer().unwritten(conversation.id, conversation.head_hash)
+
+
+def turn_writer():
+    """Return this process's write-behind queue for chat turns, built on first use."""
+    app = current_app._get_current_object()
+    writer = app.extensions.get('turn_writer')
+    if writer is None:
+        writer = app.extensions['turn_writer'] = TurnWriter(
+            app, TurnJournal(app.config['PERSIST_JOURNAL_PATH']), app.config['PERSIST_BATCH_SIZE'],
+            app.config['PERSIST_FLUSH_INTERVAL'], background=app.config['PERSIST_WRITE_BEHIND'],
+            cache=conversation_cache()
+        )
+    return writer
+
+
+def record_turn(user_id, conversation_id, history, turn):
+    """Queue the ``turn`` messages for a conversation and return its id.
+
+    The conversation is ``conversation_id`` when given, otherwise the one whose
+    messages hash to ``history`` (clients that resend the whole chat),
+    otherwise a new conversation seeded with ``history``. A new conversation's
+    row is inserted here so its id can be returned; the messages are written
+    behind the response.
+    """
+    writer = turn_writer()
+    messages = list(turn)
+    if conversation_id is not None:
+        head = writer.last_head(conversation_id)
+        if head is None:
+            head = find_conversation(user_id, conversation_id).head_hash
+    elif history:
+        head = head_hash(history)
+        conversation_id = writer.conversation_for(user_id, head)
+        if conversation_id is None:
+            row = (Conversation.query.filter_by(user_id=user_id, head_hash=head)
+                   .with_entities(Conversation.id).order_by(Conversation.id.desc()).first())
+            conversation_id = row.id if row else None
+
+    if conversation_id is None:
+        messages = list(history) + messages
+        conversation = Conversation(user_id)
+        conversation.title = conversation_title(messages)
+        db.session.add(conversation)
+        db.session.commit()
+        conversation_id, head = conversation.id, None
+
+    writer.submit(user_id, conversation_id, messages, head)
+    return conversation_id
+
+
+def recorded(events, record):
+    """Yield stream events, then save the assembled reply with ``record(text)`` and announce the conversation."""
+    parts = []
+    for event in events:
+        parts.append(event.get('content', ''))
+        yield event
+    yield {'conversation_id': record(''.join(parts))}
+
+
+async def arecorded(events, record):
+    parts = []
+    async for event in events:
+        parts.append(event.get('content', ''))
+        yield event
+    yield {'conversation_id': await asyncio.to_thread(record, ''.join(parts))}
+
+
+def conversation_messages(conversation_ids):
+    """Return ``{conversation_id: [message, ...]}`` loaded in a single query."""
+    messages = {conversation_id: [] for conversation_id in conversation_ids}
+    if conversation_ids:
+        rows = (Message.query.filter(Message.conversation_id.in_(conversation_ids))
+                .order_by(Message.conversation_id, Message.seq))
+        for row in rows:
+            messages[row.conversation_id].append(row.to_dict())
+    return messages
+
+
+def completion_cache():
+    """Return this process's completion cache, built from the app config on first use."""
+    app = current_app._get_current_object()
+    cache = app.extensions.get('completion_cache')
+    if cache is None:
+        ttl = app.config['COMPLETION_CACHE_TTL']
+        shared = None
+        if app.config['COMPLETION_CACHE_PATH']:
+            shared = SQLiteCache(app.config['COMPLETION_CACHE_PATH'],
+                                 app.config['COMPLETION_CACHE_SHARED_SIZE'], ttl, table='completions')
+        cache = app.extensions['completion_cache'] = TieredCache(
+            LRUCache(app.config['COMPLETION_CACHE_SIZE'], ttl), shared
+        )
+    return cache
+
+
+def flight_board():
+    """Return the cross-worker single-flight board, or None when coalescing is off."""
+    app = current_app._get_current_object()
+    if not app.config['SINGLE_FLIGHT_ENABLED']:
+        return None
+    board = app.extensions.get('flight_board')
+    if board is None:
+        board = app.extensions['flight_board'] = FlightBoard(
+            app.config['SINGLE_FLIGHT_PATH'], app.config['SINGLE_FLIGHT_TIMEOUT']
+        )
+    return board
+
+
+def flight_joined(leader):
+    metrics.inc('single_flight_requests_total', role='leader' if leader else 'follower')
+
+
+def completion_key(data, model, conversation, params):
+    """Return the canonical hash of this request, or None when it opts out of reuse.
+
+    The key names both the cached completion and the in-flight generation
+    identical requests attach to.
+    """
+    if data.get('cache') is False:
+        return None
+    payload = json.dumps([model, conversation, params], sort_keys=True, separators=(',', ':'),
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def cached_completion(key):
+    if key is None or not current_app.config['COMPLETION_CACHE_ENABLED']:
+        return None
+    value, tier = completion_cache().get(key)
+    metrics.inc('completion_cache_requests_total', result='hit' if value else 'miss', tier=tier or 'none')
+    return value
+
+
+def store_completion(key, text, usage, model=None):
+    if key is not None and current_app.config['COMPLETION_CACHE_ENABLED']:
+        completion_cache().set(key, {'response': text, 'usage': usage, 'model': model})
+
+
+def replay(cached):
+    """Yield a cached completion as the events a live stream would produce."""
+    yield {'cached': True}
+    if cached.get('model'):
+        yield {'model': cached['model']}
+    text = cached['response'] or ''
+    for start in range(0, len(text), REPLAY_CHUNK_CHARS):
+        yield {'content': text[start:start + REPLAY_CHUNK_CHARS]}
+    if cached.get('usage'):
+        yield {'usage': cached['usage']}
+
+
+def collect(events):
+    """Return ``(text, usage, model)`` assembled from stream events."""
+    parts, usage, model = [], None, None
+    for event in events:
+        parts.append(event.get('content', ''))
+        usage = event.get('usage', usage)
+        model = event.get('model', model)
+    return ''.join(parts), usage, model
+
+
+def remember(key, events):
+    """Yield ``events`` and cache the completion they assemble once they end."""
+    seen = []
+    for event in events:
+        seen.append(event)
+        yield event
+    store_completion(key, *collect(seen))
+
+
+async def aremember(key, events):
+    seen = []
+    async for event in events:
+        seen.append(event)
+        yield event
+    await asyncio.to_thread(store_completion, key, *collect(seen))
+
+
+def produce_completion(model, messages, message, params):
+    provider = provider_for(model)
+    text, usage = providers.complete(provider, model, build_conversation(provider, messages, message), params)
+    yield {'content': text}
+    if usage:
+        yield {'usage': usage}
+
+
+async def aproduce_completion(model, messages, message, params):
+    provider = provider_for(model)
+    text, usage = await providers.acomplete(provider, model, build_conversation(provider, messages, message),
+                                            params)
+    yield {'content': text}
+    if usage:
+        yield {'usage': usage}
+
+
+def produce_stream(model, messages, message, params):
+    provider = provider_for(model)
+    clock = ChunkClock(model)
+    for event in providers.stream(provider, model, build_conversation(provider, messages, message), params):
+        clock.tick(event)
+        yield event
+
+
+async def aproduce_stream(model, messages, message, params):
+    provider = provider_for(model)
+    clock = ChunkClock(model)
+    async for event in providers.astream(provider, model, build_conversation(provider, messages, message), params):
+        clock.tick(event)
+        yield event
+
+
+class ChunkClock:
+    """Observe a stream's time to first token and the gaps between its chunks."""
+
+    def __init__(self, model):
+        self.model = model
+        self.last = time.monotonic()
+        self.first = True
+
+    def tick(self, event):
+        if 'content' not in event:
+            return
+        now = time.monotonic()
+        name = 'chat_stream_ttft_seconds' if self.first else 'chat_stream_chunk_gap_seconds'
+        metrics.observe(name, now - self.last, model=self.model)
+        self.first = False
+        self.last = now
+
+
+def hedge_after(route):
+    """Seconds before a streamed alias generation is hedged; see ``router``."""
+    return current_app.config['ROUTER_HEDGE_AFTER'] if route.alias else None
+
+
+def run_completion(route, messages, message, params, key):
+    """Return ``(text, usage, model, cached)`` for ``route``.
+
+    The answer comes from the cache or from a generation shared with identical
+    requests; ``model`` is the model that served an alias, otherwise None.
+    """
+    cached = cached_completion(key)
+    if cached is not None:
+        return cached['response'], cached.get('usage'), cached.get('model'), True
+
+    def produce():
+        return remember(key, router.route_events(
+            route, lambda model: produce_completion(model, messages, message, params)))
+
+    text, usage, model = collect(coalesced(flight_board(), key, produce, on_join=flight_joined))
+    return text, usage, model, False
+
+
+async def arun_completion(route, messages, message, params, key):
+    cached = await asyncio.to_thread(cached_completion, key)
+    if cached is not None:
+        return cached['response'], cached.get('usage'), cached.get('model'), True
+
+    def produce():
+        return aremember(key, router.aroute_events(
+            route, lambda model: aproduce_completion(model, messages, message, params)))
+
+    events = acoalesced(flight_board(), key, produce, on_join=flight_joined)
+    text, usage, model = collect([event async for event in events])
+    return text, usage, model, False
+
+
+def run_stream(route, messages, message, params, key):
+    """Yield stream events: a cached replay, or a generation fanned out to identical requests."""
+    cached = cached_completion(key)
+    if cached is not None:
+        yield from replay(cached)
+        return
+
+    def produce():
+        return remember(key, router.route_events(
+            route, lambda model: produce_stream(model, messages, message, params), hedge_after(route)))
+
+    yield from coalesced(flight_board(), key, produce, on_join=flight_joined)
+
+
+async def arun_stream(route, messages, message, params, key):
+    cached = await asyncio.to_thread(cached_completion, key)
+    if cached is not None:
+        for event in replay(cached):
+            yield event
+        return
+
+    def produce():
+        return aremember(key, router.aroute_events(
+            route, lambda model: aproduce_stream(model, messages, message, params), hedge_after(route)))
+
+    async for event in acoalesced(flight_board(), key, produce, on_join=flight_joined):
+        yield event
@@ -0,0 +1,182 @@
+"""Count prompt tokens per model and trim long conversations to fit.
+
+Counts use the model's tiktoken encoding. Models without a public one
+(Gemini) are counted with ``cl100k_base``, and without tiktoken every model
+is estimated at three UTF-8 bytes per token; for those ``budget`` keeps a
+``margin`` of the context window free. Each message's count is cached by a
+hash of its role and text, so a chat that resends its whole history only
+tokenizes the turns it has not sent before.
+
+When a prompt is over budget, ``CONTEXT_STRATEGY`` decides what is sent:
+
+``window``
+    Drop the oldest messages until the prompt fits.
+``pinned``
+    As ``window``, but the leading system messages are always kept.
+``summary``
+    As ``pinned``, and the dropped turns are replaced by one system message
+    quoting the most recent of them briefly, within ``CONTEXT_SUMMARY_TOKENS``.
+``none``
+    Send the conversation unchanged.
+
+The newest message is always sent.
+"""
+import hashlib
+import logging
+
+from .cache import LRUCache
+from .models import message_text
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ('none', 'window', 'pinned', 'summary')
+
+CONTEXT_WINDOWS = {
+    'gpt-4o': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-3.5-turbo': 16385,
+    'gemini-pro': 30720,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+ENCODINGS = {
+    'gpt-4o': 'o200k_base',
+    'gpt-4-turbo': 'cl100k_base',
+    'gpt-3.5-turbo': 'cl100k_base',
+}
+DEFAULT_ENCODING = 'cl100k_base'
+ESTIMATE = 'estimate'
+# English runs about four bytes a token; code and non-Latin scripts nearer one to three.
+BYTES_PER_TOKEN = 3
+
+# Chat framing: every message is wrapped in role markers and every reply is
+# primed with the assistant's.
+MESSAGE_TOKENS = 4
+REPLY_TOKENS = 3
+
+SUMMARY_HEADER = 'Summary of earlier turns in this conversation:'
+SUMMARY_LINE_CHARS = 240
+REPLY_ROLES = ('assistant', 'model')
+
+_counts = LRUCache(50000, 24 * 3600)
+_encoders = {}
+
+
+def encoding_name(model):
+    """Return the tokenizer used to count ``model``'s prompts."""
+    if tiktoken is None:
+        return ESTIMATE
+    # Gemini's tokenizer is not public; cl100k_base is close enough to budget with.
+    return ENCODINGS.get(model, DEFAULT_ENCODING)
+
+
+def exact(model):
+    """Return whether ``model``'s prompts are counted with its own tokenizer."""
+    return tiktoken is not None and model in ENCODINGS and _encoder(ENCODINGS[model]) is not None
+
+
+def _encoder(name):
+    if name not in _encoders:
+        try:
+            _encoders[name] = tiktoken.get_encoding(name)
+        except Exception as e:
+            # The BPE files are downloaded on first use; estimate when that fails.
+            logger.warning('Loading tokenizer %s failed, estimating token counts: %s', name, e)
+            _encoders[name] = None
+    return _encoders[name]
+
+
+def text_tokens(encoding, text):
+    encoder = None if encoding == ESTIMATE else _encoder(encoding)
+    if encoder is None:
+        return -(-len(text.encode('utf-8')) // BYTES_PER_TOKEN)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def message_tokens(model, message):
+    encoding = encoding_name(model)
+    role = message.get('role') or ''
+    text = message_text(message)
+    key = hashlib.sha256(f'{encoding}\0{role}\0{text}'.encode('utf-8')).hexdigest()
+    count = _counts.get(key)
+    if count is None:
+        count = MESSAGE_TOKENS + text_tokens(encoding, role) + text_tokens(encoding, text)
+        _counts.set(key, count)
+    return count
+
+
+def count_tokens(model, messages):
+    """Return the prompt tokens ``messages`` cost when sent to ``model``."""
+    return REPLY_TOKENS + sum(message_tokens(model, message) for message in messages)
+
+
+def budget(models, reply_tokens, max_tokens=0, margin=0.0):
+    """Return the prompt tokens that fit every model in ``models`` with room for the reply.
+
+    A ``margin`` of the window is left free for each model whose counts are
+    approximate.
+    """
+    window = min(CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW) * (1 if exact(model) else 1 - margin)
+                 for model in models)
+    limit = max(int(window) - reply_tokens, 0)
+    return min(limit, max_tokens) if max_tokens else limit
+
+
+def trim(model, messages, limit, strategy='pinned', summary_tokens=512):
+    """Return ``(messages, before, after)``: what to send and its prompt tokens before and after."""
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown context strategy '{strategy}'")
+    before = count_tokens(model, messages)
+    if strategy == 'none' or before <= limit or len(messages) < 2:
+        return messages, before, before
+
+    pinned = 0
+    if strategy != 'window':
+        while pinned < len(messages) - 1 and messages[pinned].get('role') == 'system':
+            pinned += 1
+    head, body = list(messages[:pinned]), messages[pinned:]
+    reserve = summary_tokens if strategy == 'summary' else 0
+    used = count_tokens(model, head) + reserve
+
+    kept = []
+    for message in reversed(body):
+        cost = message_tokens(model, message)
+        if kept and used + cost > limit:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    # A reply without the message it answers only confuses the model.
+    while len(kept) > 1 and kept[0].get('role') in REPLY_ROLES:
+        kept.pop(0)
+
+    dropped = body[:len(body) - len(kept)]
+    if strategy == 'summary' and dropped:
+        head.append(summarize(model, dropped, summary_tokens))
+    trimmed = head + kept
+    return trimmed, before, count_tokens(model, trimmed)
+
+
+def summarize(model, messages, limit):
+    """Return a system message quoting the latest of ``messages`` that fit in ``limit`` tokens."""
+    encoding = encoding_name(model)
+    used = MESSAGE_TOKENS + text_tokens(encoding, SUMMARY_HEADER)
+    lines = []
+    for message in reversed(messages):
+        text = ' '.join(message_text(message).split())
+        if len(text) > SUMMARY_LINE_CHARS:
+            text = text[:SUMMARY_LINE_CHARS - 3] + '...'
+        role = 'Assistant' if message.get('role') in REPLY_ROLES else (message.get('role') or 'user').title()
+        line = f'- {role}: {text}'
+        cost = text_tokens(encoding, line) + 1
+        if used + cost > limit:
+            break
+        lines.append(line)
+        used += cost
+    lines.reverse()
+    return {"role": "system", "content": '\n'.join([SUMMARY_HEADER] + lines)}
@@ -0,0 +1,590 @@
+"""ASGI entry point that serves the provider-bound routes on asyncio.
+
+Under a sync gunicorn worker every open ``/api/chat/stream`` holds the whole
+worker until the provider finishes. The gateway answers the chat, stream,
+TTS, streamed TTS, STT and image routes with the async OpenAI client and
+Gemini's ``*_async`` calls, so one event loop can hold hundreds of open
+streams; ``/api/chat/batch`` runs its items as tasks on the same loop, and
+job event streams poll the queue from it. Every other request is handed to
+the Flask app on a small thread pool.
+
+Run it with any ASGI server, for example::
+
+    gunicorn -k uvicorn.workers.UvicornWorker --workers=2 --timeout=120 asgi:app
+"""
+import asyncio
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from tempfile import SpooledTemporaryFile
+
+from flask import Response, current_app, jsonify, request, url_for
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+
+from . import db, metrics, providers, router
+from .chat import (SSE_HEADERS, afinished, arun_completion, arun_stream, awith_context_usage, body_limit,
+                   build_conversation, completion_key, arecorded, conversation_history, fit_context, record_turn, sse,
+                   token_counts)
+from .media import (IMAGE_MODEL, STREAM_HEADERS, STT_LANGUAGE, STT_MODEL, UploadRejected, astream_speech,
+                    asynthesize_speech, audio_response, cached_image, cached_transcript, extract_image,
+                    image_payload, image_prompt_key, image_request, inspect_audio, read_file, speech_segments,
+                    store_image, stt_upload, transcript_cache, tts_payload, upload_file, wants_audio)
+from .batch import NDJSON_HEADERS, arun_batch, parse_items
+from .jobs import afollow_job, job_runner
+from .quotas import QuotaExceeded, admit, rejection
+from .usage import record_usage
+
+
+def login_required(handler):
+    @wraps(handler)
+    async def decorated(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return current_app.login_manager.unauthorized()
+        return await handler(*args, **kwargs)
+    return decorated
+
+
+def event_stream(events):
+    """Wrap an async generator of SSE strings in a streaming response."""
+    return Response(events, mimetype='text/event-stream', headers=SSE_HEADERS)
+
+
+@login_required
+async def chat():
+    try:
+        data = request.get_json()
+
+        if not data or 'message' not in data:
+            return jsonify({"error": "Missing 'message' field"}), 400
+
+        message = data['message']
+        model = data.get('model', 'gpt-4o')
+        messages = data.get('messages', [])
+        route = router.resolve(model, asynchronous=True)
+
+        if route is None:
+            return jsonify({"error": "Invalid model"}), 400
+
+        if route.error:
+            return jsonify({"error": route.error}), 503
+
+        conversation_id = data.get('conversation_id')
+        # With only a conversation_id the server supplies the history and returns just the new turn.
+        server_held = conversation_id is not None and 'messages' not in data
+        if conversation_id is not None:
+            history = await asyncio.to_thread(conversation_history, current_user.id, conversation_id)
+            if history is None:
+                return jsonify({"error": "Conversation not found"}), 404
+            if server_held:
+                messages = history
+
+        conversation = build_conversation(route.provider, messages, message)
+        params = providers.generation_params(data)
+        prompt, context_counts = await asyncio.to_thread(fit_context, route, messages, message, params)
+        cache_key = completion_key(data, model, build_conversation(route.provider, prompt, message), params)
+
+        prompt_tokens = context_counts['prompt_tokens_after_trim']
+        admission = await asyncio.to_thread(admit, current_user.id, route, prompt_tokens)
+        started = time.monotonic()
+        tokens = None
+        try:
+            assistant_message, usage, served_model, cached = await arun_completion(
+                route, prompt, message, params, cache_key
+            )
+            counts = token_counts(route, usage, prompt_tokens, assistant_message)
+            tokens = 0 if cached else counts['total_tokens']
+        finally:
+            await asyncio.to_thread(admission.settle, tokens)
+        await asyncio.to_thread(record_usage, current_user.id, served_model or route.models[0], 'chat', counts,
+                                time.monotonic() - started, cached)
+
+        conversation.append({"role": "assistant", "content": assistant_message})
+        conversation_id = await asyncio.to_thread(
+            record_turn, current_user.id, conversation_id, conversation[:-2], conversation[-2:]
+        )
+
+        result = {
+            "response": assistant_message,
+            "model": served_model or model,
+            "conversation_id": conversation_id,
+            "cached": cached
+        }
+        if not server_held:
+            result["conversation"] = conversation
+
+        result["usage"] = {**(usage or {}), **context_counts}
+
+        return jsonify(result), 200
+
+    except QuotaExceeded as e:
+        return rejection(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@login_required
+async def chat_stream():
+    try:
+        data = request.get_json()
+
+        if not data or 'message' not in data:
+            return jsonify({"error": "Missing 'message' field"}), 400
+
+        message = data['message']
+        model = data.get('model', 'gpt-4o')
+        messages = data.get('messages', [])
+        route = router.resolve(model, asynchronous=True)
+
+        if route is None:
+            return jsonify({"error": "Invalid model"}), 400
+
+        if route.error:
+            return jsonify({"error": route.error}), 503
+
+        conversation_id = data.get('conversation_id')
+        if conversation_id is not None:
+            history = await asyncio.to_thread(conversation_history, current_user.id, conversation_id)
+            if history is None:
+                return jsonify({"error": "Conversation not found"}), 404
+            if 'messages' not in data:
+                messages = history
+
+        conversation = build_conversation(route.provider, messages, message)
+        params = providers.generation_params(data)
+        prompt, context_counts = await asyncio.to_thread(fit_context, route, messages, message, params)
+        cache_key = completion_key(data, model, build_conversation(route.provider, prompt, message), params)
+        user_id = current_user.id
+        prompt_tokens = context_counts['prompt_tokens_after_trim']
+        admission = await asyncio.to_thread(admit, user_id, route, prompt_tokens)
+        started = time.monotonic()
+
+        def finish(text, usage, served_model, cached):
+            counts = token_counts(route, usage, prompt_tokens, text)
+            admission.settle(0 if cached else counts['total_tokens'])
+            record_usage(user_id, served_model or route.models[0], 'chat_stream', counts, time.monotonic() - started,
+                         cached)
+
+        def record(text):
+            turn = [conversation[-1], {"role": "assistant", "content": text}]
+            return record_turn(user_id, conversation_id, conversation[:-1], turn)
+
+        async def generate():
+            try:
+                events = afinished(arun_stream(route, prompt, message, params, cache_key), finish)
+                async for event in arecorded(awith_context_usage(events, context_counts), record):
+                    yield sse(event)
+                yield sse({'done': True})
+            except Exception as e:
+                yield sse({'error': str(e)})
+
+        response = event_stream(generate())
+        # Releases the leases of a stream that never started.
+        response.call_on_close(admission.settle)
+        return response
+
+    except QuotaExceeded as e:
+        return rejection(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@login_required
+async def chat_batch():
+    try:
+        items = parse_items(request.get_json(silent=True), current_app.config['BATCH_MAX_ITEMS'])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    lines = arun_batch(current_app.config, current_user.id, items)
+    return Response(lines, mimetype='application/x-ndjson', headers=NDJSON_HEADERS)
+
+
+@login_required
+async def generate_image():
+    try:
+        if not current_app.config['NANO_BANANA_AVAILABLE']:
+            return jsonify({"error": "Image generation is not configured. Missing GEMINI_API_KEY."}), 503
+
+        data = request.get_json()
+        prompt = data.get('prompt', '').strip()
+
+        if not prompt:
+            return jsonify({"error": "Prompt is required"}), 400
+
+        prompt_key = image_prompt_key(prompt)
+        stored = await asyncio.to_thread(cached_image, prompt_key) if data.get('cache') is not False else None
+        metrics.inc('image_cache_requests_total', result='hit' if stored else 'miss')
+        if stored:
+            return jsonify(image_payload(*stored, prompt, True)), 200
+
+        model = providers.model(IMAGE_MODEL)
+        response = await model.generate_content_async(**image_request(prompt))
+
+        image = extract_image(response)
+        if image:
+            image_bytes, mime_type = image
+            key = await asyncio.to_thread(store_image, prompt_key, image_bytes, mime_type)
+            return jsonify(image_payload(key, mime_type, prompt, False)), 200
+
+        return jsonify({"error": "No image generated. The model may have blocked the request for safety reasons."}), 502
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@login_required
+async def text_to_speech():
+    started = time.monotonic()
+    try:
+        if not providers.async_openai_client:
+            return jsonify({"error": "Voice services are not configured. Missing OPENAI_API_KEY."}), 503
+
+        data = request.get_json()
+
+        if not data or 'text' not in data:
+            return jsonify({"error": "Missing 'text' field"}), 400
+
+        text = data['text']
+        voice = data.get('voice', 'alloy')
+        speed = data.get('speed', 1.0)
+
+        key, path, audio_bytes, cached = await asynthesize_speech(text, voice, speed)
+        metrics.observe('tts_first_audio_seconds', time.monotonic() - started, mode='clip')
+
+        if wants_audio():
+            return audio_response(path, key)
+
+        if audio_bytes is None:
+            audio_bytes = await asyncio.to_thread(read_file, path)
+        payload = tts_payload(audio_bytes, voice, speed)
+        payload['url'] = url_for('tts_audio', key=key)
+        payload['cached'] = cached
+        return jsonify(payload), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@login_required
+async def text_to_speech_stream():
+    started = time.monotonic()
+    try:
+        if not providers.async_openai_client:
+            return jsonify({"error": "Voice services are not configured. Missing OPENAI_API_KEY."}), 503
+
+        data = request.get_json()
+
+        if not data or 'text' not in data:
+            return jsonify({"error": "Missing 'text' field"}), 400
+
+        config = current_app.config
+        segments = speech_segments(data['text'], config['TTS_STREAM_SEGMENT_CHARS'], config['TTS_STREAM_FIRST_CHARS'])
+        if not segments:
+            return jsonify({"error": "Text is empty"}), 400
+
+        chunks = astream_speech(segments, data.get('voice', 'alloy'), data.get('speed', 1.0),
+                                config['TTS_STREAM_WINDOW'])
+        try:
+            first = await chunks.__anext__()
+        except BaseException:
+            await chunks.aclose()
+            raise
+        metrics.observe('tts_first_audio_seconds', time.monotonic() - started, mode='stream')
+
+        async def body():
+            try:
+                yield first
+                async for chunk in chunks:
+                    yield chunk
+            finally:
+                await chunks.aclose()
+
+        return Response(body(), mimetype='audio/mpeg',
+                        headers={**STREAM_HEADERS, 'X-TTS-Segments': str(len(segments))})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@login_required
+async def speech_to_text():
+    try:
+        if not providers.async_openai_client:
+            return jsonify({"error": "Voice services are not configured. Missing OPENAI_API_KEY."}), 503
+
+        audio_file = await asyncio.to_thread(stt_upload)
+        key = await asyncio.to_thread(inspect_audio, audio_file)
+        cached = await asyncio.to_thread(cached_transcript, key)
+        if cached is not None:
+            return jsonify({**cached, "cached": True}), 200
+
+        transcript = await providers.async_openai_client.audio.transcriptions.create(
+            model=STT_MODEL,
+            file=upload_file(audio_file),
+            language=STT_LANGUAGE
+        )
+
+        result = {
+            "text": transcript.text,
+            "language": STT_LANGUAGE
+        }
+        await asyncio.to_thread(transcript_cache().set, key, result)
+        return jsonify({**result, "cached": False}), 200
+
+    except UploadRejected as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@login_required
+async def job_events():
+    queue = job_runner().queue
+    config = current_app.config
+    return event_stream(afollow_job(queue, request.view_args['job_id'], current_user.id,
+                                    config['JOBS_EVENTS_POLL_INTERVAL'], config['JOBS_EVENTS_TIMEOUT']))
+
+
+ASYNC_ROUTES = {
+    '/api/chat': chat,
+    '/api/chat/stream': chat_stream,
+    '/api/chat/batch': chat_batch,
+    '/image/generate': generate_image,
+    '/voice/tts': text_to_speech,
+    '/voice/tts/stream': text_to_speech_stream,
+    '/voice/stt': speech_to_text,
+}
+# GET routes with path arguments, by Flask endpoint; handlers read ``request.view_args``.
+ASYNC_ENDPOINTS = {
+    'job_events': job_events,
+}
+
+
+class AsyncGateway:
+    """ASGI application routing ``ASYNC_ROUTES`` natively and the rest to Flask."""
+
+    def __init__(self, flask_app, routes=None, endpoints=None):
+        self.flask_app = flask_app
+        self.routes = ASYNC_ROUTES if routes is None else routes
+        self.endpoints = ASYNC_ENDPOINTS if endpoints is None else endpoints
+        self.executor = ThreadPoolExecutor(
+            max_workers=flask_app.config['ASGI_WSGI_THREADS'],
+            thread_name_prefix='wsgi'
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        # Reject oversized bodies before buffering them, as Flask would after.
+        limit = body_limit(self.flask_app.config, scope['path'])
+        declared = dict(scope['headers']).get(b'content-length')
+        if limit is not None and declared is not None and declared.isdigit() and int(declared) > limit:
+            return await self.reject_body(send)
+
+        with SpooledTemporaryFile(max_size=65536) as body:
+            size = 0
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                chunk = message.get('body', b'')
+                size += len(chunk)
+                if limit is not None and size > limit:
+                    return await self.reject_body(send)
+                body.write(chunk)
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            environ = build_environ(scope, body)
+
+            handler = self.handler_for(scope, environ)
+            if handler is not None:
+                await self.dispatch(handler, environ, receive, send)
+            else:
+                await self.run_wsgi(environ, send)
+
+    def handler_for(self, scope, environ):
+        if scope['method'] == 'POST':
+            return self.routes.get(scope['path'])
+        if scope['method'] == 'GET' and self.endpoints:
+            try:
+                endpoint, _ = self.flask_app.url_map.bind_to_environ(environ).match()
+            except HTTPException:
+                return None
+            return self.endpoints.get(endpoint)
+        return None
+
+    async def reject_body(self, send):
+        content = b'{"error": "Request body is too large"}\n'
+        await send({'type': 'http.response.start', 'status': 413, 'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(content)).encode()),
+            (b'connection', b'close'),
+        ]})
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if providers.settings and providers.settings['prewarm']:
+                    await providers.aprewarm()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                for name in ('turn_writer', 'usage_ledger'):
+                    writer = self.flask_app.extensions.get(name)
+                    if writer is not None:
+                        await asyncio.to_thread(writer.close)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def run_wsgi(self, environ, send):
+        """Run the Flask app on the thread pool and send its body block by block.
+
+        Files from ``send_file`` (images, TTS clips, profiles) come in blocks,
+        each read on the pool, so none is held in memory whole.
+        """
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = encode_headers(headers)
+
+        result = await loop.run_in_executor(self.executor, self.flask_app, environ, start_response)
+        try:
+            blocks = iter(result)
+            block = await loop.run_in_executor(self.executor, next, blocks, None)
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while block is not None:
+                if block:
+                    await send({'type': 'http.response.body', 'body': block, 'more_body': True})
+                block = await loop.run_in_executor(self.executor, next, blocks, None)
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
+        await send({'type': 'http.response.body'})
+
+    async def dispatch(self, handler, environ, receive, send):
+        """Run ``handler`` inside a Flask request context, like ``full_dispatch_request``."""
+        app = self.flask_app
+        with app.request_context(environ):
+            try:
+                try:
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        rv = await handler()
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                response = app.process_response(app.make_response(rv))
+            except Exception as e:
+                response = app.handle_exception(e)
+
+            # Every open request shares the event loop thread, so a session
+            # left holding a pooled connection for the length of a stream
+            # would exhaust the pool and block the loop.
+            db.session.close()
+
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': encode_headers(response.get_wsgi_headers(environ).to_wsgi_list()),
+            })
+            # Close callbacks such as ``admission.settle`` write to SQLite, so they
+            # run on a thread rather than stall every other stream on the loop.
+            if hasattr(response.response, '__aiter__'):
+                try:
+                    await stream_body(response.response, receive, send)
+                finally:
+                    await asyncio.to_thread(response.close)
+            else:
+                # File responses arrive in blocks; pass them on without joining.
+                try:
+                    for chunk in response.iter_encoded():
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                finally:
+                    await asyncio.to_thread(response.close)
+                await send({'type': 'http.response.body'})
+
+
+async def stream_body(events, receive, send):
+    """Send an async iterator as the response body until it ends or the client leaves."""
+    async def pump():
+        async for chunk in events:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        sender.cancel()
+
+    sender = asyncio.ensure_future(pump())
+    watcher = asyncio.ensure_future(watch_disconnect())
+    try:
+        await sender
+    except asyncio.CancelledError:
+        # Only swallow the cancellation caused by a client disconnect.
+        if not watcher.done():
+            raise
+    finally:
+        watcher.cancel()
+        await events.aclose()
+
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+
+
+def build_environ(scope, body):
+    """Build a WSGI environ for ``scope`` with ``body`` as ``wsgi.input``."""
+    script_name = scope.get('root_path', '').encode('utf8').decode('latin1')
+    path_info = scope['path'].encode('utf8').decode('latin1')
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope['http_version'],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    headers = defaultdict(list)
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        headers[key].append(value.decode('latin1'))
+    for key, values in headers.items():
+        environ[key] = ','.join(values)
+    return environ
+
+
+def create_asgi_app(flask_app):
+    return AsyncGateway(flask_app)
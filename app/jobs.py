@@ -0,0 +1,416 @@
+"""Background jobs for image generations and long text-to-speech.
+
+``POST /api/jobs`` queues a job in a SQLite file shared by every worker on
+the host and answers at once. The client polls ``/api/jobs/<id>``, or
+follows ``/api/jobs/<id>/events``, until the job is done and then reads
+``/api/jobs/<id>/result``. No web worker waits on the provider for it, and
+only the async gateway keeps an events stream open; the WSGI app answers
+with one event and a ``retry`` hint.
+
+Each worker process runs ``JOBS_WORKERS`` threads that claim the queued job
+with the highest priority, oldest first. A job that raises is retried after
+``JOBS_RETRY_DELAY`` seconds, doubling up to ``JOBS_RETRY_MAX_DELAY``, until
+it has run ``JOBS_MAX_ATTEMPTS`` times; ``JobFailed`` (a refused prompt)
+fails it at once. A running job whose worker died is queued again. Finished
+jobs are kept for ``JOBS_RETENTION`` seconds. Results name the stored image
+or clip rather than carry it, so they cost a few bytes in the queue.
+"""
+import asyncio
+import atexit
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import click
+from flask import current_app, url_for
+
+from . import metrics, providers
+from .chat import sse
+from .cache import SQLiteStore, owner_alive
+from .media import image_payload, render_image, synthesize_speech
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+FINISHED = (DONE, FAILED)
+KINDS = ('image', 'tts')
+MAX_PRIORITY = 10
+ORPHAN_SWEEP_INTERVAL = 30
+
+metrics.describe('jobs_total', 'Background jobs by kind and outcome (queued, done, retried, failed).')
+metrics.histogram('job_run_seconds', 'Time a background job attempt ran, by kind.')
+
+
+class JobFailed(Exception):
+    """A job that cannot succeed on a retry."""
+
+
+class QueueFull(Exception):
+    """The user already has ``JOBS_MAX_PENDING`` unfinished jobs."""
+
+
+class JobQueue(SQLiteStore):
+    def __init__(self, path, retention, lease):
+        super().__init__(path)
+        self.retention = retention
+        self.lease = lease
+        self.host = socket.gethostname()
+
+    @property
+    def owner(self):
+        return f'{self.host}:{os.getpid()}'
+
+    def create(self, connection):
+        connection.row_factory = sqlite3.Row
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, kind TEXT NOT NULL, user_id INTEGER NOT NULL, payload TEXT NOT NULL, '
+            'priority INTEGER NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL, '
+            'max_attempts INTEGER NOT NULL, run_at REAL NOT NULL, owner TEXT, result TEXT, error TEXT, '
+            'created_at REAL NOT NULL, started_at REAL, finished_at REAL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_jobs_ready ON jobs (state, priority DESC, created_at)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_jobs_user ON jobs (user_id, state)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_jobs_finished ON jobs (finished_at)')
+
+    def submit(self, kind, user_id, payload, priority, max_attempts, max_pending):
+        """Queue a job and return its id; drops finished jobs past their retention."""
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM jobs WHERE finished_at < ?', (now - self.retention,))
+            pending = connection.execute(
+                'SELECT COUNT(*) FROM jobs WHERE user_id = ? AND state IN (?, ?)', (user_id, QUEUED, RUNNING)
+            ).fetchone()[0]
+            if max_pending and pending >= max_pending:
+                raise QueueFull(f'At most {max_pending} jobs can be pending at once')
+            connection.execute(
+                'INSERT INTO jobs (id, kind, user_id, payload, priority, state, attempts, max_attempts, run_at, '
+                'created_at) VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?, ?)',
+                (job_id, kind, user_id, json.dumps(payload), priority, QUEUED, max_attempts, now, now)
+            )
+        return job_id
+
+    def claim(self, sweep=False):
+        """Start the next ready job and return it, or None.
+
+        With ``sweep`` running jobs of exited workers on this host, and any
+        past ``lease`` seconds, are queued again first.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            if sweep:
+                self._requeue_orphans(connection, now)
+            row = connection.execute(
+                'SELECT * FROM jobs WHERE state = ? AND run_at <= ? ORDER BY priority DESC, created_at LIMIT 1',
+                (QUEUED, now)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                'UPDATE jobs SET state = ?, owner = ?, attempts = attempts + 1, started_at = ? WHERE id = ?',
+                (RUNNING, self.owner, now, row['id'])
+            )
+        job = dict(row)
+        job.update(state=RUNNING, attempts=row['attempts'] + 1, started_at=now, payload=json.loads(row['payload']))
+        return job
+
+    def _requeue_orphans(self, connection, now):
+        rows = connection.execute(
+            'SELECT id, owner, started_at, attempts, max_attempts FROM jobs WHERE state = ?', (RUNNING,)
+        ).fetchall()
+        for row in rows:
+            if owner_alive(row['owner'], self.host) and row['started_at'] > now - self.lease:
+                continue
+            if row['attempts'] >= row['max_attempts']:
+                connection.execute('UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE id = ?',
+                                   (FAILED, 'The worker running the job stopped', now, row['id']))
+            else:
+                connection.execute('UPDATE jobs SET state = ?, owner = NULL, run_at = ? WHERE id = ?',
+                                   (QUEUED, now, row['id']))
+
+    def finish(self, job_id, result):
+        with self.transaction() as connection:
+            connection.execute(
+                'UPDATE jobs SET state = ?, result = ?, error = NULL, finished_at = ? WHERE id = ?',
+                (DONE, json.dumps(result), time.time(), job_id)
+            )
+
+    def fail(self, job_id, error, retry_at=None):
+        """Record a failed attempt: queue the job again at ``retry_at``, or fail it for good."""
+        with self.transaction() as connection:
+            if retry_at is None:
+                connection.execute('UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE id = ?',
+                                   (FAILED, error, time.time(), job_id))
+            else:
+                connection.execute('UPDATE jobs SET state = ?, error = ?, owner = NULL, run_at = ? WHERE id = ?',
+                                   (QUEUED, error, retry_at, job_id))
+
+    def get(self, job_id, user_id):
+        """Return the job if it belongs to ``user_id``, or None."""
+        row = self._connection().execute(
+            'SELECT * FROM jobs WHERE id = ? AND user_id = ?', (job_id, user_id)
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+
+def run_image(payload):
+    image = render_image(payload['prompt'], use_cache=payload.get('cache', True))
+    if image is None:
+        raise JobFailed('No image generated. The model may have blocked the request for safety reasons.')
+    key, mime_type, cached = image
+    return {'key': key, 'mime_type': mime_type, 'cached': cached}
+
+
+def run_tts(payload):
+    key, _, _, cached = synthesize_speech(payload['text'], payload['voice'], payload['speed'])
+    return {'key': key, 'cached': cached}
+
+
+HANDLERS = {
+    'image': run_image,
+    'tts': run_tts,
+}
+
+
+class JobRunner:
+    """This process's pool of job threads, started with the first job it sees."""
+
+    def __init__(self, app, queue, workers, poll_interval, retry_delay, retry_max_delay):
+        self.app = app
+        self.queue = queue
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self._wake = threading.Event()
+        self._closed = False
+        self._threads = []
+        self._pid = None
+        self._swept_at = 0.0
+        self._sweep_lock = threading.Lock()
+
+    def submit(self, kind, user_id, payload, priority):
+        config = self.app.config
+        job_id = self.queue.submit(kind, user_id, payload, priority, config['JOBS_MAX_ATTEMPTS'],
+                                   config['JOBS_MAX_PENDING'])
+        metrics.inc('jobs_total', kind=kind, outcome='queued')
+        self._wake.set()
+        return job_id
+
+    def run_next(self):
+        """Claim and run one job; return False when none was ready."""
+        job = self.queue.claim(sweep=self._due_sweep())
+        if job is None:
+            return False
+        self.execute(job)
+        return True
+
+    def work(self):
+        """Run ready jobs until none are left; return how many ran."""
+        count = 0
+        while self.run_next():
+            count += 1
+        return count
+
+    def execute(self, job):
+        kind = job['kind']
+        started = time.monotonic()
+        try:
+            with self.app.app_context():
+                result = HANDLERS[kind](job['payload'])
+        except JobFailed as e:
+            self.queue.fail(job['id'], str(e))
+            metrics.inc('jobs_total', kind=kind, outcome='failed')
+        except Exception as e:
+            logger.warning('Job %s (%s) attempt %s failed: %s', job['id'], kind, job['attempts'], e)
+            if job['attempts'] < job['max_attempts']:
+                self.queue.fail(job['id'], str(e), time.time() + self.backoff(job['attempts']))
+                metrics.inc('jobs_total', kind=kind, outcome='retried')
+            else:
+                self.queue.fail(job['id'], str(e))
+                metrics.inc('jobs_total', kind=kind, outcome='failed')
+        else:
+            self.queue.finish(job['id'], result)
+            metrics.inc('jobs_total', kind=kind, outcome='done')
+        finally:
+            metrics.observe('job_run_seconds', time.monotonic() - started, kind=kind)
+
+    def backoff(self, attempts):
+        """Seconds before retrying a job that has failed ``attempts`` times, with jitter."""
+        delay = min(self.retry_max_delay, self.retry_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def ensure_started(self):
+        if self.workers <= 0 or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._threads = [threading.Thread(target=self._run, name=f'job-worker-{index}', daemon=True)
+                         for index in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        # Jobs still running are queued again by the next sweep once this process has exited.
+        self._closed = True
+        self._wake.set()
+
+    def _due_sweep(self):
+        with self._sweep_lock:
+            if time.monotonic() - self._swept_at < ORPHAN_SWEEP_INTERVAL:
+                return False
+            self._swept_at = time.monotonic()
+            return True
+
+    def _run(self):
+        while not self._closed:
+            try:
+                if self.run_next():
+                    continue
+            except Exception:
+                logger.exception('Claiming a job failed')
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+
+def job_runner():
+    """Return this process's job runner, built from the app config on first use and started in each worker."""
+    app = current_app._get_current_object()
+    runner = app.extensions.get('job_runner')
+    if runner is None:
+        config = app.config
+        runner = app.extensions['job_runner'] = JobRunner(
+            app, JobQueue(config['JOBS_PATH'], config['JOBS_RETENTION'], config['JOBS_LEASE']),
+            config['JOBS_WORKERS'], config['JOBS_POLL_INTERVAL'], config['JOBS_RETRY_DELAY'],
+            config['JOBS_RETRY_MAX_DELAY']
+        )
+    runner.ensure_started()
+    return runner
+
+
+def parse_job(data):
+    """Return ``(kind, payload, priority)`` for a submitted job; raises ValueError when it is unusable."""
+    if not isinstance(data, dict) or data.get('kind') not in KINDS:
+        raise ValueError(f"'kind' must be one of {', '.join(KINDS)}")
+    priority = data.get('priority', 0)
+    if not isinstance(priority, int) or isinstance(priority, bool) or abs(priority) > MAX_PRIORITY:
+        raise ValueError(f"'priority' must be an integer from -{MAX_PRIORITY} to {MAX_PRIORITY}")
+
+    kind = data['kind']
+    if kind == 'image':
+        prompt = data.get('prompt')
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise ValueError("Prompt is required")
+        return kind, {'prompt': prompt.strip(), 'cache': data.get('cache') is not False}, priority
+    if not isinstance(data.get('text'), str) or not data['text']:
+        raise ValueError("Missing 'text' field")
+    return kind, {'text': data['text'], 'voice': data.get('voice', 'alloy'), 'speed': data.get('speed', 1.0)}, priority
+
+
+def unavailable(kind):
+    """The error to answer with when ``kind`` jobs cannot run on this deployment, or None."""
+    if kind == 'image' and not current_app.config['NANO_BANANA_AVAILABLE']:
+        return "Image generation is not configured. Missing GEMINI_API_KEY."
+    if kind == 'tts' and not providers.configured('openai'):
+        return "Voice services are not configured. Missing OPENAI_API_KEY."
+    return None
+
+
+def timestamp(value):
+    return datetime.utcfromtimestamp(value).isoformat() if value else None
+
+
+def job_status(job):
+    status = {
+        "id": job['id'],
+        "kind": job['kind'],
+        "state": job['state'],
+        "priority": job['priority'],
+        "attempts": job['attempts'],
+        "max_attempts": job['max_attempts'],
+        "created_at": timestamp(job['created_at']),
+        "started_at": timestamp(job['started_at']),
+        "finished_at": timestamp(job['finished_at']),
+        "error": job['error'],
+    }
+    if job['state'] == QUEUED and job['attempts']:
+        status['retry_at'] = timestamp(job['run_at'])
+    return status
+
+
+def job_links(job_id):
+    return {
+        "status_url": url_for('get_job', job_id=job_id),
+        "result_url": url_for('get_job_result', job_id=job_id),
+        "events_url": url_for('job_events', job_id=job_id),
+    }
+
+
+def job_result(job):
+    """The finished job's result, shaped like the response of its synchronous endpoint."""
+    result = job['result']
+    if job['kind'] == 'image':
+        return image_payload(result['key'], result['mime_type'], job['payload']['prompt'], result['cached'])
+    payload = job['payload']
+    return {
+        "url": url_for('tts_audio', key=result['key']),
+        "format": "mp3",
+        "voice": payload['voice'],
+        "speed": payload['speed'],
+        "cached": result['cached']
+    }
+
+
+def job_event(job):
+    event = job_status(job)
+    if job['state'] == DONE:
+        event['result'] = job_result(job)
+    return event
+
+
+async def afollow_job(queue, job_id, user_id, poll_interval, timeout):
+    """Yield an SSE event each time the job changes, until it finishes or ``timeout`` passes."""
+    last, deadline = None, time.monotonic() + timeout
+    while True:
+        job = await asyncio.to_thread(queue.get, job_id, user_id)
+        if job is None:
+            yield sse({'error': 'Job not found'})
+            return
+        event = job_event(job)
+        if event != last:
+            yield sse(event)
+            last = event
+        if job['state'] in FINISHED or time.monotonic() >= deadline:
+            return
+        await asyncio.sleep(poll_interval)
+
+
+def init_app(app):
+    @app.cli.command('jobs-worker')
+    @click.option('--threads', type=int, help='job threads (default: JOBS_WORKERS, at least 1)')
+    def jobs_worker_command(threads):
+        """Run background jobs in this process until interrupted."""
+        app.config['JOBS_WORKERS'] = threads or max(1, app.config['JOBS_WORKERS'])
+        runner = job_runner()
+        click.echo(f'Running jobs from {runner.queue.path} on {runner.workers} threads.')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            runner.close()
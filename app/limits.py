@@ -0,0 +1,148 @@
+"""Rate limits shared by every worker on the host.
+
+``TokenBuckets`` keeps one bucket per key in a SQLite file. A bucket holds up
+to ``burst`` tokens and refills at ``burst / period`` tokens per second; each
+``take`` spends tokens or reports how long until enough are available.
+``charge`` spends without asking, for costs only known afterwards, and may
+leave a bucket in debt.
+
+``Leases`` counts work in progress per key. A lease is held from
+``acquire`` until ``release``; the leases of a worker that died are reclaimed
+by the next ``acquire`` that finds its key full, and every lease expires
+after ``ttl`` seconds regardless.
+"""
+import math
+import os
+import socket
+import time
+
+from .cache import SQLiteStore, owner_alive
+
+PRUNE_EVERY = 1000
+
+
+class TokenBuckets(SQLiteStore):
+    def __init__(self, path, table='buckets'):
+        super().__init__(path)
+        self.table = table
+        self._takes = 0
+
+    def create(self, connection):
+        connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.table} ('
+            'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, full_at REAL NOT NULL)'
+        )
+        connection.execute(f'CREATE INDEX IF NOT EXISTS ix_{self.table}_full ON {self.table} (full_at)')
+
+    def take(self, key, burst, period, cost=1):
+        """Spend ``cost`` tokens from ``key``'s bucket; return 0 if allowed, else seconds until they are available."""
+        now = time.time()
+        rate = burst / period
+        with self.transaction() as connection:
+            tokens = self._tokens(connection, key, burst, rate, now)
+            if tokens < cost:
+                return (cost - tokens) / rate
+            self._store(connection, key, tokens - cost, burst, rate, now)
+        return 0
+
+    def charge(self, key, burst, period, cost):
+        """Spend ``cost`` tokens even if the bucket goes into debt; a negative cost refunds."""
+        now = time.time()
+        rate = burst / period
+        with self.transaction() as connection:
+            tokens = self._tokens(connection, key, burst, rate, now)
+            self._store(connection, key, min(burst, tokens - cost), burst, rate, now)
+
+    def available(self, key, burst, period):
+        row = self._connection().execute(
+            f'SELECT tokens, updated_at FROM {self.table} WHERE key = ?', (key,)
+        ).fetchone()
+        return burst if row is None else min(burst, row[0] + (time.time() - row[1]) * burst / period)
+
+    def _tokens(self, connection, key, burst, rate, now):
+        row = connection.execute(
+            f'SELECT tokens, updated_at FROM {self.table} WHERE key = ?', (key,)
+        ).fetchone()
+        return burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+
+    def _store(self, connection, key, tokens, burst, rate, now):
+        connection.execute(
+            f'INSERT OR REPLACE INTO {self.table} (key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?)',
+            (key, tokens, now, now + (burst - tokens) / rate)
+        )
+        self._takes += 1
+        if self._takes % PRUNE_EVERY == 0:
+            # A bucket that has refilled is the same as no bucket.
+            connection.execute(f'DELETE FROM {self.table} WHERE full_at < ?', (now,))
+
+    def reset(self, key):
+        with self.transaction() as connection:
+            connection.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+
+class Leases(SQLiteStore):
+    def __init__(self, path, table='leases'):
+        super().__init__(path)
+        self.table = table
+        self.host = socket.gethostname()
+
+    @property
+    def owner(self):
+        return f'{self.host}:{os.getpid()}'
+
+    def create(self, connection):
+        connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.table} ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, owner TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        connection.execute(f'CREATE INDEX IF NOT EXISTS ix_{self.table}_key ON {self.table} (key, expires_at)')
+
+    def acquire(self, limits, ttl):
+        """Take a lease on every key in ``limits``, a list of ``(key, limit)``.
+
+        Returns the lease ids, or ``(None, key)`` naming the first full key; no
+        lease is taken unless all of them fit.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            for key, limit in limits:
+                if self._held(connection, key, now) >= limit and (
+                        not self._reclaim(connection, key) or self._held(connection, key, now) >= limit):
+                    return None, key
+            ids = [
+                connection.execute(
+                    f'INSERT INTO {self.table} (key, owner, expires_at) VALUES (?, ?, ?)',
+                    (key, self.owner, now + ttl)
+                ).lastrowid
+                for key, _ in limits
+            ]
+            connection.execute(f'DELETE FROM {self.table} WHERE expires_at < ?', (now,))
+        return ids, None
+
+    def release(self, ids):
+        with self.transaction() as connection:
+            connection.executemany(f'DELETE FROM {self.table} WHERE id = ?', [(lease_id,) for lease_id in ids])
+
+    def counts(self):
+        """Return ``{key: leases held}`` for every key with a live lease."""
+        return dict(self._connection().execute(
+            f'SELECT key, COUNT(*) FROM {self.table} WHERE expires_at >= ? GROUP BY key', (time.time(),)
+        ).fetchall())
+
+    def _held(self, connection, key, now):
+        return connection.execute(
+            f'SELECT COUNT(*) FROM {self.table} WHERE key = ? AND expires_at >= ?', (key, now)
+        ).fetchone()[0]
+
+    def _reclaim(self, connection, key):
+        owners = [row[0] for row in connection.execute(
+            f'SELECT DISTINCT owner FROM {self.table} WHERE key = ?', (key,))]
+        dead = [owner for owner in owners if not owner_alive(owner, self.host)]
+        for owner in dead:
+            connection.execute(f'DELETE FROM {self.table} WHERE owner = ?', (owner,))
+        return bool(dead)
+
+
+def retry_after(seconds):
+    """Return a ``Retry-After`` header value for ``seconds``."""
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,402 @@
+"""TTS, STT and image helpers shared by the Flask routes and the async gateway."""
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, request, send_file, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from . import metrics, providers
+from .audioinfo import audio_duration
+from .blobstore import BlobStore, content_key
+from .cache import LRUCache, SQLiteCache, TieredCache
+
+TTS_MODEL = "tts-1"
+STT_MODEL = "whisper-1"
+IMAGE_MODEL = 'gemini-pro-vision'
+BLOB_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+STT_LANGUAGE = "en"
+HASH_CHUNK_BYTES = 1024 * 1024
+
+metrics.describe('image_cache_requests_total', 'Image store lookups by result.')
+metrics.describe('tts_cache_requests_total', 'TTS audio cache lookups by result.')
+metrics.histogram('tts_first_audio_seconds', 'Time from a TTS request to its first audio bytes, by mode.')
+
+# A sentence ends at terminal punctuation, or just after a closing quote or bracket, before whitespace.
+SENTENCE_END = re.compile(r'(?<=[.!?\u2026])\s+|(?<=[.!?\u2026]["\'\u201d\u2019)\]])\s+')
+CLAUSE_END = re.compile(r'(?<=[,;:\u2014])\s+')
+STREAM_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+metrics.describe('stt_cache_requests_total', 'Transcript cache lookups by result and tier.')
+
+
+class UploadRejected(Exception):
+    """An upload that breaks the STT limits; ``status`` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+IMAGE_GENERATION_CONFIG = {
+    'candidate_count': 1,
+    'stop_sequences': ['x'],
+    'max_output_tokens': 2048,
+    'temperature': 1.0,
+    'top_p': 0.8,
+    'top_k': 40
+}
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+
+def image_request(prompt):
+    """Return the ``generate_content`` keyword arguments for an image prompt."""
+    return {
+        'contents': {
+            'parts': [
+                {'text': prompt}
+            ]
+        },
+        'generation_config': providers.genai.types.GenerationConfig(**IMAGE_GENERATION_CONFIG)
+    }
+
+
+def extract_image(response):
+    """Return ``(image_bytes, mime_type)`` from a Gemini response, or None."""
+    if response and hasattr(response, 'candidates'):
+        for candidate in response.candidates:
+            if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
+                for part in candidate.content.parts:
+                    if hasattr(part, 'inline_data') and part.inline_data:
+                        return part.inline_data.data, part.inline_data.mime_type
+    return None
+
+
+def image_payload(key, mime_type, prompt, cached):
+    return {
+        "success": True,
+        "url": url_for('image_file', key=key),
+        "mime_type": mime_type,
+        "prompt": prompt,
+        "model": "gemini-2.5-flash-image",
+        "cached": cached
+    }
+
+
+def image_store():
+    """Return the on-disk image store, built from the app config on first use."""
+    app = current_app._get_current_object()
+    store = app.extensions.get('image_store')
+    if store is None:
+        store = app.extensions['image_store'] = BlobStore(
+            app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'], app.config['IMAGE_CACHE_MAX_AGE']
+        )
+    return store
+
+
+def image_prompt_key(prompt, model=IMAGE_MODEL):
+    return content_key(model, json.dumps(IMAGE_GENERATION_CONFIG, sort_keys=True), prompt)
+
+
+def cached_image(prompt_key):
+    """Return ``(image_key, mime_type)`` stored for ``prompt_key``, or None.
+
+    A prompt maps to a small JSON pointer blob naming the content-addressed
+    image, so identical images from different prompts are stored once.
+    """
+    store = image_store()
+    path = store.get(prompt_key)
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        pointer = json.loads(f.read())
+    if store.get(pointer['key']) is None:
+        return None
+    return pointer['key'], pointer['mime_type']
+
+
+def store_image(prompt_key, image_bytes, mime_type):
+    """Store a generated image under its content hash and point ``prompt_key`` at it."""
+    store = image_store()
+    key = content_key(image_bytes)
+    store.put(key, image_bytes)
+    store.put(prompt_key, json.dumps({'key': key, 'mime_type': mime_type}).encode('utf-8'))
+    return key
+
+
+def render_image(prompt, use_cache=True):
+    """Return ``(image_key, mime_type, cached)`` for ``prompt``, or None when the model sent no image."""
+    prompt_key = image_prompt_key(prompt)
+    stored = cached_image(prompt_key) if use_cache else None
+    metrics.inc('image_cache_requests_total', result='hit' if stored else 'miss')
+    if stored:
+        return (*stored, True)
+
+    response = providers.model(IMAGE_MODEL).generate_content(**image_request(prompt))
+    image = extract_image(response)
+    if image is None:
+        return None
+    image_bytes, mime_type = image
+    return store_image(prompt_key, image_bytes, mime_type), mime_type, False
+
+
+def image_mimetype(path):
+    with open(path, 'rb') as f:
+        head = f.read(12)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime_type
+    return None
+
+
+def image_response(path, key, mime_type):
+    response = send_file(path, mimetype=mime_type, conditional=True, etag=key)
+    response.headers['Cache-Control'] = BLOB_CACHE_CONTROL
+    return response
+
+
+def tts_payload(audio_bytes, voice, speed):
+    return {
+        "audio": base64.b64encode(audio_bytes).decode('utf-8'),
+        "format": "mp3",
+        "voice": voice,
+        "speed": speed
+    }
+
+
+def audio_store():
+    """Return the on-disk TTS cache, built from the app config on first use."""
+    app = current_app._get_current_object()
+    store = app.extensions.get('tts_cache')
+    if store is None:
+        store = app.extensions['tts_cache'] = BlobStore(
+            app.config['TTS_CACHE_DIR'], app.config['TTS_CACHE_MAX_BYTES']
+        )
+    return store
+
+
+def tts_key(text, voice, speed, model=TTS_MODEL):
+    return content_key(model, str(voice), repr(float(speed)), text)
+
+
+def synthesize_speech(text, voice, speed):
+    """Return ``(key, path, audio_bytes, cached)``; ``audio_bytes`` is None for a cached clip."""
+    key = tts_key(text, voice, speed)
+    store = audio_store()
+    path = store.get(key)
+    cached = path is not None
+    metrics.inc('tts_cache_requests_total', result='hit' if cached else 'miss')
+    if cached:
+        return key, path, None, True
+
+    response = providers.openai_client.audio.speech.create(
+        model=TTS_MODEL,
+        voice=voice,
+        input=text,
+        speed=speed
+    )
+    return key, store.put(key, response.content), response.content, False
+
+
+async def asynthesize_speech(text, voice, speed):
+    key = tts_key(text, voice, speed)
+    store = audio_store()
+    path = await asyncio.to_thread(store.get, key)
+    cached = path is not None
+    metrics.inc('tts_cache_requests_total', result='hit' if cached else 'miss')
+    if cached:
+        return key, path, None, True
+
+    response = await providers.async_openai_client.audio.speech.create(
+        model=TTS_MODEL,
+        voice=voice,
+        input=text,
+        speed=speed
+    )
+    return key, await asyncio.to_thread(store.put, key, response.content), response.content, False
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def speech_segments(text, max_chars, first_chars):
+    """Split ``text`` into sentences for synthesis, packed up to ``max_chars`` each.
+
+    Sentences longer than that break at clause ends, then at spaces. The
+    first segment holds at most ``first_chars`` so its audio is ready sooner.
+    """
+    sentences = [sentence.strip() for sentence in SENTENCE_END.split(text.strip()) if sentence.strip()]
+    pieces = []
+    for index, sentence in enumerate(sentences):
+        pieces.extend(_fit(sentence, first_chars if index == 0 else max_chars))
+    return _pack(pieces, first_chars, max_chars)
+
+
+def _fit(text, limit):
+    if len(text) <= limit:
+        return [text]
+    pieces = []
+    for clause in CLAUSE_END.split(text):
+        if len(clause) <= limit:
+            pieces.append(clause)
+            continue
+        for word in clause.split():
+            pieces.extend(word[start:start + limit] for start in range(0, len(word), limit))
+    return _pack(pieces, limit, limit)
+
+
+def _pack(pieces, first_limit, limit):
+    segments = []
+    for piece in pieces:
+        cap = first_limit if len(segments) == 1 else limit
+        if segments and len(segments[-1]) + 1 + len(piece) <= cap:
+            segments[-1] += ' ' + piece
+        else:
+            segments.append(piece)
+    return segments
+
+
+def stream_speech(segments, voice, speed, window):
+    """Yield each segment's MP3 in order, synthesizing up to ``window`` segments at a time.
+
+    Every segment is cached like a ``/voice/tts`` clip; MP3 frames from
+    consecutive clips play back as one stream.
+    """
+    app = current_app._get_current_object()
+
+    def synthesize(segment):
+        with app.app_context():
+            _, path, audio_bytes, _ = synthesize_speech(segment, voice, speed)
+            return read_file(path) if audio_bytes is None else audio_bytes
+
+    executor = ThreadPoolExecutor(max_workers=window, thread_name_prefix='tts-stream')
+    pending = deque()
+    try:
+        for segment in segments:
+            pending.append(executor.submit(synthesize, segment))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # A client that went away cancels the segments that have not started.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def astream_speech(segments, voice, speed, window):
+    async def synthesize(segment):
+        _, path, audio_bytes, _ = await asynthesize_speech(segment, voice, speed)
+        return await asyncio.to_thread(read_file, path) if audio_bytes is None else audio_bytes
+
+    pending = deque()
+    try:
+        for segment in segments:
+            pending.append(asyncio.ensure_future(synthesize(segment)))
+            if len(pending) >= window:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def wants_audio():
+    """True when the client asked for raw ``audio/mpeg`` instead of base64 JSON."""
+    if request.args.get('format') == 'audio':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'audio/mpeg']) == 'audio/mpeg'
+
+
+def audio_response(path, key):
+    """Stream a cached MP3 from disk; GET requests may ask for byte ranges."""
+    response = send_file(path, mimetype='audio/mpeg', conditional=True, etag=key)
+    response.headers['Cache-Control'] = BLOB_CACHE_CONTROL
+    return response
+
+
+def stt_upload():
+    """Return the ``audio`` upload of the current request or raise ``UploadRejected``.
+
+    Werkzeug spools large uploads to a temporary file while parsing, so the
+    upload is never held in memory; the provider reads ``audio.stream``.
+    """
+    try:
+        files = request.files
+    except RequestEntityTooLarge:
+        raise UploadRejected("Request body is too large", 413)
+    if 'audio' not in files:
+        raise UploadRejected("No audio file provided")
+    audio_file = files['audio']
+    if audio_file.filename == '':
+        raise UploadRejected("No selected file")
+
+    stream = audio_file.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    max_bytes = current_app.config['STT_MAX_BYTES']
+    if size > max_bytes:
+        raise UploadRejected(f"Audio file is larger than {max_bytes} bytes", 413)
+    if size == 0:
+        raise UploadRejected("Audio file is empty")
+    return audio_file
+
+
+def inspect_audio(audio_file):
+    """Hash the upload and check its duration; return the transcript cache key."""
+    stream = audio_file.stream
+    max_seconds = current_app.config['STT_MAX_SECONDS']
+    duration = audio_duration(stream)
+    if duration is not None and duration > max_seconds:
+        raise UploadRejected(f"Audio is longer than {max_seconds} seconds", 413)
+
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_BYTES), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return content_key(STT_MODEL, STT_LANGUAGE, digest.hexdigest())
+
+
+def upload_file(audio_file):
+    """Return the ``(filename, stream)`` pair handed to Whisper, which infers the format from the extension."""
+    extension = os.path.splitext(audio_file.filename or '')[1].lower()
+    return ('audio' + extension if extension else 'audio.webm'), audio_file.stream
+
+
+def transcript_cache():
+    """Return this process's transcript cache, built from the app config on first use."""
+    app = current_app._get_current_object()
+    cache = app.extensions.get('transcript_cache')
+    if cache is None:
+        ttl = app.config['STT_CACHE_TTL']
+        shared = None
+        if app.config['STT_CACHE_PATH']:
+            shared = SQLiteCache(app.config['STT_CACHE_PATH'], app.config['STT_CACHE_SHARED_SIZE'], ttl,
+                                 table='transcripts')
+        cache = app.extensions['transcript_cache'] = TieredCache(
+            LRUCache(app.config['STT_CACHE_SIZE'], ttl), shared
+        )
+    return cache
+
+
+def cached_transcript(key):
+    value, tier = transcript_cache().get(key)
+    metrics.inc('stt_cache_requests_total', result='hit' if value else 'miss', tier=tier or 'none')
+    return value
@@ -0,0 +1,206 @@
+"""Counters, gauges and histograms rendered in the Prometheus text format.
+
+Each worker keeps its own series. Functions registered with ``collector``
+run before each snapshot to refresh gauges that mirror state kept
+elsewhere. ``SharedMetrics`` pools the snapshots of every worker on the
+host in a SQLite file so that any worker can answer a scrape for all of
+them: counters and histograms are summed, including those of workers that
+have exited, and gauges are summed over the live workers. Gauges described
+with ``merge='local'`` already hold a host-wide value and are reported from
+the rendering worker alone.
+"""
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from .cache import SQLiteStore, owner_alive
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_help = {}
+_local = set()
+_histograms = {}
+_collectors = []
+
+# Seconds; suits request, provider and query latencies alike.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RETIRED = 'retired'
+
+logger = logging.getLogger(__name__)
+
+
+def describe(name, text, merge='sum'):
+    _help[name] = text
+    if merge == 'local':
+        _local.add(name)
+
+
+def histogram(name, text, buckets=DEFAULT_BUCKETS):
+    _help[name] = text
+    _histograms[name] = tuple(buckets)
+
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] += value
+
+
+def gauge(name, value, **labels):
+    with _lock:
+        _gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+def adjust(name, delta, **labels):
+    """Add ``delta`` to a gauge, for counts of things in progress."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + delta
+
+
+def observe(name, value, **labels):
+    """Record ``value`` in the histogram ``name``."""
+    labels = tuple(sorted(labels.items()))
+    with _lock:
+        for bound in _histograms[name]:
+            if value <= bound:
+                _counters[(f'{name}_bucket', labels + (('le', f'{bound:g}'),))] += 1
+        _counters[(f'{name}_bucket', labels + (('le', '+Inf'),))] += 1
+        _counters[(f'{name}_sum', labels)] += value
+        _counters[(f'{name}_count', labels)] += 1
+
+
+def collector(fn):
+    _collectors.append(fn)
+    return fn
+
+
+def value(name, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    return _gauges[key] if key in _gauges else _counters.get(key, 0)
+
+
+def snapshot():
+    """Return this worker's series as ``[(name, labels, kind, value)]``; kind is counter or gauge."""
+    for fn in list(_collectors):
+        try:
+            fn()
+        except Exception:
+            logger.exception('Metrics collector %s failed', fn.__name__)
+    with _lock:
+        return ([(name, labels, 'counter', count) for (name, labels), count in _counters.items()] +
+                [(name, labels, 'gauge', count) for (name, labels), count in _gauges.items()])
+
+
+def family(name):
+    """Return the metric a series belongs to and its Prometheus type."""
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in _histograms:
+            return name[:-len(suffix)], 'histogram'
+    return name, None
+
+
+def _order(sample):
+    name, labels, kind, _ = sample
+    base, _ = family(name)
+    plain = tuple(item for item in labels if item[0] != 'le')
+    le = dict(labels).get('le')
+    bound = math.inf if le == '+Inf' else float(le) if le is not None else 0
+    return base, plain, ('_bucket', '_sum', '_count').index(name[len(base):]) if name != base else 0, bound
+
+
+def render(samples=None):
+    samples = sorted(snapshot() if samples is None else samples, key=_order)
+    lines = []
+    seen = set()
+    for name, labels, kind, count in samples:
+        base, histogram_kind = family(name)
+        if base not in seen:
+            seen.add(base)
+            if base in _help:
+                lines.append(f'# HELP {base} {_help[base]}')
+            lines.append(f'# TYPE {base} {histogram_kind or kind}')
+        label_text = ','.join(f'{key}="{val}"' for key, val in labels)
+        lines.append(f'{name}{{{label_text}}} {count:g}' if label_text else f'{name} {count:g}')
+    return '\n'.join(lines) + '\n'
+
+
+class SharedMetrics(SQLiteStore):
+    def __init__(self, path):
+        super().__init__(path)
+        self.host = socket.gethostname()
+
+    @property
+    def owner(self):
+        return f'{self.host}:{os.getpid()}'
+
+    def create(self, connection):
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS samples (owner TEXT NOT NULL, name TEXT NOT NULL, labels TEXT NOT NULL, '
+            'kind TEXT NOT NULL, value REAL NOT NULL, PRIMARY KEY (owner, name, labels))'
+        )
+
+    def push(self, samples=None):
+        """Replace this worker's stored series with ``samples`` (default: a fresh snapshot)."""
+        samples = snapshot() if samples is None else samples
+        rows = [(self.owner, name, json.dumps(labels), kind, count)
+                for name, labels, kind, count in samples if name not in _local]
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM samples WHERE owner = ?', (self.owner,))
+            connection.executemany('INSERT INTO samples VALUES (?, ?, ?, ?, ?)', rows)
+
+    def merged(self):
+        """Return the series of every worker on the host, this one freshly pushed."""
+        samples = snapshot()
+        self.push(samples)
+        self._retire_dead()
+        totals = {}
+        for name, labels, kind, count in self._connection().execute(
+                'SELECT name, labels, kind, SUM(value) FROM samples GROUP BY name, labels, kind'):
+            totals[(name, tuple(tuple(item) for item in json.loads(labels)), kind)] = count
+        merged = [(name, labels, kind, count) for (name, labels, kind), count in totals.items()]
+        return merged + [sample for sample in samples if sample[0] in _local]
+
+    def _retire_dead(self):
+        # Keep an exited worker's counters in the totals; drop its gauges.
+        with self.transaction() as connection:
+            owners = [row[0] for row in connection.execute('SELECT DISTINCT owner FROM samples')]
+            for owner in owners:
+                if owner == RETIRED or owner_alive(owner, self.host):
+                    continue
+                connection.execute(
+                    'INSERT INTO samples SELECT ?, name, labels, kind, value FROM samples '
+                    "WHERE owner = ? AND kind = 'counter' "
+                    'ON CONFLICT (owner, name, labels) DO UPDATE SET value = value + excluded.value',
+                    (RETIRED, owner)
+                )
+                connection.execute('DELETE FROM samples WHERE owner = ?', (owner,))
+
+
+class Pusher:
+    """Push this worker's series every ``interval`` seconds from a daemon thread; 0 turns it off."""
+
+    def __init__(self, store, interval):
+        self.store = store
+        self.interval = interval
+        self._pid = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid() or self.interval <= 0:
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name='metrics-pusher', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.store.push()
+            except Exception:
+                logger.exception('Pushing metrics failed')
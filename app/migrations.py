@@ -0,0 +1,82 @@
+"""Idempotent schema upgrades for databases created by an older release.
+
+``db.create_all`` only creates missing tables, so columns and indexes added
+to existing tables are applied here. Every step checks the live schema first
+and can be re-run safely. Nothing runs at boot; deploys run ``flask --app
+main migrate`` once before starting the workers.
+"""
+import click
+from sqlalchemy import inspect, text
+
+from . import db, search
+from .models import ChatHistory, Conversation, chain_hash
+
+
+def init_app(app):
+    @app.cli.command('migrate')
+    def migrate_command():
+        """Create missing tables and apply schema upgrades."""
+        migrate()
+        click.echo('Database schema is up to date.')
+
+
+def migrate():
+    db.create_all()
+    upgrade()
+
+
+def upgrade():
+    for table in db.metadata.sorted_tables:
+        add_missing_columns(table)
+        create_missing_indexes(table)
+    with db.engine.begin() as connection:
+        search.create_index(connection)
+    rollup_chat_history()
+
+
+def add_missing_columns(table):
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    with db.engine.begin() as connection:
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+
+def create_missing_indexes(table):
+    for index in table.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+def rollup_chat_history():
+    """Fold legacy ``ChatHistory`` snapshots into conversations and delete them.
+
+    Every ``/api/chat`` call used to store the whole conversation again, so a
+    snapshot whose messages start with an earlier snapshot's messages continues
+    that conversation and only its new tail is appended.
+    """
+    user_ids = [row.user_id for row in db.session.query(ChatHistory.user_id).distinct()]
+    for user_id in user_ids:
+        heads = {}
+        rows = (ChatHistory.query.filter_by(user_id=user_id)
+                .order_by(ChatHistory.created_at, ChatHistory.id).all())
+        for row in rows:
+            messages = row.conversation or []
+            prefixes = [None]
+            for message in messages:
+                prefixes.append(chain_hash(prefixes[-1], message))
+
+            conversation, start = None, 0
+            for length in range(len(messages), 0, -1):
+                if prefixes[length] in heads:
+                    conversation, start = heads.pop(prefixes[length]), length
+                    break
+            if conversation is None and messages:
+                conversation = Conversation(user_id, created_at=row.created_at)
+                db.session.add(conversation)
+
+            if conversation is not None:
+                conversation.append(messages[start:], created_at=row.created_at)
+                heads[conversation.head_hash] = conversation
+            db.session.delete(row)
+        db.session.commit()
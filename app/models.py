@@ -1,7 +1,9 @@
 from . import db
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from .auth import password_hasher
 from datetime import datetime
+import hashlib
+import json
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -19,13 +21,139 @@ class User(UserMixin, db.Model):
         self.phone = phone
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher().hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher().verify(self.password_hash, password)
+
+def message_text(message):
+    content = message.get('content')
+    if content is None:
+        content = ' '.join(str(part) for part in message.get('parts', []))
+    return content
+
+def conversation_title(conversation, length=60):
+    """Return the opening user message of ``conversation`` for list views."""
+    for message in conversation:
+        if message.get('role') == 'user':
+            return message_text(message)[:length]
+    return ''
+
+def chain_hash(previous, message):
+    """Fold ``message`` into the running hash of the messages before it."""
+    payload = json.dumps([message.get('role'), message_text(message)], ensure_ascii=False)
+    return hashlib.sha256(((previous or '') + payload).encode('utf-8')).hexdigest()
+
+def head_hash(messages):
+    digest = None
+    for message in messages:
+        digest = chain_hash(digest, message)
+    return digest
+
+class Conversation(db.Model):
+    __tablename__ = 'conversations'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    title = db.Column(db.String(120))
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+    head_hash = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    messages = db.relationship('Message', back_populates='conversation', order_by='Message.seq',
+                               lazy='dynamic', cascade='all, delete-orphan')
+
+    __table_args__ = (
+        db.Index('ix_conversations_user_created', 'user_id', 'created_at'),
+        db.Index('ix_conversations_user_head', 'user_id', 'head_hash'),
+    )
+
+    def __init__(self, user_id, created_at=None):
+        self.user_id = user_id
+        self.message_count = 0
+        self.created_at = self.updated_at = created_at or datetime.utcnow()
+
+    def append(self, messages, created_at=None):
+        """Add ``messages`` after the current tail; only new rows are written."""
+        created_at = created_at or datetime.utcnow()
+        for message in messages:
+            db.session.add(Message(
+                conversation=self,
+                seq=self.message_count,
+                role=message.get('role'),
+                content=message_text(message),
+                created_at=created_at
+            ))
+            self.message_count += 1
+            self.head_hash = chain_hash(self.head_hash, message)
+        if not self.title:
+            self.title = conversation_title(messages)
+        self.updated_at = created_at
+
+    def to_messages(self):
+        return [message.to_dict() for message in self.messages]
+
+class Message(db.Model):
+    __tablename__ = 'messages'
+
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    role = db.Column(db.String(20), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    conversation = db.relationship('Conversation', back_populates='messages')
+
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
 
 class ChatHistory(db.Model):
+    """Legacy whole-conversation snapshots, rolled up into ``Conversation`` by migrations."""
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     conversation = db.Column(db.JSON, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_chat_history_user_created', 'user_id', 'created_at'),
+    )
+
+class UsageRecord(db.Model):
+    """One chat request's token usage, inserted in batches by ``usage.UsageLedger``."""
+    __tablename__ = 'usage_records'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    model = db.Column(db.String(100), nullable=False)
+    endpoint = db.Column(db.String(40), nullable=False)
+    prompt_tokens = db.Column(db.Integer, nullable=False, default=0)
+    completion_tokens = db.Column(db.Integer, nullable=False, default=0)
+    total_tokens = db.Column(db.Integer, nullable=False, default=0)
+    latency_ms = db.Column(db.Integer, nullable=False, default=0)
+    cached = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_usage_records_user_created', 'user_id', 'created_at'),
+    )
+
+class UsageRollup(db.Model):
+    """Usage summed per user and model over an hour or a day, starting at ``bucket``."""
+    __tablename__ = 'usage_rollups'
+
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(8), nullable=False)
+    bucket = db.Column(db.DateTime, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    model = db.Column(db.String(100), nullable=False)
+    requests = db.Column(db.Integer, nullable=False, default=0)
+    cached_requests = db.Column(db.Integer, nullable=False, default=0)
+    prompt_tokens = db.Column(db.BigInteger, nullable=False, default=0)
+    completion_tokens = db.Column(db.BigInteger, nullable=False, default=0)
+    total_tokens = db.Column(db.BigInteger, nullable=False, default=0)
+    latency_ms = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('period', 'user_id', 'bucket', 'model', name='uq_usage_rollups_key'),
+    )
@@ -0,0 +1,124 @@
+"""Request, database and connection pool metrics.
+
+``init_app`` times every request into ``http_request_duration_seconds`` by
+route; for a stream that is the time to the response headers, and the
+stream itself is covered by the provider and stream metrics in ``router``
+and ``chat``. SQLAlchemy events time each statement and count pooled
+connections in use, and pass each statement on to ``profiling`` in case its
+request is being profiled. Workers push their series to ``METRICS_PATH``
+every ``METRICS_PUSH_INTERVAL`` seconds and ``/metrics`` renders the host's
+totals.
+"""
+import logging
+import sqlite3
+import time
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+from . import db, metrics, profiling
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = {'select', 'insert', 'update', 'delete', 'begin', 'commit', 'rollback'}
+
+metrics.histogram('http_request_duration_seconds', 'Time to a response, by route, method and status.')
+metrics.histogram('db_query_duration_seconds', 'SQL statement execution time, by operation.')
+metrics.describe('db_pool_checked_out', 'Pooled database connections in use.')
+metrics.describe('db_pool_size', 'Connections the database pool keeps open.')
+
+
+def init_app(app):
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        pusher().ensure_started()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                            route=route, method=request.method, status=str(response.status_code))
+        return response
+
+
+def shared_metrics():
+    """Return the host-wide metrics store, built from the app config on first use."""
+    app = current_app._get_current_object()
+    store = app.extensions.get('shared_metrics')
+    if store is None:
+        store = app.extensions['shared_metrics'] = metrics.SharedMetrics(app.config['METRICS_PATH'])
+    return store
+
+
+def pusher():
+    app = current_app._get_current_object()
+    instance = app.extensions.get('metrics_pusher')
+    if instance is None:
+        instance = app.extensions['metrics_pusher'] = metrics.Pusher(shared_metrics(),
+                                                                     app.config['METRICS_PUSH_INTERVAL'])
+    return instance
+
+
+def render():
+    """Render the metrics of every worker on the host, or of this one if the shared file is unusable."""
+    try:
+        return metrics.render(shared_metrics().merged())
+    except sqlite3.Error:
+        logger.exception('Reading shared metrics failed')
+        return metrics.render()
+
+
+def database_ok():
+    try:
+        db.session.execute(text('SELECT 1'))
+        return True
+    except Exception:
+        logger.exception('Database health check failed')
+        db.session.rollback()
+        return False
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _statement_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _statement_finished(conn, cursor, statement, parameters, context, executemany):
+    stack = conn.info.get('statement_started')
+    if not stack:
+        return
+    elapsed = time.perf_counter() - stack.pop()
+    operation = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else 'other'
+    metrics.observe('db_query_duration_seconds', elapsed, operation=operation if operation in OPERATIONS else 'other')
+    profiling.record_statement(statement, elapsed)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _statement_failed(context):
+    connection = context.connection
+    if connection is not None and connection.info.get('statement_started'):
+        connection.info['statement_started'].pop()
+
+
+@event.listens_for(Pool, 'checkout')
+def _connection_checked_out(dbapi_connection, record, proxy):
+    metrics.adjust('db_pool_checked_out', 1)
+
+
+@event.listens_for(Pool, 'checkin')
+def _connection_checked_in(dbapi_connection, record):
+    metrics.adjust('db_pool_checked_out', -1)
+
+
+@metrics.collector
+def _publish_pool_size():
+    if has_app_context():
+        size = getattr(db.engine.pool, 'size', None)
+        if callable(size):
+            metrics.gauge('db_pool_size', size())
@@ -0,0 +1,291 @@
+"""Write chat turns to the database behind the response.
+
+``TurnWriter.submit`` appends a finished turn to a journal, a SQLite file on
+the host like the other shared worker state, and returns. A background
+thread in each worker moves journalled turns into the database in batches,
+one transaction per batch, once ``PERSIST_BATCH_SIZE`` turns are waiting or
+every ``PERSIST_FLUSH_INTERVAL`` seconds. The journal is drained when the
+worker exits. Turns left behind by a worker that died are adopted by the
+next flush of any worker on the host, so a crash delays them rather than
+losing them; a crash between the database commit and the journal delete
+writes a turn twice.
+
+Until a turn is written, the worker that accepted it still serves it as
+part of the conversation's history (``unwritten``). Each pending turn
+carries the head hash the conversation will have once it is written, which
+tells it apart from turns already in the database.
+"""
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from datetime import datetime, timezone
+
+from flask import has_app_context
+from sqlalchemy.exc import IntegrityError
+
+from . import db, metrics
+from .cache import SQLiteStore, owner_alive
+from .models import Conversation, chain_hash, message_text
+
+logger = logging.getLogger(__name__)
+
+SAVE_ATTEMPTS = 3
+# Seconds a written turn stays in the pending list for readers that loaded
+# the conversation row just before it was committed.
+WRITTEN_GRACE = 30
+ORPHAN_SWEEP_INTERVAL = 30
+
+metrics.describe('persist_turns_total', 'Chat turns by write-behind state (queued, written, dropped).')
+metrics.describe('persist_batches_total', 'Write-behind batches committed to the database.')
+metrics.describe('persist_queue_depth', 'Chat turns accepted by this worker and not yet written.')
+
+
+class TurnJournal(SQLiteStore):
+    """Turns accepted but not yet written, owned by the worker that accepted them."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.host = socket.gethostname()
+
+    @property
+    def owner(self):
+        return f'{self.host}:{os.getpid()}'
+
+    def create(self, connection):
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS turns ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, owner TEXT NOT NULL, conversation_id INTEGER NOT NULL, '
+            'messages TEXT NOT NULL, created_at REAL NOT NULL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_turns_owner ON turns (owner, id)')
+
+    def append(self, conversation_id, messages, created_at):
+        with self.transaction() as connection:
+            return connection.execute(
+                'INSERT INTO turns (owner, conversation_id, messages, created_at) VALUES (?, ?, ?, ?)',
+                (self.owner, conversation_id, json.dumps(messages), created_at)
+            ).lastrowid
+
+    def claim(self, limit, adopt=False):
+        """Return up to ``limit`` of this worker's oldest turns as ``(id, conversation_id, messages, created_at)``.
+
+        With ``adopt`` the turns of exited workers on this host become this worker's first.
+        """
+        owner = self.owner
+        with self.transaction() as connection:
+            if adopt:
+                owners = [row[0] for row in connection.execute('SELECT DISTINCT owner FROM turns')]
+                dead = [name for name in owners if name != owner and not owner_alive(name, self.host)]
+                for name in dead:
+                    connection.execute('UPDATE turns SET owner = ? WHERE owner = ?', (owner, name))
+            rows = connection.execute(
+                'SELECT id, conversation_id, messages, created_at FROM turns WHERE owner = ? ORDER BY id LIMIT ?',
+                (owner, limit)
+            ).fetchall()
+        return [(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
+
+    def delete(self, ids):
+        with self.transaction() as connection:
+            connection.executemany('DELETE FROM turns WHERE id = ?', [(turn_id,) for turn_id in ids])
+
+
+class PendingTurn:
+    __slots__ = ('journal_id', 'messages', 'head', 'written_at')
+
+    def __init__(self, journal_id, messages, head):
+        self.journal_id = journal_id
+        self.messages = messages
+        self.head = head
+        self.written_at = None
+
+
+class TurnWriter:
+    def __init__(self, app, journal, batch_size, flush_interval, background=True, cache=None):
+        self.app = app
+        self.journal = journal
+        self.cache = cache
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.background = background
+        self._pending = defaultdict(list)
+        self._heads = {}
+        self._waiting = 0
+        self._state = threading.Lock()
+        self._flushing = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._pid = None
+
+    def submit(self, user_id, conversation_id, messages, head):
+        """Queue ``messages`` for the end of a conversation.
+
+        ``head`` is the conversation's stored head hash; turns still pending here
+        come before the new one.
+        """
+        journal_id = self.journal.append(conversation_id, messages, time.time())
+        with self._state:
+            turns = self._pending[conversation_id]
+            if turns:
+                head = turns[-1].head
+            for message in messages:
+                head = chain_hash(head, message)
+            turns.append(PendingTurn(journal_id, messages, head))
+            self._heads[(user_id, head)] = conversation_id
+            self._waiting += 1
+            waiting = self._waiting
+        metrics.inc('persist_turns_total', state='queued')
+        metrics.gauge('persist_queue_depth', waiting)
+        if not self.background:
+            self.flush()
+            return
+        self._start()
+        if waiting >= self.batch_size:
+            self._wake.set()
+
+    def last_head(self, conversation_id):
+        """Return the head hash after this worker's latest pending turn, or None."""
+        with self._state:
+            turns = self._pending.get(conversation_id)
+            return turns[-1].head if turns else None
+
+    def conversation_for(self, user_id, head):
+        """Return the conversation a pending turn left at ``head``, if any."""
+        with self._state:
+            return self._heads.get((user_id, head))
+
+    def unwritten(self, conversation_id, head):
+        """Return the pending messages that follow ``head``, the stored head of the conversation."""
+        with self._state:
+            turns = list(self._pending.get(conversation_id, ()))
+        for index, turn in enumerate(turns):
+            if turn.head == head:
+                turns = turns[index + 1:]
+                break
+        else:
+            turns = [turn for turn in turns if turn.written_at is None]
+        return [message for turn in turns for message in turn.messages]
+
+    def flush(self, adopt=False):
+        """Write journalled turns to the database until none are left; return how many were written."""
+        written = 0
+        with self._flushing:
+            while True:
+                rows = self.journal.claim(self.batch_size, adopt)
+                if not rows:
+                    return written
+                context = nullcontext() if has_app_context() else self.app.app_context()
+                with context:
+                    appended = write_batch(rows)
+                self.journal.delete([row[0] for row in rows])
+                self._update_cache(appended)
+                self._settle({row[0] for row in rows})
+                written += len(rows)
+
+    def close(self):
+        """Stop the background thread and drain the journal."""
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=30)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Draining chat turns at shutdown failed')
+
+    def _update_cache(self, appended):
+        # Extend hot copies that were current before the batch; anything else reloads.
+        if self.cache is None:
+            return
+        for conversation_id, (before, after, messages) in appended.items():
+            entry = self.cache.get(conversation_id)
+            if before == 0:
+                entry = (0, [])
+            if entry is not None and entry[0] == before:
+                stored = [{"role": m.get('role'), "content": message_text(m)} for m in messages]
+                self.cache.set(conversation_id, (after, entry[1] + stored))
+            else:
+                self.cache.delete(conversation_id)
+
+    def _settle(self, journal_ids):
+        now = time.time()
+        with self._state:
+            for conversation_id in list(self._pending):
+                turns = self._pending[conversation_id]
+                for turn in turns:
+                    if turn.journal_id in journal_ids:
+                        turn.written_at = now
+                        self._waiting -= 1
+                kept = [turn for turn in turns if turn.written_at is None or turn.written_at > now - WRITTEN_GRACE]
+                if kept:
+                    self._pending[conversation_id] = kept
+                else:
+                    del self._pending[conversation_id]
+            live = {turn.head for turns in self._pending.values() for turn in turns}
+            self._heads = {key: value for key, value in self._heads.items() if key[1] in live}
+            waiting = self._waiting
+        metrics.inc('persist_turns_total', len(journal_ids), state='written')
+        metrics.inc('persist_batches_total')
+        metrics.gauge('persist_queue_depth', waiting)
+
+    def _start(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='turn-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        swept_at = 0.0
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            adopt = time.monotonic() - swept_at >= ORPHAN_SWEEP_INTERVAL
+            if not (self._waiting or adopt):
+                continue
+            try:
+                self.flush(adopt)
+                if adopt:
+                    swept_at = time.monotonic()
+            except Exception:
+                # The turns stay journalled and the next interval retries them.
+                logger.exception('Writing chat turns failed')
+
+
+def write_batch(rows):
+    """Append each journalled turn to its conversation in a single transaction.
+
+    Returns ``{conversation_id: (count_before, count_after, messages)}``.
+    """
+    for attempt in range(SAVE_ATTEMPTS):
+        try:
+            ids = {row[1] for row in rows}
+            conversations = {c.id: c for c in Conversation.query.filter(Conversation.id.in_(ids)).with_for_update()}
+            appended = {}
+            for _, conversation_id, messages, created_at in rows:
+                conversation = conversations.get(conversation_id)
+                if conversation is None:
+                    logger.warning('Dropping a turn for missing conversation %s', conversation_id)
+                    metrics.inc('persist_turns_total', state='dropped')
+                    continue
+                before, _, written = appended.get(conversation_id, (conversation.message_count, 0, []))
+                conversation.append(messages, created_at=datetime.fromtimestamp(created_at, timezone.utc)
+                                    .replace(tzinfo=None))
+                appended[conversation_id] = (before, conversation.message_count, written + messages)
+            db.session.commit()
+            return appended
+        except IntegrityError:
+            # Another worker appended to the same conversation; reload and retry.
+            db.session.rollback()
+            if attempt == SAVE_ATTEMPTS - 1:
+                raise
+        except Exception:
+            db.session.rollback()
+            raise
@@ -0,0 +1,239 @@
+"""Per-request profiles for finding where a slow request spends its time.
+
+A request is profiled when an administrator (``ADMIN_EMAILS``) sends the
+``PROFILE_HEADER`` header, or when it falls in the ``PROFILE_SAMPLE_RATE``
+fraction of all requests. Its profile holds a cProfile run of the request
+and every SQL statement it executed with its timings, grouped by statement.
+Profiles are written to ``PROFILE_DIR``, which keeps the newest
+``PROFILE_KEEP``, and are listed at ``/admin/profiles``. An unprofiled
+request costs a header lookup and, for each statement, a check of ``g``.
+
+cProfile follows the thread that started it. A streamed response is
+profiled until the stream closes; on the ASGI gateway the event loop
+thread also runs other requests, and their coroutines show up in the
+profile too. A request that arrives while its thread is already being
+profiled gets its SQL breakdown only.
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import current_app, g, has_request_context, request
+from flask_login import current_user
+
+from . import metrics
+from .auth import is_admin
+
+logger = logging.getLogger(__name__)
+
+TOP_FUNCTIONS = 40
+TOP_STATEMENTS = 50
+PROFILE_ID = re.compile(r'\d{8}T\d{12}-[0-9a-f]{8}')
+
+_thread = threading.local()
+
+metrics.describe('request_profiles_total', 'Requests profiled, by trigger (header, sampled).')
+
+
+class RequestProfile:
+    def __init__(self, reason):
+        self.id = f'{datetime.utcnow():%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}'
+        self.reason = reason
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.statements = {}
+        self.profiler = None
+        if not getattr(_thread, 'busy', False):
+            _thread.busy = True
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def statement(self, text, elapsed):
+        entry = self.statements.get(text)
+        if entry is None:
+            entry = self.statements[text] = {'statement': text, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+        entry['count'] += 1
+        entry['total_ms'] += elapsed * 1000
+        entry['max_ms'] = max(entry['max_ms'], elapsed * 1000)
+
+    def stop(self):
+        if hasattr(self, 'duration'):
+            return
+        self.duration = time.perf_counter() - self.started
+        if self.profiler is not None:
+            self.profiler.disable()
+            _thread.busy = False
+
+    def report(self, details):
+        statements = sorted(self.statements.values(), key=lambda entry: entry['total_ms'], reverse=True)
+        for entry in statements:
+            entry['total_ms'] = round(entry['total_ms'], 3)
+            entry['max_ms'] = round(entry['max_ms'], 3)
+        return {
+            'id': self.id,
+            'reason': self.reason,
+            'started_at': self.started_at.isoformat(),
+            'duration_ms': round(self.duration * 1000, 3),
+            **details,
+            'sql': {
+                'count': sum(entry['count'] for entry in statements),
+                'total_ms': round(sum(entry['total_ms'] for entry in statements), 3),
+                'statements': statements[:TOP_STATEMENTS],
+            },
+            'functions': self.functions(),
+        }
+
+    def functions(self):
+        """Return the functions with the most cumulative time, heaviest first."""
+        if self.profiler is None:
+            return []
+        stats = pstats.Stats(self.profiler, stream=io.StringIO())
+        rows = []
+        for (filename, line, name), (_, calls, own, cumulative, _) in stats.stats.items():
+            rows.append({
+                'function': f'{filename}:{line}({name})',
+                'calls': calls,
+                'own_ms': round(own * 1000, 3),
+                'cumulative_ms': round(cumulative * 1000, 3),
+            })
+        rows.sort(key=lambda row: row['cumulative_ms'], reverse=True)
+        return rows[:TOP_FUNCTIONS]
+
+
+class ProfileStore:
+    """A directory of profiles, each a JSON report and a ``.prof`` file for pstats or snakeviz."""
+
+    def __init__(self, path, keep):
+        self.path = path
+        self.keep = keep
+
+    def save(self, profile, report):
+        os.makedirs(self.path, exist_ok=True)
+        base = os.path.join(self.path, profile.id)
+        if profile.profiler is not None:
+            profile.profiler.dump_stats(base + '.prof')
+        with open(base + '.json.tmp', 'w') as f:
+            json.dump(report, f)
+        os.replace(base + '.json.tmp', base + '.json')
+        self.prune()
+
+    def prune(self):
+        ids = self.ids()
+        for profile_id in ids[self.keep:]:
+            for suffix in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(self.path, profile_id + suffix))
+                except FileNotFoundError:
+                    pass
+
+    def ids(self):
+        """Return the stored profile ids, newest first."""
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return sorted((name[:-5] for name in names if name.endswith('.json')), reverse=True)
+
+    def load(self, profile_id):
+        if not PROFILE_ID.fullmatch(profile_id):
+            return None
+        try:
+            with open(os.path.join(self.path, profile_id + '.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def stats_path(self, profile_id):
+        if not PROFILE_ID.fullmatch(profile_id):
+            return None
+        path = os.path.join(self.path, profile_id + '.prof')
+        return path if os.path.exists(path) else None
+
+    def index(self, limit):
+        entries = []
+        for profile_id in self.ids()[:limit]:
+            report = self.load(profile_id)
+            if report is not None:
+                entries.append({key: report[key] for key in
+                                ('id', 'reason', 'started_at', 'duration_ms', 'method', 'path', 'status', 'user_id')}
+                               | {'sql_count': report['sql']['count'], 'sql_ms': report['sql']['total_ms']})
+        return entries
+
+
+def profile_store():
+    app = current_app._get_current_object()
+    store = app.extensions.get('profile_store')
+    if store is None:
+        store = app.extensions['profile_store'] = ProfileStore(app.config['PROFILE_DIR'], app.config['PROFILE_KEEP'])
+    return store
+
+
+def init_app(app):
+    @app.before_request
+    def start_profile():
+        config = app.config
+        reason = None
+        if config['PROFILE_HEADER'] in request.headers:
+            if is_admin(current_user):
+                reason = 'header'
+        elif config['PROFILE_SAMPLE_RATE'] and random.random() < config['PROFILE_SAMPLE_RATE']:
+            reason = 'sampled'
+        if reason and not request.path.startswith('/admin/profiles'):
+            g.profile = RequestProfile(reason)
+            metrics.inc('request_profiles_total', reason=reason)
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.get('profile')
+        if profile is None:
+            return response
+        details = {
+            'method': request.method,
+            'path': request.path,
+            'query': request.query_string.decode('latin-1'),
+            'status': response.status_code,
+            'user_id': current_user.get_id(),
+            'streamed': response.is_streamed,
+        }
+        store = profile_store()
+        response.headers['X-Profile-Id'] = profile.id
+
+        def finish():
+            profile.stop()
+            try:
+                store.save(profile, profile.report(details))
+            except Exception:
+                logger.exception('Saving profile %s failed', profile.id)
+
+        if response.is_streamed:
+            # Statements run by the stream are still recorded while its context lasts.
+            g.profile_deferred = True
+            response.call_on_close(finish)
+        else:
+            g.pop('profile')
+            finish()
+        return response
+
+    @app.teardown_request
+    def abandon_profile(exc):
+        # A request that failed before ``finish_profile`` must not leave its thread profiled.
+        profile = g.pop('profile', None)
+        if profile is not None and not g.get('profile_deferred'):
+            profile.stop()
+
+
+def record_statement(statement, elapsed):
+    """Add a statement to the profile of the current request, if it is being profiled."""
+    if has_request_context():
+        profile = g.get('profile')
+        if profile is not None:
+            profile.statement(statement, elapsed)
@@ -0,0 +1,359 @@
+"""Provider calls behind the chat routes, in sync and async flavours.
+
+``complete`` returns ``(text, usage)``; ``stream`` yields ``{'content': ...}``
+events followed by at most one ``{'usage': ...}`` event. ``usage`` is the
+OpenAI-style token dict or None when the provider did not report it.
+
+The provider SDKs are slow to import, so neither is imported until it is
+first needed: ``openai_client``, ``async_openai_client``, ``gemini_client``
+and ``genai`` are module attributes built on first access, then shared by
+every app instance and importing module. The OpenAI clients get pooled HTTP
+transports sized by the ``PROVIDER_*`` config; Gemini model handles are
+cached by name. A forked worker drops the clients it inherited, so no pooled
+connection is shared with the parent, and with ``PROVIDER_PREWARM`` each
+process builds its clients and opens their connections up front.
+"""
+import contextvars
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+settings = None
+# Set by the router while it races a generation: the list to add its upstream ``close`` to.
+upstream_closers = contextvars.ContextVar('upstream_closers', default=None)
+
+CHAT_MODEL = 'gemini-pro'
+CLIENTS = {
+    'openai_client': 'openai',
+    'async_openai_client': 'openai',
+    'gemini_client': 'gemini',
+}
+
+_models = {}
+_models_lock = threading.Lock()
+_clients_lock = threading.RLock()
+
+PROVIDER_LABELS = {
+    'openai': 'OpenAI',
+    'gemini': 'Gemini',
+}
+
+MODELS = {
+    'openai': ('gpt-4o', 'gpt-4-turbo', 'gpt-3.5-turbo'),
+    'gemini': ('gemini-pro',),
+}
+
+GENERATION_PARAMS = ('temperature', 'top_p', 'max_tokens', 'seed')
+
+
+def init_app(app):
+    global settings
+    settings = {
+        'openai_api_key': os.environ.get("OPENAI_API_KEY"),
+        'gemini_api_key': os.environ.get("GEMINI_API_KEY"),
+        'timeout': app.config['PROVIDER_TIMEOUT'],
+        'connect_timeout': app.config['PROVIDER_CONNECT_TIMEOUT'],
+        'max_connections': app.config['PROVIDER_MAX_CONNECTIONS'],
+        'max_keepalive': app.config['PROVIDER_MAX_KEEPALIVE'],
+        'keepalive_expiry': app.config['PROVIDER_KEEPALIVE_EXPIRY'],
+        'max_retries': app.config['PROVIDER_MAX_RETRIES'],
+        'prewarm': app.config['PROVIDER_PREWARM'],
+    }
+    # A preloading gunicorn master forks its workers, which pre-warm for themselves.
+    if settings['prewarm'] and not any(name in globals() for name in CLIENTS) and not _forking_master():
+        start_prewarm()
+    app.config['NANO_BANANA_AVAILABLE'] = bool(settings['gemini_api_key'])
+
+
+def _forking_master():
+    return os.environ.get('GUNICORN_MASTER_PID') == str(os.getpid())
+
+
+def __getattr__(name):
+    if name == 'genai':
+        return _import_genai()
+    if name in CLIENTS:
+        return client(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _import_genai():
+    import google.generativeai as genai
+    globals()['genai'] = genai
+    return genai
+
+
+def import_sdks():
+    """Import the SDKs of the configured providers now, e.g. in a master about to fork its workers."""
+    if settings and settings['openai_api_key']:
+        import openai  # noqa: F401
+    if settings and settings['gemini_api_key']:
+        _import_genai()
+
+
+def client(name):
+    """Return the client called ``name`` in ``CLIENTS``, building its provider's clients on first use.
+
+    None means the provider has no API key.
+    """
+    try:
+        return globals()[name]
+    except KeyError:
+        pass
+    with _clients_lock:
+        if name not in globals():
+            build_clients(CLIENTS[name])
+        return globals()[name]
+
+
+def build_clients(*providers):
+    """Create this process's clients for ``providers`` (default: all) from ``settings``."""
+    providers = providers or set(CLIENTS.values())
+    if 'openai' in providers:
+        _build_openai()
+    if 'gemini' in providers:
+        _build_gemini()
+
+
+def _build_openai():
+    global openai_client, async_openai_client
+    if not (settings and settings['openai_api_key']):
+        openai_client = async_openai_client = None
+        return
+
+    import httpx
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI, Timeout
+
+    timeout = Timeout(settings['timeout'], connect=settings['connect_timeout'])
+    limits = httpx.Limits(
+        max_connections=settings['max_connections'],
+        max_keepalive_connections=settings['max_keepalive'],
+        keepalive_expiry=settings['keepalive_expiry']
+    )
+    openai_client = OpenAI(
+        api_key=settings['openai_api_key'],
+        timeout=timeout,
+        max_retries=settings['max_retries'],
+        http_client=DefaultHttpxClient(limits=limits, timeout=timeout)
+    )
+    async_openai_client = AsyncOpenAI(
+        api_key=settings['openai_api_key'],
+        timeout=timeout,
+        max_retries=settings['max_retries'],
+        http_client=DefaultAsyncHttpxClient(limits=limits, timeout=timeout)
+    )
+
+
+def _build_gemini():
+    global gemini_client
+    with _models_lock:
+        _models.clear()
+    if not (settings and settings['gemini_api_key']):
+        gemini_client = None
+        return
+    # configure() also drops Gemini's cached gRPC clients.
+    _import_genai().configure(api_key=settings['gemini_api_key'])
+    gemini_client = model(CHAT_MODEL)
+
+
+def model(name):
+    """Return the shared Gemini ``GenerativeModel`` handle for ``name``."""
+    handle = _models.get(name)
+    if handle is None:
+        with _models_lock:
+            handle = _models.get(name)
+            if handle is None:
+                handle = _models[name] = _import_genai().GenerativeModel(name)
+    return handle
+
+
+def prewarm():
+    """Build the clients and open the TLS connections to each configured provider ahead of the first request."""
+    openai = client('openai_client')
+    if openai is not None:
+        try:
+            openai.with_options(max_retries=0).models.list()
+        except Exception as e:
+            logger.warning("OpenAI pre-warm failed: %s", e)
+    if client('gemini_client') is not None:
+        try:
+            next(iter(_import_genai().list_models(page_size=1)), None)
+        except Exception as e:
+            logger.warning("Gemini pre-warm failed: %s", e)
+
+
+async def aprewarm():
+    """Pre-warm the async OpenAI client on the running event loop."""
+    async_openai = client('async_openai_client')
+    if async_openai is not None:
+        try:
+            await async_openai.with_options(max_retries=0).models.list()
+        except Exception as e:
+            logger.warning("Async OpenAI pre-warm failed: %s", e)
+
+
+def start_prewarm():
+    threading.Thread(target=prewarm, name='provider-prewarm', daemon=True).start()
+
+
+def drop_clients():
+    """Forget this process's clients so the next use builds new ones."""
+    with _clients_lock:
+        for name in CLIENTS:
+            globals().pop(name, None)
+        with _models_lock:
+            _models.clear()
+
+
+def _after_fork():
+    # Pooled sockets and gRPC channels must not be shared with the parent, and a
+    # lock held by another of its threads at the fork would never be released.
+    global _clients_lock, _models_lock
+    _clients_lock = threading.RLock()
+    _models_lock = threading.Lock()
+    drop_clients()
+    if settings is not None and settings['prewarm']:
+        start_prewarm()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def provider_for(model):
+    """Return the provider name serving ``model`` or None if it is unknown."""
+    if model.startswith('gpt'):
+        return 'openai'
+    if model == 'gemini-pro':
+        return 'gemini'
+    return None
+
+
+def generation_params(data):
+    """Pick the supported generation parameters out of a request body."""
+    return {name: data[name] for name in GENERATION_PARAMS if data.get(name) is not None}
+
+
+def configured(provider, asynchronous=False):
+    """Whether ``provider`` can serve requests, without building its client."""
+    if provider == 'openai':
+        name = 'async_openai_client' if asynchronous else 'openai_client'
+    elif provider == 'gemini':
+        name = 'gemini_client'
+    else:
+        return False
+    if name in globals():
+        return globals()[name] is not None
+    return bool(settings and settings[f'{provider}_api_key'])
+
+
+def usage_dict(usage):
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens
+    }
+
+
+def gemini_config(params):
+    config = {}
+    if 'temperature' in params:
+        config['temperature'] = params['temperature']
+    if 'top_p' in params:
+        config['top_p'] = params['top_p']
+    if 'max_tokens' in params:
+        config['max_output_tokens'] = params['max_tokens']
+    options = {'request_options': {'timeout': settings['timeout']}} if settings else {}
+    return {'generation_config': config, **options} if config else options
+
+
+def complete(provider, model, conversation, params):
+    if provider == 'openai':
+        response = client('openai_client').chat.completions.create(
+            model=model,
+            messages=conversation,
+            **params
+        )
+        return response.choices[0].message.content, usage_dict(response.usage) if response.usage else None
+
+    response = client('gemini_client').generate_content(conversation, **gemini_config(params))
+    return response.text, None
+
+
+async def acomplete(provider, model, conversation, params):
+    if provider == 'openai':
+        response = await client('async_openai_client').chat.completions.create(
+            model=model,
+            messages=conversation,
+            **params
+        )
+        return response.choices[0].message.content, usage_dict(response.usage) if response.usage else None
+
+    response = await client('gemini_client').generate_content_async(conversation, **gemini_config(params))
+    return response.text, None
+
+
+def closable(response):
+    """Let a hedged race close ``response``, from another thread, once this generation has lost."""
+    closers = upstream_closers.get()
+    if closers is not None:
+        closers.append(response.close)
+    return response
+
+
+def stream(provider, model, conversation, params):
+    if provider == 'openai':
+        chunks = closable(client('openai_client').chat.completions.create(
+            model=model,
+            messages=conversation,
+            stream=True,
+            stream_options={"include_usage": True},
+            **params
+        ))
+        usage = None
+        for chunk in chunks:
+            content, chunk_usage = _openai_chunk(chunk)
+            if content is not None:
+                yield {'content': content}
+            usage = chunk_usage or usage
+        if usage:
+            yield {'usage': usage}
+        return
+
+    for chunk in client('gemini_client').generate_content(conversation, stream=True, **gemini_config(params)):
+        yield {'content': chunk.text}
+
+
+async def astream(provider, model, conversation, params):
+    if provider == 'openai':
+        chunks = await client('async_openai_client').chat.completions.create(
+            model=model,
+            messages=conversation,
+            stream=True,
+            stream_options={"include_usage": True},
+            **params
+        )
+        usage = None
+        async for chunk in chunks:
+            content, chunk_usage = _openai_chunk(chunk)
+            if content is not None:
+                yield {'content': content}
+            usage = chunk_usage or usage
+        if usage:
+            yield {'usage': usage}
+        return
+
+    chunks = await client('gemini_client').generate_content_async(conversation, stream=True, **gemini_config(params))
+    async for chunk in chunks:
+        yield {'content': chunk.text}
+
+
+def _openai_chunk(chunk):
+    content = None
+    if chunk.choices and len(chunk.choices) > 0:
+        content = chunk.choices[0].delta.content
+    usage = None
+    if hasattr(chunk, 'usage') and chunk.usage is not None:
+        usage = usage_dict(chunk.usage)
+    return content, usage
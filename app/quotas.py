@@ -0,0 +1,140 @@
+"""Per-user and per-model limits on chat generations.
+
+Each generation holds a lease on its user and its model while it runs
+(``QUOTA_USER_CONCURRENCY``, ``QUOTA_MODEL_CONCURRENCY``) and spends tokens
+from a per-minute bucket for each (``QUOTA_USER_TPM``, ``QUOTA_MODEL_TPM``).
+The prompt's estimated tokens are taken up front; the rest of the request's
+usage is charged when it finishes, so a long reply leaves the bucket in debt
+and delays the next request instead of being cut off. ``QUOTA_MODELS``
+overrides the model limits per model, and a limit of 0 turns it off.
+
+The state lives in a SQLite file shared by the workers on the host
+(``QUOTA_PATH``). A request over a limit fails at once with ``QuotaExceeded``.
+"""
+from flask import current_app, has_app_context, jsonify
+
+from . import metrics
+from .limits import Leases, TokenBuckets, retry_after
+
+TPM_PERIOD = 60
+
+metrics.describe('quota_rejections_total', 'Chat requests refused by a quota, by scope (user, model) and limit.')
+metrics.describe('quota_generations_in_flight', 'Generations holding a model lease, across the workers on the host.',
+                 merge='local')
+metrics.describe('quota_users_in_flight', 'Users with a generation running, across the workers on the host.',
+                 merge='local')
+metrics.describe('quota_tokens_available', 'Tokens left in a model\'s per-minute bucket.', merge='local')
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, scope, limit, wait):
+        super().__init__(f'Too many {"concurrent requests" if limit == "concurrency" else "tokens per minute"} '
+                         f'for this {scope}. Try again later.')
+        self.scope = scope
+        self.limit = limit
+        self.wait = wait
+
+
+class Admission:
+    """A generation let in by ``Quotas.admit``; ``settle`` once it is over."""
+
+    def __init__(self, quotas, leases, reserved):
+        self.quotas = quotas
+        self.leases = leases
+        self.reserved = reserved
+        self._settled = False
+
+    def settle(self, tokens=None):
+        """Charge the tokens the generation used beyond its reservation and release its leases."""
+        if self._settled:
+            return
+        self._settled = True
+        try:
+            if tokens is not None:
+                for key, burst, reserved in self.reserved:
+                    self.quotas.buckets.charge(key, burst, TPM_PERIOD, tokens - reserved)
+        finally:
+            if self.leases:
+                self.quotas.leases.release(self.leases)
+
+
+class Quotas:
+    def __init__(self, config):
+        self.leases = Leases(config['QUOTA_PATH'])
+        self.buckets = TokenBuckets(config['QUOTA_PATH'], table='token_buckets')
+        self.user_limits = (config['QUOTA_USER_CONCURRENCY'], config['QUOTA_USER_TPM'])
+        self.model_limits = (config['QUOTA_MODEL_CONCURRENCY'], config['QUOTA_MODEL_TPM'])
+        self.models = config['QUOTA_MODELS']
+        self.lease_ttl = config['QUOTA_LEASE_TTL']
+        self._seen = set()
+
+    def limits(self, model):
+        """Return ``(concurrency, tokens per minute)`` for ``model``."""
+        override = self.models.get(model, {})
+        return override.get('concurrency', self.model_limits[0]), override.get('tpm', self.model_limits[1])
+
+    def admit(self, user_id, model, prompt_tokens):
+        """Let a generation of ``model`` for ``user_id`` in, or raise ``QuotaExceeded``."""
+        self._seen.add(model)
+        scopes = [('user', f'user:{user_id}', *self.user_limits), ('model', f'model:{model}', *self.limits(model))]
+        concurrency = [(key, limit) for _, key, limit, _ in scopes if limit]
+        leases = []
+        if concurrency:
+            leases, full = self.leases.acquire(concurrency, self.lease_ttl)
+            if leases is None:
+                scope = full.split(':', 1)[0]
+                metrics.inc('quota_rejections_total', scope=scope, limit='concurrency')
+                raise QuotaExceeded(scope, 'concurrency', 1)
+
+        reserved = []
+        try:
+            for scope, key, _, burst in scopes:
+                if not burst:
+                    continue
+                cost = min(prompt_tokens, burst)
+                wait = self.buckets.take(key, burst, TPM_PERIOD, cost)
+                if wait:
+                    metrics.inc('quota_rejections_total', scope=scope, limit='tpm')
+                    raise QuotaExceeded(scope, 'tpm', wait)
+                reserved.append((key, burst, cost))
+        except BaseException:
+            Admission(self, leases, reserved).settle(0)
+            raise
+        return Admission(self, leases, reserved)
+
+    def publish(self):
+        counts = self.leases.counts()
+        users = sum(1 for key in counts if key.startswith('user:'))
+        metrics.gauge('quota_users_in_flight', users)
+        for key in counts:
+            if key.startswith('model:'):
+                self._seen.add(key.split(':', 1)[1])
+        for model in self._seen:
+            metrics.gauge('quota_generations_in_flight', counts.get(f'model:{model}', 0), model=model)
+            burst = self.limits(model)[1]
+            if burst:
+                metrics.gauge('quota_tokens_available', round(self.buckets.available(f'model:{model}', burst,
+                                                                                      TPM_PERIOD)), model=model)
+
+
+def quotas():
+    """Return this process's quota limiter, built from the app config on first use."""
+    app = current_app._get_current_object()
+    limiter = app.extensions.get('quotas')
+    if limiter is None:
+        limiter = app.extensions['quotas'] = Quotas(app.config)
+    return limiter
+
+
+def admit(user_id, route, prompt_tokens):
+    return quotas().admit(user_id, route.models[0], prompt_tokens)
+
+
+def rejection(error):
+    return jsonify({"error": str(error)}), 429, {'Retry-After': retry_after(error.wait)}
+
+
+@metrics.collector
+def _publish_quotas():
+    if has_app_context() and 'quotas' in current_app.extensions:
+        current_app.extensions['quotas'].publish()
@@ -0,0 +1,398 @@
+"""Pick the model that serves a chat request and race providers when one stalls.
+
+Every generation records its time to first token, or its error, in a rolling
+per-model window. A request for a concrete model goes to that model. A
+request for an alias (``fast``, ``cheap``) is served by its candidate models:
+``fast`` ranks them by median time to first token and ``cheap`` keeps its
+preference order. Both move models whose recent error rate is too high to the
+back. If an alias's model fails before its first token, the next candidate
+takes over. With ``ROUTER_HEDGE_AFTER`` set, a streamed generation starts a
+second candidate (preferably on another provider) when the first has
+produced nothing after that many seconds. The first one to produce content
+wins and the other is cancelled: an async loser's task is cancelled, which
+closes its connection, and a sync loser's OpenAI stream is closed from the
+routing thread. A sync Gemini stream has no handle to close, so it stops at
+its next chunk, or at the provider timeout if it has stalled. Completions
+that are not streamed are never hedged, since a blocking call cannot be
+stopped once it is sent and the loser would be billed in full.
+"""
+import asyncio
+import contextvars
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from typing import NamedTuple, Optional, Tuple
+
+from . import metrics, providers
+from .providers import provider_for
+
+ALIASES = {
+    'fast': ('gpt-4o', 'gemini-pro', 'gpt-3.5-turbo'),
+    'cheap': ('gpt-3.5-turbo', 'gemini-pro', 'gpt-4o'),
+}
+WINDOW = 200
+MIN_SAMPLES = 5
+MAX_ERROR_RATE = 0.5
+
+metrics.describe('router_fallbacks_total', 'Alias requests moved to the next model after an error.')
+metrics.describe('router_hedges_total', 'Hedged second requests started, by model.')
+metrics.histogram('provider_request_duration_seconds', 'Upstream generation time, by model and outcome.')
+metrics.histogram('provider_tokens_per_second', 'Completion tokens per second after the first token, by model.',
+                  buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 400))
+
+
+class ModelStats:
+    """Rolling window of ``(seconds_to_first_token, ok)`` samples per model."""
+
+    def __init__(self, window=WINDOW):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, model, latency=None, ok=True):
+        with self._lock:
+            self._samples[model].append((latency, ok))
+
+    def snapshot(self, model):
+        with self._lock:
+            samples = list(self._samples.get(model, ()))
+        latencies = sorted(latency for latency, ok in samples if ok and latency is not None)
+        errors = sum(1 for _, ok in samples if not ok)
+        return {
+            'p50': _percentile(latencies, 0.5),
+            'p99': _percentile(latencies, 0.99),
+            'error_rate': errors / len(samples) if samples else 0.0,
+            'samples': len(samples),
+        }
+
+    def healthy(self, model):
+        snapshot = self.snapshot(model)
+        return snapshot['samples'] < MIN_SAMPLES or snapshot['error_rate'] < MAX_ERROR_RATE
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(q * len(values)))], 4)
+
+
+stats = ModelStats()
+
+
+class Route(NamedTuple):
+    requested: str
+    models: Tuple[str, ...]
+    alias: bool
+    error: Optional[str] = None
+
+    @property
+    def provider(self):
+        """Provider whose message format the request's conversation is kept in."""
+        return 'openai' if self.alias else provider_for(self.models[0])
+
+
+def resolve(model, asynchronous=False):
+    """Return the ``Route`` for a requested model or alias, or None if it is unknown.
+
+    ``route.error`` is set when no candidate's provider is configured.
+    """
+    if model in ALIASES:
+        candidates = [name for name in ALIASES[model] if providers.configured(provider_for(name), asynchronous)]
+        ranked = rank(model, candidates)
+        return Route(model, tuple(ranked), True, None if ranked else f"No provider configured for '{model}'")
+    provider = provider_for(model)
+    if provider is None:
+        return None
+    if not providers.configured(provider, asynchronous):
+        return Route(model, (), False, f"{providers.PROVIDER_LABELS[provider]} client not configured")
+    return Route(model, (model,), False)
+
+
+def catalogue(asynchronous=False):
+    """Return the ``/models`` listing: configured models, alias targets and live stats."""
+    listing = {}
+    for provider, models in providers.MODELS.items():
+        if providers.configured(provider, asynchronous):
+            listing['google' if provider == 'gemini' else provider] = list(models)
+    aliases = {}
+    for alias in ALIASES:
+        route = resolve(alias, asynchronous)
+        aliases[alias] = route.models[0] if route.models else None
+    names = [name for models in providers.MODELS.values() for name in models]
+    return {
+        "models": listing,
+        "default": "gpt-4o",
+        "aliases": aliases,
+        "stats": {name: stats.snapshot(name) for name in names}
+    }
+
+
+def rank(alias, models):
+    if alias == 'fast':
+        def latency(name):
+            p50 = stats.snapshot(name)['p50']
+            # Models without samples go first so they get measured.
+            return 0.0 if p50 is None else p50
+        models = sorted(models, key=latency)
+    return sorted(models, key=lambda name: not stats.healthy(name))
+
+
+def timed(model, events):
+    """Yield ``events`` while recording the model's time to first token or error."""
+    started = time.monotonic()
+    first = None
+    usage = None
+    try:
+        for event in events:
+            if first is None and 'content' in event:
+                first = time.monotonic()
+                stats.record(model, first - started)
+            usage = event.get('usage', usage)
+            yield event
+    except Exception:
+        stats.record(model, ok=False)
+        observe_generation(model, started, first, usage, 'error')
+        raise
+    if first is None:
+        stats.record(model, time.monotonic() - started)
+    observe_generation(model, started, first, usage, 'ok')
+
+
+async def atimed(model, events):
+    started = time.monotonic()
+    first = None
+    usage = None
+    try:
+        async for event in events:
+            if first is None and 'content' in event:
+                first = time.monotonic()
+                stats.record(model, first - started)
+            usage = event.get('usage', usage)
+            yield event
+    except Exception:
+        stats.record(model, ok=False)
+        observe_generation(model, started, first, usage, 'error')
+        raise
+    if first is None:
+        stats.record(model, time.monotonic() - started)
+    observe_generation(model, started, first, usage, 'ok')
+
+
+def observe_generation(model, started, first, usage, outcome):
+    now = time.monotonic()
+    metrics.observe('provider_request_duration_seconds', now - started, model=model, outcome=outcome)
+    generating = now - (first or started)
+    if usage and usage.get('completion_tokens') and generating > 0:
+        metrics.observe('provider_tokens_per_second', usage['completion_tokens'] / generating, model=model)
+
+
+def hedge_candidate(route, started):
+    """Return the next model to start, preferring a provider not yet racing."""
+    remaining = [name for name in route.models if name not in started]
+    racing = {provider_for(name) for name in started}
+    for name in remaining:
+        if provider_for(name) not in racing:
+            return name
+    return remaining[0] if remaining else None
+
+
+def route_events(route, produce, hedge_after=None):
+    """Yield the events of ``produce(model)`` for the model that serves ``route``.
+
+    Alias routes announce the serving model with a ``{'model': ...}`` event.
+    """
+    if hedge_after and len(route.models) > 1:
+        yield from _hedged(route, produce, hedge_after)
+        return
+    for index, model in enumerate(route.models):
+        started = False
+        try:
+            for event in timed(model, produce(model)):
+                if not started and route.alias:
+                    yield {'model': model}
+                started = True
+                yield event
+            return
+        except Exception:
+            if started or index == len(route.models) - 1:
+                raise
+            metrics.inc('router_fallbacks_total', model=model)
+
+
+async def aroute_events(route, produce, hedge_after=None):
+    if hedge_after and len(route.models) > 1:
+        async for event in _ahedged(route, produce, hedge_after):
+            yield event
+        return
+    for index, model in enumerate(route.models):
+        started = False
+        try:
+            async for event in atimed(model, produce(model)):
+                if not started and route.alias:
+                    yield {'model': model}
+                started = True
+                yield event
+            return
+        except Exception:
+            if started or index == len(route.models) - 1:
+                raise
+            metrics.inc('router_fallbacks_total', model=model)
+
+
+_END = object()
+
+
+class _Racer:
+    """Consume one model's events on a thread, posting them to a shared queue."""
+
+    def __init__(self, model, events, results):
+        self.model = model
+        self.events = events
+        self.results = results
+        self.cancelled = threading.Event()
+        self.closers = []
+        context = contextvars.copy_context()
+        self.thread = threading.Thread(target=context.run, args=(self.run,), daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        """Stop posting events and close the upstream response, unblocking a read in progress."""
+        self.cancelled.set()
+        for close in list(self.closers):
+            try:
+                close()
+            except Exception:
+                pass
+
+    def run(self):
+        providers.upstream_closers.set(self.closers)
+        try:
+            for event in self.events:
+                if self.cancelled.is_set():
+                    break
+                self.results.put((self, event))
+            else:
+                self.results.put((self, _END))
+        except Exception as e:
+            self.results.put((self, e))
+        finally:
+            self.events.close()
+
+
+def _hedged(route, produce, hedge_after):
+    results = queue.Queue()
+    racers = []
+
+    def start(model):
+        racers.append(_Racer(model, timed(model, produce(model)), results))
+
+    start(route.models[0])
+    deadline = time.monotonic() + hedge_after
+    failed = set()
+    try:
+        while True:
+            timeout = None
+            if len(racers) == 1 and len(failed) == 0:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                racer, item = results.get(timeout=timeout)
+            except queue.Empty:
+                model = hedge_candidate(route, [r.model for r in racers])
+                metrics.inc('router_hedges_total', model=model)
+                start(model)
+                continue
+            if isinstance(item, Exception):
+                failed.add(racer)
+                if len(failed) < len(racers):
+                    continue
+                model = hedge_candidate(route, [r.model for r in racers])
+                if model is None:
+                    raise item
+                metrics.inc('router_fallbacks_total', model=racer.model)
+                start(model)
+                continue
+            winner = racer
+            break
+
+        for racer in racers:
+            if racer is not winner:
+                racer.cancel()
+        if route.alias:
+            yield {'model': winner.model}
+        while item is not _END:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            racer, item = results.get()
+            while racer is not winner:
+                racer, item = results.get()
+    finally:
+        for racer in racers:
+            racer.cancel()
+
+
+async def _ahedged(route, produce, hedge_after):
+    results = asyncio.Queue()
+    racers = {}
+
+    async def run(model):
+        events = atimed(model, produce(model))
+        try:
+            async for event in events:
+                results.put_nowait((model, event))
+            results.put_nowait((model, _END))
+        except Exception as e:
+            results.put_nowait((model, e))
+        finally:
+            await events.aclose()
+
+    def start(model):
+        racers[model] = asyncio.ensure_future(run(model))
+
+    start(route.models[0])
+    deadline = time.monotonic() + hedge_after
+    failed = set()
+    try:
+        while True:
+            timeout = None
+            if len(racers) == 1 and not failed:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                model, item = await asyncio.wait_for(results.get(), timeout)
+            except asyncio.TimeoutError:
+                candidate = hedge_candidate(route, list(racers))
+                metrics.inc('router_hedges_total', model=candidate)
+                start(candidate)
+                continue
+            if isinstance(item, Exception):
+                failed.add(model)
+                if len(failed) < len(racers):
+                    continue
+                candidate = hedge_candidate(route, list(racers))
+                if candidate is None:
+                    raise item
+                metrics.inc('router_fallbacks_total', model=model)
+                start(candidate)
+                continue
+            winner = model
+            break
+
+        for model, task in racers.items():
+            if model != winner:
+                task.cancel()
+        if route.alias:
+            yield {'model': winner}
+        while item is not _END:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            model, item = await results.get()
+            while model != winner:
+                model, item = await results.get()
+    finally:
+        for task in racers.values():
+            task.cancel()
@@ -1,17 +1,65 @@
-from flask import request, jsonify, render_template, redirect, url_for, flash, session, Response, stream_with_context, current_app
+import time
+from itertools import chain
+from flask import request, jsonify, render_template, redirect, url_for, flash, session, Response, stream_with_context, current_app, send_file
 from flask_login import login_user, logout_user, login_required, current_user
-from . import db, openai_client, gemini_client, login_manager
-from .models import User, ChatHistory
-import json
-import base64
-import io
-import google.generativeai as genai
+from . import db, metrics, login_manager, providers, router
+from .models import User, Conversation
+from .chat import (SSE_HEADERS, body_limit, build_conversation, completion_key, conversation_history,
+                   conversation_messages, find_conversation, finished, fit_context, record_turn, recorded,
+                   run_completion, run_stream, sse, token_counts, with_context_usage)
+from .media import (STREAM_HEADERS, STT_LANGUAGE, STT_MODEL, UploadRejected, audio_response, audio_store,
+                    cached_transcript, image_mimetype, image_payload, image_response, image_store, inspect_audio,
+                    render_image, speech_segments, stream_speech, stt_upload, synthesize_speech, transcript_cache,
+                    tts_payload, upload_file, wants_audio)
+from .batch import NDJSON_HEADERS, parse_items, run_batch
+from .jobs import (DONE, FAILED, FINISHED, QueueFull, job_event, job_links, job_result, job_runner, job_status,
+                   parse_job, unavailable)
+from .auth import (HashingBusy, admin_or_token_required, admin_required, client_address, password_hasher,
+                   throttle_login)
+from .limits import retry_after
+from .monitoring import database_ok, render as render_metrics
+from .pagination import decode_offset, encode_offset, keyset_page, parse_limit
+from .profiling import profile_store
+from .quotas import QuotaExceeded, admit, rejection
+from .search import SearchUnavailable, search_conversations, snippet_html
+from .usage import record_usage, report_range, usage_by_user, usage_report
+from .users import forget_user, user_cache
+from werkzeug.exceptions import RequestEntityTooLarge
+
+def history_summary(row):
+    return {
+        "id": row.id,
+        "title": row.title,
+        "message_count": row.message_count,
+        "created_at": row.created_at.isoformat() if row.created_at else None
+    }
+
+def too_many_attempts(wait):
+    headers = {'Retry-After': retry_after(wait)}
+    if request.is_json:
+        return jsonify({"error": "Too many attempts. Try again later."}), 429, headers
+    flash(f'Too many attempts. Try again in {headers["Retry-After"]} seconds.', 'error')
+    return render_template(f'{request.endpoint}.html'), 429, headers
+
+def hashing_busy():
+    headers = {'Retry-After': '1'}
+    if request.is_json:
+        return jsonify({"error": "The server is busy. Try again shortly."}), 503, headers
+    flash('The server is busy. Try again shortly.', 'error')
+    return render_template(f'{request.endpoint}.html'), 503, headers
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache().load(int(user_id))
 
 def register_routes(app):
+    @app.before_request
+    def limit_request_body():
+        limit = body_limit(app.config, request.path)
+        request.max_content_length = limit
+        if request.content_length is not None and request.content_length > limit:
+            raise RequestEntityTooLarge()
+
     @app.route('/')
     def index():
         if current_user.is_authenticated:
@@ -34,11 +82,27 @@ def register_routes(app):
                 flash('Email/phone and password are required', 'error')
                 return redirect(url_for('login'))
 
+            wait = throttle_login(client_address(), email_or_phone)
+            if wait:
+                return too_many_attempts(wait)
+
             user = User.query.filter(
                 (User.email == email_or_phone) | (User.phone == email_or_phone)
             ).first()
 
-            if user and user.check_password(password):
+            try:
+                verified = user is not None and user.check_password(password)
+            except HashingBusy:
+                return hashing_busy()
+
+            if verified:
+                try:
+                    if password_hasher().needs_rehash(user.password_hash):
+                        # Hash parameters changed since this password was set; upgrade it while we have it.
+                        user.set_password(password)
+                        db.session.commit()
+                except HashingBusy:
+                    pass  # The rehash is opportunistic; the next login retries it.
                 login_user(user, remember=True)
                 session.permanent = True
 
@@ -104,8 +168,15 @@ def register_routes(app):
                 flash('Phone number already registered', 'error')
                 return redirect(url_for('signup'))
 
+            wait = throttle_login(client_address())
+            if wait:
+                return too_many_attempts(wait)
+
             user = User(name=name, email=email, phone=phone)
-            user.set_password(password)
+            try:
+                user.set_password(password)
+            except HashingBusy:
+                return hashing_busy()
 
             try:
                 db.session.add(user)
@@ -134,6 +205,7 @@ def register_routes(app):
     @app.route('/logout')
     @login_required
     def logout():
+        forget_user(current_user.id)
         logout_user()
         flash('You have been logged out successfully.', 'success')
         return redirect(url_for('login'))
@@ -170,29 +242,26 @@ def register_routes(app):
                 "GET /health": "Check API health status",
                 "GET /models": "List available models",
                 "POST /api/chat": "Create chat completion (authenticated)",
-                "POST /api/chat/stream": "Create streaming chat completion (authenticated)"
+                "POST /api/chat/stream": "Create streaming chat completion (authenticated)",
+                "GET /api/chat/history": "List conversations, paginated with view/limit/cursor (authenticated)",
+                "GET /api/chat/history/<id>": "Get one full conversation (authenticated)"
             },
             "documentation": "See README.md for usage examples"
         }), 200
 
     @app.route('/health')
     def health():
+        database = database_ok()
         return jsonify({
-            "status": "healthy",
+            "status": "healthy" if database else "unhealthy",
             "service": "AI Gateway API",
             "providers": ["OpenAI", "Google Gemini"],
-            "database": "Connected"
-        }), 200
+            "database": "Connected" if database else "Unavailable"
+        }), 200 if database else 503
 
     @app.route('/models')
     def get_models():
-        return jsonify({
-            "models": {
-                "openai": ["gpt-4o", "gpt-4-turbo", "gpt-3.5-turbo"],
-                "google": ["gemini-pro"]
-            },
-            "default": "gpt-4o"
-        }), 200
+        return jsonify(router.catalogue()), 200
 
     @app.route('/api/chat', methods=['POST'])
     @login_required
@@ -206,72 +275,76 @@ def register_routes(app):
             message = data['message']
             model = data.get('model', 'gpt-4o')
             messages = data.get('messages', [])
+            route = router.resolve(model)
 
-            if model.startswith('gpt'):
-                if not openai_client:
-                    return jsonify({"error": "OpenAI client not configured"}), 503
-
-                if messages:
-                    conversation = messages
-                else:
-                    conversation = []
-
-                conversation.append({"role": "user", "content": message})
+            if route is None:
+                return jsonify({"error": "Invalid model"}), 400
 
-                response = openai_client.chat.completions.create(
-                    model=model,
-                    messages=conversation
+            if route.error:
+                return jsonify({"error": route.error}), 503
+
+            conversation_id = data.get('conversation_id')
+            # With only a conversation_id the server supplies the history and returns just the new turn.
+            server_held = conversation_id is not None and 'messages' not in data
+            if conversation_id is not None:
+                history = conversation_history(current_user.id, conversation_id)
+                if history is None:
+                    return jsonify({"error": "Conversation not found"}), 404
+                if server_held:
+                    messages = history
+
+            conversation = build_conversation(route.provider, messages, message)
+            params = providers.generation_params(data)
+            prompt, context_counts = fit_context(route, messages, message, params)
+            cache_key = completion_key(data, model, build_conversation(route.provider, prompt, message), params)
+
+            prompt_tokens = context_counts['prompt_tokens_after_trim']
+            admission = admit(current_user.id, route, prompt_tokens)
+            started = time.monotonic()
+            tokens = None
+            try:
+                assistant_message, usage, served_model, cached = run_completion(
+                    route, prompt, message, params, cache_key
                 )
+                counts = token_counts(route, usage, prompt_tokens, assistant_message)
+                tokens = 0 if cached else counts['total_tokens']
+            finally:
+                admission.settle(tokens)
+            record_usage(current_user.id, served_model or route.models[0], 'chat', counts, time.monotonic() - started,
+                         cached)
+
+            conversation.append({"role": "assistant", "content": assistant_message})
+            conversation_id = record_turn(current_user.id, conversation_id, conversation[:-2], conversation[-2:])
+
+            result = {
+                "response": assistant_message,
+                "model": served_model or model,
+                "conversation_id": conversation_id,
+                "cached": cached
+            }
+            if not server_held:
+                result["conversation"] = conversation
 
-                assistant_message = response.choices[0].message.content
-                conversation.append({"role": "assistant", "content": assistant_message})
-
-                chat_history = ChatHistory(user_id=current_user.id, conversation=conversation)
-                db.session.add(chat_history)
-                db.session.commit()
-
-                result = {
-                    "response": assistant_message,
-                    "model": model,
-                    "conversation": conversation
-                }
-
-                if response.usage:
-                    result["usage"] = {
-                        "prompt_tokens": response.usage.prompt_tokens,
-                        "completion_tokens": response.usage.completion_tokens,
-                        "total_tokens": response.usage.total_tokens
-                    }
-
-                return jsonify(result), 200
-
-            elif model == 'gemini-pro':
-                if not gemini_client:
-                    return jsonify({"error": "Gemini client not configured"}), 503
-
-                if messages:
-                    conversation = messages
-                else:
-                    conversation = []
-
-                conversation.append({"role": "user", "parts": [message]})
-
-                response = gemini_client.generate_content(conversation)
-
-                conversation.append({"role": "assistant", "content": response.text})
-
-                chat_history = ChatHistory(user_id=current_user.id, conversation=conversation)
-                db.session.add(chat_history)
-                db.session.commit()
-
-                return jsonify({"response": response.text, "model": model, "conversation": conversation}), 200
+            result["usage"] = {**(usage or {}), **context_counts}
 
-            else:
-                return jsonify({"error": "Invalid model"}), 400
+            return jsonify(result), 200
 
+        except QuotaExceeded as e:
+            return rejection(e)
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
+    @app.route('/api/chat/batch', methods=['POST'])
+    @login_required
+    def chat_batch():
+        """Answer a list of independent prompts concurrently, as NDJSON lines in completion order."""
+        try:
+            items = parse_items(request.get_json(silent=True), app.config['BATCH_MAX_ITEMS'])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        lines = run_batch(current_app._get_current_object(), current_user.id, items)
+        return Response(lines, mimetype='application/x-ndjson', headers=NDJSON_HEADERS)
+
     @app.route('/image/generate', methods=['POST'])
     @login_required
     def generate_image():
@@ -286,46 +359,10 @@ def register_routes(app):
             if not prompt:
                 return jsonify({"error": "Prompt is required"}), 400
 
-            # Create proper Content structure
-            content = {
-                'parts': [
-                    {'text': prompt}
-                ]
-            }
-
-            # Generate image using Nano Banana
-            model = genai.GenerativeModel('gemini-pro-vision')
-            response = model.generate_content(
-                contents=content,
-                generation_config=genai.types.GenerationConfig(
-                    candidate_count=1,
-                    stop_sequences=['x'],
-                    max_output_tokens=2048,
-                    temperature=1.0,
-                    top_p=0.8,
-                    top_k=40
-                )
-            )
-
-            # Extract image data from response with proper error handling
-            if response and hasattr(response, 'candidates'):
-                for candidate in response.candidates:
-                    if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
-                        for part in candidate.content.parts:
-                            if hasattr(part, 'inline_data') and part.inline_data:
-                                image_bytes = part.inline_data.data
-                                mime_type = part.inline_data.mime_type
-
-                                # Encode bytes to base64 string for JSON serialization
-                                image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-
-                                return jsonify({
-                                    "success": True,
-                                    "image": image_base64,
-                                    "mime_type": mime_type,
-                                    "prompt": prompt,
-                                    "model": "gemini-2.5-flash-image"
-                                }), 200
+            image = render_image(prompt, use_cache=data.get('cache') is not False)
+            if image:
+                key, mime_type, cached = image
+                return jsonify(image_payload(key, mime_type, prompt, cached)), 200
 
             # No image in response - likely safety block or model issue
             return jsonify({"error": "No image generated. The model may have blocked the request for safety reasons."}), 502
@@ -333,12 +370,26 @@ def register_routes(app):
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
+    @app.route('/image/<key>', methods=['GET'])
+    @login_required
+    def image_file(key):
+        """Serve a stored image by its content hash"""
+        try:
+            path = image_store().get(key)
+        except ValueError:
+            path = None
+        mime_type = image_mimetype(path) if path else None
+        if mime_type is None:
+            return jsonify({"error": "Image not found"}), 404
+        return image_response(path, key, mime_type)
+
     @app.route('/voice/tts', methods=['POST'])
     @login_required
     def text_to_speech():
         """Convert text to speech using OpenAI TTS"""
+        started = time.monotonic()
         try:
-            if not openai_client:
+            if not providers.openai_client:
                 return jsonify({"error": "Voice services are not configured. Missing OPENAI_API_KEY."}), 503
 
             data = request.get_json()
@@ -350,71 +401,250 @@ def register_routes(app):
             voice = data.get('voice', 'alloy')
             speed = data.get('speed', 1.0)
 
-            # Generate speech
-            response = openai_client.audio.speech.create(
-                model="tts-1",
-                voice=voice,
-                input=text,
-                speed=speed
-            )
+            key, path, audio_bytes, cached = synthesize_speech(text, voice, speed)
+            metrics.observe('tts_first_audio_seconds', time.monotonic() - started, mode='clip')
 
-            # Convert to base64 for JSON response
-            audio_bytes = response.content
-            audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
+            if wants_audio():
+                return audio_response(path, key)
 
-            return jsonify({
-                "audio": audio_base64,
-                "format": "mp3",
-                "voice": voice,
-                "speed": speed
-            }), 200
+            if audio_bytes is None:
+                with open(path, 'rb') as f:
+                    audio_bytes = f.read()
+            payload = tts_payload(audio_bytes, voice, speed)
+            payload['url'] = url_for('tts_audio', key=key)
+            payload['cached'] = cached
+            return jsonify(payload), 200
 
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
-    @app.route('/voice/stt', methods=['POST'])
+    @app.route('/voice/tts/stream', methods=['POST'])
     @login_required
-    def speech_to_text():
-        """Convert speech to text using OpenAI Whisper"""
+    def text_to_speech_stream():
+        """Stream speech as ``audio/mpeg``, synthesizing the text a few sentences at a time"""
+        started = time.monotonic()
         try:
-            if not openai_client:
+            if not providers.openai_client:
                 return jsonify({"error": "Voice services are not configured. Missing OPENAI_API_KEY."}), 503
 
-            if 'audio' not in request.files:
-                return jsonify({"error": "No audio file provided"}), 400
+            data = request.get_json()
+
+            if not data or 'text' not in data:
+                return jsonify({"error": "Missing 'text' field"}), 400
 
-            audio_file = request.files['audio']
+            config = app.config
+            segments = speech_segments(data['text'], config['TTS_STREAM_SEGMENT_CHARS'],
+                                       config['TTS_STREAM_FIRST_CHARS'])
+            if not segments:
+                return jsonify({"error": "Text is empty"}), 400
 
-            if audio_file.filename == '':
-                return jsonify({"error": "No selected file"}), 400
+            chunks = stream_speech(segments, data.get('voice', 'alloy'), data.get('speed', 1.0),
+                                   config['TTS_STREAM_WINDOW'])
+            # Synthesize the first segment before answering, so a failing provider still gets a JSON error.
+            first = next(chunks)
+            metrics.observe('tts_first_audio_seconds', time.monotonic() - started, mode='stream')
+            return Response(chain([first], chunks), mimetype='audio/mpeg',
+                            headers={**STREAM_HEADERS, 'X-TTS-Segments': str(len(segments))})
 
-            # Read audio data
-            audio_data = audio_file.read()
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
 
-            # Create file-like object for OpenAI API
-            audio_buffer = io.BytesIO(audio_data)
-            audio_buffer.name = "audio.webm"  # OpenAI supports webm, mp3, mp4, etc.
+    @app.route('/voice/tts/audio/<key>', methods=['GET'])
+    @login_required
+    def tts_audio(key):
+        """Serve a cached TTS clip as ``audio/mpeg`` with Range support"""
+        try:
+            path = audio_store().get(key)
+        except ValueError:
+            path = None
+        if path is None:
+            return jsonify({"error": "Audio not found"}), 404
+        return audio_response(path, key)
 
-            # Transcribe using Whisper
-            transcript = openai_client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_buffer,
-                language="en"  # Can be auto-detected by removing this parameter
+    @app.route('/voice/stt', methods=['POST'])
+    @login_required
+    def speech_to_text():
+        """Convert speech to text using OpenAI Whisper"""
+        try:
+            if not providers.openai_client:
+                return jsonify({"error": "Voice services are not configured. Missing OPENAI_API_KEY."}), 503
+
+            audio_file = stt_upload()
+            key = inspect_audio(audio_file)
+            cached = cached_transcript(key)
+            if cached is not None:
+                return jsonify({**cached, "cached": True}), 200
+
+            # Transcribe using Whisper, reading the spooled upload directly
+            transcript = providers.openai_client.audio.transcriptions.create(
+                model=STT_MODEL,
+                file=upload_file(audio_file),
+                language=STT_LANGUAGE  # Can be auto-detected by removing this parameter
             )
 
-            return jsonify({
+            result = {
                 "text": transcript.text,
-                "language": "en"
-            }), 200
+                "language": STT_LANGUAGE
+            }
+            transcript_cache().set(key, result)
+            return jsonify({**result, "cached": False}), 200
 
+        except UploadRejected as e:
+            return jsonify({"error": str(e)}), e.status
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
+    @app.route('/api/jobs', methods=['POST'])
+    @login_required
+    def submit_job():
+        """Queue an image or TTS generation and answer at once with where to follow it"""
+        try:
+            kind, payload, priority = parse_job(request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        error = unavailable(kind)
+        if error:
+            return jsonify({"error": error}), 503
+        try:
+            job_id = job_runner().submit(kind, current_user.id, payload, priority)
+        except QueueFull as e:
+            return jsonify({"error": str(e)}), 429, {'Retry-After': '5'}
+        links = job_links(job_id)
+        body = {"id": job_id, "kind": kind, "state": "queued", "priority": priority, **links}
+        return jsonify(body), 202, {'Location': links['status_url']}
+
+    @app.route('/api/jobs/<job_id>', methods=['GET'])
+    @login_required
+    def get_job(job_id):
+        job = job_runner().queue.get(job_id, current_user.id)
+        if job is None:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify({**job_status(job), **job_links(job_id)}), 200
+
+    @app.route('/api/jobs/<job_id>/result', methods=['GET'])
+    @login_required
+    def get_job_result(job_id):
+        """The finished job's result; 202 while it is pending and 502 once it has failed"""
+        job = job_runner().queue.get(job_id, current_user.id)
+        if job is None:
+            return jsonify({"error": "Job not found"}), 404
+        if job['state'] == DONE:
+            return jsonify(job_result(job)), 200
+        if job['state'] == FAILED:
+            return jsonify(job_status(job)), 502
+        return jsonify(job_status(job)), 202, {'Retry-After': '1'}
+
+    @app.route('/api/jobs/<job_id>/events', methods=['GET'])
+    @login_required
+    def job_events(job_id):
+        """The job's status as a single SSE event; the async gateway streams every change.
+
+        A sync worker must not be held by a follower, so an unfinished job's
+        event carries a ``retry`` hint and EventSource reconnects to poll.
+        """
+        job = job_runner().queue.get(job_id, current_user.id)
+        if job is None:
+            return jsonify({"error": "Job not found"}), 404
+        body = sse(job_event(job))
+        if job['state'] not in FINISHED:
+            body = f"retry: {int(app.config['JOBS_EVENTS_RETRY'] * 1000)}\n" + body
+        return Response(body, mimetype='text/event-stream', headers=SSE_HEADERS)
+
     @app.route('/api/chat/history', methods=['GET'])
     @login_required
     def get_chat_history():
-        history = ChatHistory.query.filter_by(user_id=current_user.id).all()
-        return jsonify([h.conversation for h in history])
+        """List the user's conversations, newest first.
+
+        ``view=summary`` returns id, title, message count and timestamp only;
+        ``view=full`` includes each conversation. Either view is paginated
+        with ``limit`` and the opaque ``cursor`` from ``next_cursor``. Without
+        any of these parameters the legacy unpaginated list is returned.
+        """
+        args = request.args
+        if not any(key in args for key in ('view', 'limit', 'cursor')):
+            conversations = (Conversation.query.filter_by(user_id=current_user.id)
+                             .order_by(Conversation.created_at, Conversation.id).all())
+            messages = conversation_messages([c.id for c in conversations])
+            return jsonify([messages[c.id] for c in conversations])
+
+        view = args.get('view', 'summary')
+        if view not in ('summary', 'full'):
+            return jsonify({"error": "view must be 'summary' or 'full'"}), 400
+
+        try:
+            limit = parse_limit(args.get('limit'))
+            query = Conversation.query.filter_by(user_id=current_user.id).with_entities(
+                Conversation.id, Conversation.title, Conversation.message_count, Conversation.created_at
+            )
+            rows, next_cursor = keyset_page(
+                query, Conversation.created_at, Conversation.id, args.get('cursor'), limit
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        items = [history_summary(row) for row in rows]
+        if view == 'full':
+            messages = conversation_messages([row.id for row in rows])
+            for item in items:
+                item['conversation'] = messages[item['id']]
+        return jsonify({"items": items, "next_cursor": next_cursor}), 200
+
+    @app.route('/api/chat/history/<int:conversation_id>', methods=['GET'])
+    @login_required
+    def get_chat_history_entry(conversation_id):
+        conversation = find_conversation(current_user.id, conversation_id)
+        if conversation is None:
+            return jsonify({"error": "Conversation not found"}), 404
+        result = history_summary(conversation)
+        result['conversation'] = conversation.to_messages()
+        return jsonify(result), 200
+
+    @app.route('/api/chat/search', methods=['GET'])
+    @login_required
+    def search_chat_history():
+        """Search the user's conversations for ``q``, best match first.
+
+        Each item is a conversation summary with its number of matching
+        messages and the best one's ``seq``, ``role`` and an HTML ``snippet``
+        with the matched words in ``<mark>``. Paginated with ``limit`` and
+        the opaque ``cursor`` from ``next_cursor``.
+        """
+        args = request.args
+        try:
+            limit = parse_limit(args.get('limit'))
+            offset = decode_offset(args.get('cursor'))
+            hits, more = search_conversations(current_user.id, args.get('q', ''), limit, offset)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except SearchUnavailable as e:
+            return jsonify({"error": str(e)}), 501
+
+        rows = {row.id: row for row in Conversation.query.filter(
+            Conversation.id.in_([hit[0] for hit in hits])
+        ).with_entities(Conversation.id, Conversation.title, Conversation.message_count, Conversation.created_at)}
+        items = []
+        for conversation_id, seq, role, matches, snippet in hits:
+            if conversation_id in rows:
+                item = history_summary(rows[conversation_id])
+                item.update(matches=matches, message={"seq": seq, "role": role, "snippet": snippet_html(snippet)})
+                items.append(item)
+        next_cursor = encode_offset(offset + limit) if more else None
+        return jsonify({"items": items, "next_cursor": next_cursor}), 200
+
+    @app.route('/api/usage', methods=['GET'])
+    @login_required
+    def get_usage():
+        """The user's token usage per ``hour`` or ``day`` bucket and model, from the rollups.
+
+        ``from`` and ``to`` are ISO timestamps (UTC, ``to`` exclusive); the
+        default is the last 24 hours or 30 days.
+        """
+        args = request.args
+        try:
+            start, end = report_range(args.get('period', 'day'), args.get('from'), args.get('to'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify(usage_report(current_user.id, args.get('period', 'day'), start, end)), 200
 
     @app.route('/api/chat/stream', methods=['POST'])
     @login_required
@@ -428,89 +658,112 @@ def register_routes(app):
             message = data['message']
             model = data.get('model', 'gpt-4o')
             messages = data.get('messages', [])
+            route = router.resolve(model)
 
-            if model.startswith('gpt'):
-                if not openai_client:
-                    return jsonify({"error": "OpenAI client not configured"}), 503
-
-                if messages:
-                    conversation = messages
-                else:
-                    conversation = []
-
-                conversation.append({"role": "user", "content": message})
-
-                def generate():
-                    try:
-                        stream = openai_client.chat.completions.create(
-                            model=model,
-                            messages=conversation,
-                            stream=True,
-                            stream_options={"include_usage": True}
-                        )
-
-                        usage_data = None
-                        for chunk in stream:
-                            if chunk.choices and len(chunk.choices) > 0:
-                                if chunk.choices[0].delta.content is not None:
-                                    content = chunk.choices[0].delta.content
-                                    yield f"data: {json.dumps({'content': content})}\n\n"
-
-                            if hasattr(chunk, 'usage') and chunk.usage is not None:
-                                usage_data = {
-                                    "prompt_tokens": chunk.usage.prompt_tokens,
-                                    "completion_tokens": chunk.usage.completion_tokens,
-                                    "total_tokens": chunk.usage.total_tokens
-                                }
-
-                        if usage_data:
-                            yield f"data: {json.dumps({'usage': usage_data})}\n\n"
-
-                        yield f"data: {json.dumps({'done': True})}\n\n"
-
-                    except Exception as e:
-                        yield f"data: {json.dumps({'error': str(e)})}\n\n"
-
-                return Response(
-                    stream_with_context(generate()),
-                    mimetype='text/event-stream',
-                    headers={
-                        'Cache-Control': 'no-cache',
-                        'X-Accel-Buffering': 'no'
-                    }
-                )
-
-            elif model == 'gemini-pro':
-                if not gemini_client:
-                    return jsonify({"error": "Gemini client not configured"}), 503
-
-                if messages:
-                    conversation = messages
-                else:
-                    conversation = []
-
-                conversation.append({"role": "user", "parts": [message]})
-
-                def generate():
-                    try:
-                        stream = gemini_client.generate_content(conversation, stream=True)
-                        for chunk in stream:
-                            yield f"data: {json.dumps({'content': chunk.text})}\n\n"
-                        yield f"data: {json.dumps({'done': True})}\n\n"
-                    except Exception as e:
-                        yield f"data: {json.dumps({'error': str(e)})}\n\n"
-
-                return Response(
-                    stream_with_context(generate()),
-                    mimetype='text/event-stream',
-                    headers={
-                        'Cache-Control': 'no-cache',
-                        'X-Accel-Buffering': 'no'
-                    }
-                )
-
-            else:
+            if route is None:
                 return jsonify({"error": "Invalid model"}), 400
 
+            if route.error:
+                return jsonify({"error": route.error}), 503
+
+            conversation_id = data.get('conversation_id')
+            if conversation_id is not None:
+                history = conversation_history(current_user.id, conversation_id)
+                if history is None:
+                    return jsonify({"error": "Conversation not found"}), 404
+                if 'messages' not in data:
+                    messages = history
+
+            conversation = build_conversation(route.provider, messages, message)
+            params = providers.generation_params(data)
+            prompt, context_counts = fit_context(route, messages, message, params)
+            cache_key = completion_key(data, model, build_conversation(route.provider, prompt, message), params)
+            user_id = current_user.id
+            prompt_tokens = context_counts['prompt_tokens_after_trim']
+            admission = admit(user_id, route, prompt_tokens)
+            started = time.monotonic()
+
+            def finish(text, usage, served_model, cached):
+                counts = token_counts(route, usage, prompt_tokens, text)
+                admission.settle(0 if cached else counts['total_tokens'])
+                record_usage(user_id, served_model or route.models[0], 'chat_stream', counts, time.monotonic() - started,
+                             cached)
+
+            def record(text):
+                turn = [conversation[-1], {"role": "assistant", "content": text}]
+                return record_turn(user_id, conversation_id, conversation[:-1], turn)
+
+            def generate():
+                try:
+                    events = finished(run_stream(route, prompt, message, params, cache_key), finish)
+                    for event in recorded(with_context_usage(events, context_counts), record):
+                        yield sse(event)
+                    yield sse({'done': True})
+                except Exception as e:
+                    yield sse({'error': str(e)})
+
+            response = Response(
+                stream_with_context(generate()),
+                mimetype='text/event-stream',
+                headers=SSE_HEADERS
+            )
+            # Releases the leases of a stream that never started.
+            response.call_on_close(admission.settle)
+            return response
+
+        except QuotaExceeded as e:
+            return rejection(e)
         except Exception as e:
             return jsonify({"error": str(e)}), 500
+
+    @app.route('/metrics')
+    @admin_or_token_required('METRICS_TOKEN')
+    def metrics_endpoint():
+        """Prometheus text format, for administrators or a scraper sending ``METRICS_TOKEN``."""
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/admin/usage', methods=['GET'])
+    @admin_required
+    def get_usage_by_user():
+        """Token usage per user and model over the range, most tokens first, up to ``limit`` rows.
+
+        Takes the same ``period``, ``from`` and ``to`` as ``/api/usage``.
+        """
+        args = request.args
+        try:
+            start, end = report_range(args.get('period', 'day'), args.get('from'), args.get('to'))
+            limit = parse_limit(args.get('limit'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify(usage_by_user(args.get('period', 'day'), start, end, limit)), 200
+
+    @app.route('/admin/profiles', methods=['GET'])
+    @admin_required
+    def list_profiles():
+        """The newest request profiles, up to ``limit``, without their SQL and function tables."""
+        try:
+            limit = parse_limit(request.args.get('limit'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"items": profile_store().index(limit)}), 200
+
+    @app.route('/admin/profiles/<profile_id>', methods=['GET'])
+    @admin_required
+    def get_profile(profile_id):
+        report = profile_store().load(profile_id)
+        if report is None:
+            return jsonify({"error": "Profile not found"}), 404
+        return jsonify(report), 200
+
+    @app.route('/admin/profiles/<profile_id>/stats', methods=['GET'])
+    @admin_required
+    def get_profile_stats(profile_id):
+        path = profile_store().stats_path(profile_id)
+        if path is None:
+            return jsonify({"error": "Profile not found"}), 404
+        return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                         download_name=f'{profile_id}.prof')
+
+    @app.errorhandler(RequestEntityTooLarge)
+    def request_too_large(e):
+        return jsonify({"error": "Request body is too large"}), 413
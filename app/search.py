@@ -0,0 +1,186 @@
+"""Full-text search over a user's chat messages.
+
+On SQLite the messages are indexed in an FTS5 table, ``message_search``,
+filled by triggers on ``messages``; on PostgreSQL ``messages`` carries a
+generated ``tsvector`` column with a GIN index. Either way the database
+keeps the index current, so a turn is searchable once the write-behind
+batch holding it commits, whichever worker wrote it. The index is created
+with the ``messages`` table; ``migrate`` adds and fills it for an existing
+database.
+
+A search returns conversations, best match first, each with its number of
+matching messages and a snippet of the best one. Other databases have no
+index and cannot search.
+"""
+import html
+import logging
+import re
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+
+from . import db
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+TEXT_SEARCH_CONFIG = 'english'
+SNIPPET_WORDS = 16
+# Rowids of indexed messages: the conversation id in the high bits, ``seq`` in the low ones.
+SEQ_BITS = 24
+MARK_START = '\x02'
+MARK_END = '\x03'
+TERM = re.compile(r'\w+', re.UNICODE)
+QUERY_PART = re.compile(r'"([^"]*)"|(\S+)')
+
+FTS5_TABLE = (
+    "CREATE VIRTUAL TABLE message_search USING fts5("
+    "content, owner, conversation_id UNINDEXED, seq UNINDEXED, role UNINDEXED, tokenize='porter unicode61')"
+)
+FTS5_ROW = (
+    "SELECT (m.conversation_id << {bits}) + m.seq, m.content, 'u' || c.user_id, m.conversation_id, m.seq, m.role "
+    "FROM {source} m JOIN conversations c ON c.id = m.conversation_id"
+)
+FTS5_TRIGGERS = (
+    "CREATE TRIGGER IF NOT EXISTS messages_search_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO message_search (rowid, content, owner, conversation_id, seq, role) "
+    + FTS5_ROW.format(bits=SEQ_BITS, source='(SELECT new.conversation_id AS conversation_id, new.seq AS seq, '
+                      'new.content AS content, new.role AS role)') + "; END",
+    "CREATE TRIGGER IF NOT EXISTS messages_search_delete AFTER DELETE ON messages BEGIN "
+    f"DELETE FROM message_search WHERE rowid = (old.conversation_id << {SEQ_BITS}) + old.seq; END",
+)
+
+
+class SearchUnavailable(Exception):
+    """The database has no full-text index to search."""
+
+
+def create_index(connection):
+    """Create the index for the connection's database if it is missing, indexing existing messages."""
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        connection.execute(text(
+            'ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS '
+            f"(to_tsvector('{TEXT_SEARCH_CONFIG}', content)) STORED"
+        ))
+        connection.execute(text('CREATE INDEX IF NOT EXISTS ix_messages_search ON messages USING GIN (search_vector)'))
+    elif dialect == 'sqlite':
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_search'"
+        )).first()
+        if exists is None:
+            try:
+                connection.execute(text(FTS5_TABLE))
+            except OperationalError:
+                logger.warning('SQLite was built without FTS5; chat search is unavailable')
+                return
+            connection.execute(text(
+                'INSERT INTO message_search (rowid, content, owner, conversation_id, seq, role) '
+                + FTS5_ROW.format(bits=SEQ_BITS, source='messages')
+            ))
+        for trigger in FTS5_TRIGGERS:
+            connection.execute(text(trigger))
+
+
+@event.listens_for(Message.__table__, 'after_create')
+def _create_with_messages(target, connection, **kw):
+    create_index(connection)
+
+
+@event.listens_for(Message.__table__, 'before_drop')
+def _drop_with_messages(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text('DROP TABLE IF EXISTS message_search'))
+
+
+def fts5_query(query, user_id):
+    """Return an FTS5 expression for ``query`` limited to ``user_id``'s messages.
+
+    Words must all match; ``"..."`` matches a phrase and a trailing ``*`` a prefix.
+    Anything else in the query is ignored, so it can never be a syntax error.
+    """
+    parts = []
+    for phrase, word in QUERY_PART.findall(query):
+        terms = TERM.findall(phrase or word)
+        if terms:
+            prefix = '*' if word.endswith('*') and len(terms) == 1 else ''
+            parts.append(f'content : "{" ".join(terms)}"{prefix}')
+    if not parts:
+        raise ValueError('The query has no words to search for')
+    return ' AND '.join([f'owner : "u{int(user_id)}"'] + parts)
+
+
+def search_conversations(user_id, query, limit, offset):
+    """Return ``(hits, more)`` for a page of ``user_id``'s conversations matching ``query``.
+
+    Each hit is ``(conversation_id, seq, role, matches, snippet)``, where
+    ``snippet`` marks the matched words with ``MARK_START`` and ``MARK_END``.
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        hits = _search_fts5(user_id, query, limit + 1, offset)
+    elif dialect == 'postgresql':
+        if not query.strip():
+            raise ValueError('The query has no words to search for')
+        hits = _search_tsvector(user_id, query, limit + 1, offset)
+    else:
+        raise SearchUnavailable(f'Search is not available on {dialect}')
+    return hits[:limit], len(hits) > limit
+
+
+def _search_fts5(user_id, query, limit, offset):
+    expression = fts5_query(query, user_id)
+    session = db.session
+    if session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'message_search'")).first() is None:
+        raise SearchUnavailable('Search is not available: SQLite was built without FTS5')
+    # bm25 and snippet cannot feed a window function, so rank and group the matches first
+    # and build snippets for the page's best messages only.
+    best = session.execute(text(
+        'WITH matches AS MATERIALIZED ('
+        '  SELECT rowid AS id, conversation_id, bm25(message_search, 1.0, 0.0) AS score'
+        '  FROM message_search WHERE message_search MATCH :expression) '
+        'SELECT id, conversation_id, hits FROM ('
+        '  SELECT id, conversation_id, score,'
+        '    ROW_NUMBER() OVER (PARTITION BY conversation_id ORDER BY score, id) AS n,'
+        '    COUNT(*) OVER (PARTITION BY conversation_id) AS hits'
+        '  FROM matches) '
+        'WHERE n = 1 ORDER BY score, conversation_id DESC LIMIT :limit OFFSET :offset'
+    ), {'expression': expression, 'limit': limit, 'offset': offset}).all()
+    if not best:
+        return []
+
+    ids = {row.id: row for row in best}
+    snippets = session.execute(text(
+        f"SELECT rowid AS id, seq, role, snippet(message_search, 0, '{MARK_START}', '{MARK_END}', '…', "
+        f"{SNIPPET_WORDS}) AS snippet FROM message_search WHERE message_search MATCH :expression "
+        f"AND rowid IN ({', '.join(str(int(row_id)) for row_id in ids)})"
+    ), {'expression': expression}).all()
+    found = {row.id: row for row in snippets}
+    return [(row.conversation_id, found[row.id].seq, found[row.id].role, row.hits, found[row.id].snippet)
+            for row in best]
+
+
+def _search_tsvector(user_id, query, limit, offset):
+    options = (f'StartSel="{MARK_START}", StopSel="{MARK_END}", MaxWords={SNIPPET_WORDS}, '
+               f'MinWords={SNIPPET_WORDS // 2}, MaxFragments=1, FragmentDelimiter="…"')
+    rows = db.session.execute(text(
+        'SELECT conversation_id, seq, role, hits, '
+        f"  ts_headline('{TEXT_SEARCH_CONFIG}', content, query, :options) AS snippet "
+        'FROM ('
+        '  SELECT m.conversation_id, m.seq, m.role, m.content, q.query,'
+        '    ts_rank_cd(m.search_vector, q.query) AS score,'
+        '    ROW_NUMBER() OVER (PARTITION BY m.conversation_id'
+        '      ORDER BY ts_rank_cd(m.search_vector, q.query) DESC, m.seq) AS n,'
+        '    COUNT(*) OVER (PARTITION BY m.conversation_id) AS hits'
+        '  FROM messages m JOIN conversations c ON c.id = m.conversation_id'
+        f"  CROSS JOIN websearch_to_tsquery('{TEXT_SEARCH_CONFIG}', :query) AS q(query)"
+        '  WHERE c.user_id = :user_id AND m.search_vector @@ q.query'
+        ') ranked WHERE n = 1 ORDER BY score DESC, conversation_id DESC LIMIT :limit OFFSET :offset'
+    ), {'query': query, 'user_id': user_id, 'options': options, 'limit': limit, 'offset': offset}).all()
+    return [(row.conversation_id, row.seq, row.role, row.hits, row.snippet) for row in rows]
+
+
+def snippet_html(snippet):
+    """Escape ``snippet`` for HTML and wrap its matched words in ``<mark>``."""
+    return html.escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
@@ -0,0 +1,268 @@
+"""Run identical in-flight generations once across every worker on the host.
+
+The first request for a key becomes the leader of a *flight*: it runs the
+upstream call and publishes each event to a shared SQLite file, batching
+writes every ``flush_interval`` seconds. Identical requests that arrive while
+the flight is running follow it by polling for new events, so a double
+submit or a burst of the same prompt costs one upstream generation and every
+stream fans out from it.
+
+A follower whose leader failed raises ``FlightFailed``. If the leader went
+away (client disconnect or a dead worker), a follower that has not yielded
+anything yet starts again and may lead a new flight. A leader on this host
+whose process is gone is noticed on the next poll; otherwise the flight is
+abandoned once its heartbeat is ``timeout`` seconds old. The leader beats
+every ``timeout / 3`` seconds while it waits on the provider, so a slow
+call that is not streamed stays followed.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from .cache import SQLiteStore, owner_alive
+
+logger = logging.getLogger(__name__)
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+ABANDONED = 'abandoned'
+
+
+class FlightFailed(Exception):
+    """The leader's upstream call raised; the message is its error."""
+
+
+class FlightAbandoned(Exception):
+    """The leader stopped before finishing the flight."""
+
+
+class FlightBoard(SQLiteStore):
+    def __init__(self, path, timeout, poll_interval=0.02, flush_interval=0.05, retention=300):
+        super().__init__(path)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.heartbeat_interval = timeout / 3
+        self.host = socket.gethostname()
+
+    @property
+    def owner(self):
+        return f'{self.host}:{os.getpid()}'
+
+    def _live(self, state, owner, heartbeat_at, now):
+        return state == RUNNING and heartbeat_at > now - self.timeout and owner_alive(owner, self.host)
+
+    def create(self, connection):
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS flights ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, owner TEXT NOT NULL, '
+            'state TEXT NOT NULL, error TEXT, heartbeat_at REAL NOT NULL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_flights_key ON flights (key, id)')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS flight_events ('
+            'flight_id INTEGER NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL, '
+            'PRIMARY KEY (flight_id, seq))'
+        )
+
+    def join(self, key):
+        """Return ``(flight_id, leader)`` for ``key``, starting a flight unless one is running."""
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT id, state, owner, heartbeat_at FROM flights WHERE key = ? ORDER BY id DESC LIMIT 1', (key,)
+            ).fetchone()
+            if row is not None and self._live(*row[1:], now):
+                return row[0], False
+            flight_id = connection.execute(
+                'INSERT INTO flights (key, owner, state, heartbeat_at) VALUES (?, ?, ?, ?)',
+                (key, self.owner, RUNNING, now)
+            ).lastrowid
+            stale = 'SELECT id FROM flights WHERE heartbeat_at < ?'
+            connection.execute(f'DELETE FROM flight_events WHERE flight_id IN ({stale})', (now - self.retention,))
+            connection.execute('DELETE FROM flights WHERE heartbeat_at < ?', (now - self.retention,))
+        return flight_id, True
+
+    def publish(self, flight_id, seq, events, state=RUNNING, error=None):
+        """Append ``events`` numbered from ``seq`` and record the flight's state."""
+        with self.transaction() as connection:
+            connection.executemany(
+                'INSERT INTO flight_events (flight_id, seq, event) VALUES (?, ?, ?)',
+                [(flight_id, seq + i, json.dumps(event)) for i, event in enumerate(events)]
+            )
+            connection.execute(
+                'UPDATE flights SET state = ?, error = ?, heartbeat_at = ? WHERE id = ?',
+                (state, error, time.time(), flight_id)
+            )
+
+    def read(self, flight_id, after):
+        """Return ``(events, state, error)`` for events after seq ``after``.
+
+        ``state`` is read first, so a finished state means ``events`` is complete.
+        """
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT state, error, owner, heartbeat_at FROM flights WHERE id = ?', (flight_id,)
+        ).fetchone()
+        if row is None:
+            return [], ABANDONED, None
+        state, error, owner, heartbeat_at = row
+        rows = connection.execute(
+            'SELECT event FROM flight_events WHERE flight_id = ? AND seq > ? ORDER BY seq', (flight_id, after)
+        ).fetchall()
+        if state == RUNNING and not self._live(state, owner, heartbeat_at, time.time()):
+            state = ABANDONED
+        return [json.loads(row[0]) for row in rows], state, error
+
+    def beat(self, flight_id):
+        """Refresh a running flight's heartbeat."""
+        try:
+            with self.transaction() as connection:
+                connection.execute('UPDATE flights SET heartbeat_at = ? WHERE id = ? AND state = ?',
+                                   (time.time(), flight_id, RUNNING))
+        except sqlite3.Error:
+            logger.exception('Refreshing flight %s failed', flight_id)
+
+    def _beat_until(self, flight_id, stopped):
+        while not stopped.wait(self.heartbeat_interval):
+            self.beat(flight_id)
+
+    async def _abeat(self, flight_id):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            await asyncio.to_thread(self.beat, flight_id)
+
+    def broadcast(self, flight_id, events):
+        """Yield ``events`` while publishing them to the flight's followers."""
+        pending, seq, flushed_at = [], 0, time.monotonic()
+        stopped = threading.Event()
+        threading.Thread(target=self._beat_until, args=(flight_id, stopped), daemon=True).start()
+        try:
+            for event in events:
+                pending.append(event)
+                yield event
+                if time.monotonic() - flushed_at >= self.flush_interval:
+                    self._publish_quietly(flight_id, seq, pending)
+                    seq, pending, flushed_at = seq + len(pending), [], time.monotonic()
+        except GeneratorExit:
+            self._publish_quietly(flight_id, seq, [], ABANDONED)
+            raise
+        except Exception as e:
+            self._publish_quietly(flight_id, seq, pending, FAILED, str(e))
+            raise
+        finally:
+            stopped.set()
+        self._publish_quietly(flight_id, seq, pending, DONE)
+
+    async def abroadcast(self, flight_id, events):
+        pending, seq, flushed_at = [], 0, time.monotonic()
+        heartbeat = asyncio.ensure_future(self._abeat(flight_id))
+        try:
+            async for event in events:
+                pending.append(event)
+                yield event
+                if time.monotonic() - flushed_at >= self.flush_interval:
+                    await asyncio.to_thread(self._publish_quietly, flight_id, seq, pending)
+                    seq, pending, flushed_at = seq + len(pending), [], time.monotonic()
+        except (GeneratorExit, asyncio.CancelledError):
+            self._publish_quietly(flight_id, seq, [], ABANDONED)
+            raise
+        except Exception as e:
+            await asyncio.to_thread(self._publish_quietly, flight_id, seq, pending, FAILED, str(e))
+            raise
+        finally:
+            heartbeat.cancel()
+        await asyncio.to_thread(self._publish_quietly, flight_id, seq, pending, DONE)
+
+    def follow(self, flight_id):
+        """Yield the flight's events until it finishes."""
+        seq = -1
+        while True:
+            events, state, error = self.read(flight_id, seq)
+            seq += len(events)
+            yield from events
+            if self._finished(state, error):
+                return
+            time.sleep(self.poll_interval)
+
+    async def afollow(self, flight_id):
+        seq = -1
+        while True:
+            events, state, error = await asyncio.to_thread(self.read, flight_id, seq)
+            seq += len(events)
+            for event in events:
+                yield event
+            if self._finished(state, error):
+                return
+            await asyncio.sleep(self.poll_interval)
+
+    @staticmethod
+    def _finished(state, error):
+        if state == DONE:
+            return True
+        if state == FAILED:
+            raise FlightFailed(error)
+        if state == ABANDONED:
+            raise FlightAbandoned()
+        return False
+
+    def _publish_quietly(self, flight_id, seq, events, state=RUNNING, error=None):
+        try:
+            self.publish(flight_id, seq, events, state, error)
+        except sqlite3.Error:
+            # Followers time out on the stale heartbeat and run on their own.
+            logger.exception('Publishing flight %s failed', flight_id)
+
+
+def coalesced(board, key, produce, on_join=None):
+    """Yield the events of ``produce()``, shared with identical requests in flight."""
+    if board is None or key is None:
+        yield from produce()
+        return
+    while True:
+        flight_id, leader = board.join(key)
+        if on_join:
+            on_join(leader)
+        if leader:
+            yield from board.broadcast(flight_id, produce())
+            return
+        started = False
+        try:
+            for event in board.follow(flight_id):
+                started = True
+                yield event
+            return
+        except FlightAbandoned:
+            if started:
+                raise FlightFailed('The shared generation was interrupted')
+
+
+async def acoalesced(board, key, produce, on_join=None):
+    if board is None or key is None:
+        async for event in produce():
+            yield event
+        return
+    while True:
+        flight_id, leader = await asyncio.to_thread(board.join, key)
+        if on_join:
+            on_join(leader)
+        if leader:
+            async for event in board.abroadcast(flight_id, produce()):
+                yield event
+            return
+        started = False
+        try:
+            async for event in board.afollow(flight_id):
+                started = True
+                yield event
+            return
+        except FlightAbandoned:
+            if started:
+                raise FlightFailed('The shared generation was interrupted')
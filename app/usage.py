@@ -0,0 +1,317 @@
+"""Token usage ledger with hourly and daily rollups.
+
+Every chat request leaves a ``UsageRecord``: user, model, endpoint, tokens,
+latency and whether the completion cache answered it. Records are buffered
+in the worker and inserted in batches by a background thread, once
+``USAGE_BATCH_SIZE`` are waiting or every ``USAGE_FLUSH_INTERVAL`` seconds,
+and the same transaction adds them to the ``UsageRollup`` rows for their
+hour and day. ``/api/usage`` and the administrators' ``/admin/usage`` read
+only the rollups, so their cost depends on the range asked for, not on how
+many requests were made. Records still
+buffered when a worker is killed are lost; a clean exit drains them.
+
+At most ``USAGE_MAX_QUEUE`` records wait in a worker; past that, new ones
+are dropped. A batch that fails ``USAGE_MAX_ATTEMPTS`` times in a row is
+written one record at a time, and the records that still fail are dropped,
+so one bad record cannot hold back the ones queued behind it. Dropped
+records are counted in ``usage_records_total{state="dropped"}``.
+"""
+import atexit
+import logging
+import os
+import threading
+from collections import defaultdict
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app, has_app_context
+from sqlalchemy import func, insert
+from sqlalchemy.exc import IntegrityError
+
+from . import db, metrics
+from .models import UsageRecord, UsageRollup, User
+
+logger = logging.getLogger(__name__)
+
+SAVE_ATTEMPTS = 3
+PERIODS = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+# Widest range ``/api/usage`` answers per period, in buckets.
+MAX_BUCKETS = {'hour': 31 * 24, 'day': 366}
+TOTALS = ('requests', 'cached_requests', 'prompt_tokens', 'completion_tokens', 'total_tokens', 'latency_ms')
+
+metrics.describe('usage_records_total', 'Usage ledger records by state (queued, written, dropped).')
+
+
+def bucket_start(moment, period):
+    if period == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class UsageLedger:
+    def __init__(self, app, batch_size, flush_interval, background=True, max_queue=10000, max_attempts=3):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.background = background
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self._queue = []
+        self._failures = 0
+        self._state = threading.Lock()
+        self._flushing = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._pid = None
+
+    def record(self, user_id, model, endpoint, counts, latency, cached):
+        """Queue one request's usage; ``counts`` holds its prompt, completion and total tokens.
+
+        A cache hit cost no provider tokens and is recorded with none.
+        """
+        if cached:
+            counts = dict.fromkeys(counts, 0)
+        entry = {
+            'user_id': user_id,
+            'model': model,
+            'endpoint': endpoint,
+            'prompt_tokens': counts['prompt_tokens'],
+            'completion_tokens': counts['completion_tokens'],
+            'total_tokens': counts['total_tokens'],
+            'latency_ms': int(latency * 1000),
+            'cached': cached,
+            'created_at': datetime.utcnow(),
+        }
+        with self._state:
+            waiting = len(self._queue)
+            if waiting < self.max_queue:
+                self._queue.append(entry)
+                waiting += 1
+            else:
+                entry = None
+        if entry is None:
+            logger.warning('Usage queue is full (%s records), dropping a record', waiting)
+            metrics.inc('usage_records_total', state='dropped')
+            return
+        metrics.inc('usage_records_total', state='queued')
+        if not self.background:
+            self.flush()
+            return
+        self._start()
+        if waiting >= self.batch_size:
+            self._wake.set()
+
+    def flush(self):
+        """Write queued records until none are left; return how many were written."""
+        written = 0
+        with self._flushing:
+            while True:
+                with self._state:
+                    batch, self._queue = self._queue[:self.batch_size], self._queue[self.batch_size:]
+                if not batch:
+                    return written
+                context = nullcontext() if has_app_context() else self.app.app_context()
+                try:
+                    with context:
+                        write_usage(batch)
+                except Exception:
+                    self._failures += 1
+                    if self._failures < self.max_attempts:
+                        with self._state:
+                            self._queue[:0] = batch
+                        raise
+                    logger.exception('Writing %s usage records failed %s times, writing them one by one',
+                                     len(batch), self._failures)
+                    with context:
+                        batch = self._write_each(batch)
+                self._failures = 0
+                metrics.inc('usage_records_total', len(batch), state='written')
+                written += len(batch)
+
+    def _write_each(self, batch):
+        """Write ``batch`` one record at a time, dropping those that fail; return the written ones."""
+        written = []
+        for entry in batch:
+            try:
+                write_usage([entry])
+            except Exception:
+                logger.exception('Dropping usage record for user %s', entry['user_id'])
+                metrics.inc('usage_records_total', state='dropped')
+            else:
+                written.append(entry)
+        return written
+
+    def close(self):
+        """Stop the background thread and write what is left."""
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=30)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Writing usage records at shutdown failed')
+            metrics.inc('usage_records_total', len(self._queue), state='dropped')
+
+    def _start(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='usage-ledger', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if not self._queue:
+                continue
+            try:
+                self.flush()
+            except Exception:
+                # The records stay queued and the next interval retries them.
+                logger.exception('Writing usage records failed')
+
+
+def write_usage(entries):
+    """Insert ``entries`` and add them to their hourly and daily rollups in one transaction."""
+    sums = defaultdict(lambda: dict.fromkeys(TOTALS, 0))
+    for entry in entries:
+        for period in PERIODS:
+            row = sums[(period, bucket_start(entry['created_at'], period), entry['user_id'], entry['model'])]
+            row['requests'] += 1
+            row['cached_requests'] += int(entry['cached'])
+            for name in ('prompt_tokens', 'completion_tokens', 'total_tokens', 'latency_ms'):
+                row[name] += entry[name]
+
+    for attempt in range(SAVE_ATTEMPTS):
+        try:
+            db.session.execute(insert(UsageRecord), entries)
+            existing = UsageRollup.query.filter(
+                UsageRollup.user_id.in_({key[2] for key in sums}),
+                UsageRollup.bucket.in_({key[1] for key in sums})
+            ).with_for_update().all()
+            rollups = {(row.period, row.bucket, row.user_id, row.model): row for row in existing}
+            for key, totals in sums.items():
+                rollup = rollups.get(key)
+                if rollup is None:
+                    period, bucket, user_id, model = key
+                    db.session.add(UsageRollup(period=period, bucket=bucket, user_id=user_id, model=model, **totals))
+                else:
+                    for name, amount in totals.items():
+                        setattr(rollup, name, getattr(rollup, name) + amount)
+            db.session.commit()
+            return
+        except IntegrityError:
+            # Another worker created one of the rollup rows first; retry against it.
+            db.session.rollback()
+            if attempt == SAVE_ATTEMPTS - 1:
+                raise
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def usage_ledger():
+    """Return this process's usage ledger, built from the app config on first use."""
+    app = current_app._get_current_object()
+    ledger = app.extensions.get('usage_ledger')
+    if ledger is None:
+        ledger = app.extensions['usage_ledger'] = UsageLedger(
+            app, app.config['USAGE_BATCH_SIZE'], app.config['USAGE_FLUSH_INTERVAL'],
+            background=app.config['USAGE_WRITE_BEHIND'], max_queue=app.config['USAGE_MAX_QUEUE'],
+            max_attempts=app.config['USAGE_MAX_ATTEMPTS']
+        )
+    return ledger
+
+
+def record_usage(user_id, model, endpoint, counts, latency, cached):
+    try:
+        usage_ledger().record(user_id, model, endpoint, counts, latency, cached)
+    except Exception:
+        # The reply has been produced; losing its usage row must not fail the request.
+        logger.exception('Recording usage failed')
+
+
+def usage_report(user_id, period, start, end):
+    """Return ``user_id``'s rollups for ``period`` buckets in ``[start, end)``, per bucket and model."""
+    rows = (UsageRollup.query
+            .filter(UsageRollup.period == period, UsageRollup.user_id == user_id,
+                    UsageRollup.bucket >= start, UsageRollup.bucket < end)
+            .order_by(UsageRollup.bucket, UsageRollup.model)
+            .all())
+    totals = dict.fromkeys(TOTALS, 0)
+    buckets = []
+    for row in rows:
+        values = {name: getattr(row, name) for name in TOTALS}
+        for name, amount in values.items():
+            totals[name] += amount
+        buckets.append({"start": row.bucket.isoformat(), "model": row.model, **values})
+    return {
+        "period": period,
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "buckets": buckets,
+        "totals": totals
+    }
+
+
+def usage_by_user(period, start, end, limit):
+    """Return every user's rollups in ``[start, end)`` summed per user and model, most tokens first."""
+    sums = [func.sum(getattr(UsageRollup, name)).label(name) for name in TOTALS]
+    rows = (db.session.query(UsageRollup.user_id, User.email, UsageRollup.model, *sums)
+            .outerjoin(User, User.id == UsageRollup.user_id)
+            .filter(UsageRollup.period == period, UsageRollup.bucket >= start, UsageRollup.bucket < end)
+            .group_by(UsageRollup.user_id, User.email, UsageRollup.model)
+            .order_by(func.sum(UsageRollup.total_tokens).desc(), UsageRollup.user_id, UsageRollup.model)
+            .limit(limit)
+            .all())
+    totals = (db.session.query(*sums)
+              .filter(UsageRollup.period == period, UsageRollup.bucket >= start, UsageRollup.bucket < end)
+              .one())
+    return {
+        "period": period,
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "users": [{"user_id": row.user_id, "email": row.email, "model": row.model,
+                   **{name: getattr(row, name) for name in TOTALS}} for row in rows],
+        "totals": {name: getattr(totals, name) or 0 for name in TOTALS}
+    }
+
+
+def parse_time(value):
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def report_range(period, start=None, end=None, now=None):
+    """Return ``(start, end)`` aligned to ``period`` buckets, UTC, with ``end`` exclusive.
+
+    The default is the last 24 hours or 30 days including the current bucket.
+    A ``to`` inside a bucket includes that bucket, so the last partial period
+    is reported. Raises ``ValueError`` for an unknown period, a bad timestamp or a range
+    wider than ``MAX_BUCKETS``.
+    """
+    if period not in PERIODS:
+        raise ValueError("period must be 'hour' or 'day'")
+    step = PERIODS[period]
+    if end:
+        moment = parse_time(end)
+        end = bucket_start(moment, period)
+        if end < moment:
+            end += step
+    else:
+        end = bucket_start(now or datetime.utcnow(), period) + step
+    if start:
+        start = bucket_start(parse_time(start), period)
+    else:
+        start = end - step * (24 if period == 'hour' else 30)
+    if start >= end:
+        raise ValueError("'from' must be before 'to'")
+    if (end - start) / step > MAX_BUCKETS[period]:
+        raise ValueError(f'At most {MAX_BUCKETS[period]} {period} buckets can be requested')
+    return start, end
@@ -0,0 +1,128 @@
+"""Per-process cache of the users behind authenticated requests.
+
+``load_user`` runs on every ``@login_required`` request, so each worker
+keeps recently loaded users in an LRU (``USER_CACHE_SIZE`` entries for
+``USER_CACHE_TTL`` seconds) instead of querying the database each time.
+
+Entries are checked against a per-user version counter kept in a SQLite file
+shared by the workers on the host (``USER_VERSIONS_PATH``). Committing a
+change to a user (a new password, an edited profile) or logging out bumps
+the counter, so every worker reloads that user on its next request. If the
+counter cannot be read the user is loaded from the database.
+"""
+import logging
+import sqlite3
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from . import db, metrics
+from .cache import LRUCache, SQLiteStore
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('user_cache_requests_total', 'Authenticated user lookups by result (hit, miss, stale).')
+
+
+class UserVersions(SQLiteStore):
+    def create(self, connection):
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS user_versions (user_id INTEGER PRIMARY KEY, version INTEGER NOT NULL)'
+        )
+
+    def get(self, user_id):
+        row = self._connection().execute(
+            'SELECT version FROM user_versions WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, user_ids):
+        with self.transaction() as connection:
+            connection.executemany(
+                'INSERT INTO user_versions (user_id, version) VALUES (?, 1) '
+                'ON CONFLICT (user_id) DO UPDATE SET version = version + 1',
+                [(user_id,) for user_id in user_ids]
+            )
+
+
+class UserCache:
+    def __init__(self, local, versions):
+        self.local = local
+        self.versions = versions
+
+    def load(self, user_id):
+        """Return the ``User`` with ``user_id``, attached to the current session, or None."""
+        try:
+            version = self.versions.get(user_id)
+        except sqlite3.Error:
+            logger.exception('Reading the user version failed')
+            version = None
+        entry = self.local.get(user_id)
+        if entry is not None and version is not None and entry[0] == version:
+            metrics.inc('user_cache_requests_total', result='hit')
+            return db.session.merge(restore(entry[1]), load=False)
+
+        metrics.inc('user_cache_requests_total', result='miss' if entry is None else 'stale')
+        user = db.session.get(User, user_id)
+        if user is not None and version is not None:
+            self.local.set(user_id, (version, snapshot(user)))
+        return user
+
+    def invalidate(self, user_ids):
+        for user_id in user_ids:
+            self.local.delete(user_id)
+        try:
+            self.versions.bump(user_ids)
+        except sqlite3.Error:
+            logger.exception('Bumping user versions failed')
+
+
+def snapshot(user):
+    return {column.key: getattr(user, column.key) for column in User.__mapper__.column_attrs}
+
+
+def restore(values):
+    """Rebuild a detached ``User`` from a snapshot without touching the database."""
+    user = User.__mapper__.class_manager.new_instance()
+    for key, value in values.items():
+        setattr(user, key, value)
+    make_transient_to_detached(user)
+    return user
+
+
+def user_cache():
+    """Return this process's user cache, built from the app config on first use."""
+    app = current_app._get_current_object()
+    cache = app.extensions.get('user_cache')
+    if cache is None:
+        cache = app.extensions['user_cache'] = UserCache(
+            LRUCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL']),
+            UserVersions(app.config['USER_VERSIONS_PATH'])
+        )
+    return cache
+
+
+def forget_user(user_id):
+    user_cache().invalidate([user_id])
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_users(session, flush_context):
+    changed = {obj.id for obj in session.dirty if isinstance(obj, User) and session.is_modified(obj)}
+    changed |= {obj.id for obj in session.deleted if isinstance(obj, User)}
+    if changed:
+        session.info.setdefault('changed_users', set()).update(changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_changed_users(session):
+    changed = session.info.pop('changed_users', None)
+    if changed and has_app_context():
+        user_cache().invalidate(sorted(changed))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_users(session):
+    session.info.pop('changed_users', None)
@@ -0,0 +1,193 @@
+"""How many concurrent ``/api/chat/stream`` responses one process can hold.
+
+Drives the ASGI gateway in-process with a fake async OpenAI client whose
+streams emit ``--chunks`` deltas ``--interval`` seconds apart, so every
+stream stays open for roughly ``chunks * interval`` seconds. For each
+concurrency level it reports the wall time, the peak number of upstream
+streams open at once and the per-stream time to first byte, as one JSON
+object per line. ``--sync-workers`` runs the same load through the Flask
+route on that many threads for comparison with the gunicorn sync workers.
+
+    python benchmarks/async_streams.py --streams 100,500,1000
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+os.environ.setdefault('OPENAI_API_KEY', 'bench-key')
+os.environ.pop('GEMINI_API_KEY', None)
+
+from app import create_app, db  # noqa: E402
+from app.gateway import create_asgi_app  # noqa: E402
+from app.models import User  # noqa: E402
+
+
+class OpenStreams:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.open += 1
+            self.peak = max(self.peak, self.open)
+
+    def __exit__(self, *exc):
+        with self.lock:
+            self.open -= 1
+
+
+def _chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+
+
+class FakeAsyncCompletions:
+    def __init__(self, tracker, chunks, interval):
+        self.tracker, self.chunks, self.interval = tracker, chunks, interval
+
+    async def create(self, **kwargs):
+        async def stream():
+            with self.tracker:
+                for i in range(self.chunks):
+                    await asyncio.sleep(self.interval)
+                    yield _chunk(f"tok{i} ")
+        return stream()
+
+
+class FakeSyncCompletions(FakeAsyncCompletions):
+    def create(self, **kwargs):
+        def stream():
+            with self.tracker:
+                for i in range(self.chunks):
+                    time.sleep(self.interval)
+                    yield _chunk(f"tok{i} ")
+        return stream()
+
+
+def fake_client(completions):
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+
+async def asgi_stream(asgi_app, cookie, body):
+    scope = {
+        'type': 'http', 'method': 'POST', 'path': '/api/chat/stream', 'query_string': b'',
+        'http_version': '1.1', 'server': ('localhost', 80), 'client': ('127.0.0.1', 0),
+        'headers': [(b'content-type', b'application/json'), (b'cookie', cookie.encode())],
+    }
+    pending = [{'type': 'http.request', 'body': body}]
+    started = time.perf_counter()
+    first_byte = None
+
+    async def receive():
+        if pending:
+            return pending.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal first_byte
+        if message.get('body') and first_byte is None:
+            first_byte = time.perf_counter() - started
+
+    await asgi_app(scope, receive, send)
+    return first_byte
+
+
+async def run_async(asgi_app, cookie, body, n):
+    return await asyncio.gather(*(asgi_stream(asgi_app, cookie, body) for _ in range(n)))
+
+
+def login_cookie(flask_app):
+    client = flask_app.test_client()
+    client.post('/login', json={'email_or_phone': 'bench@example.com', 'password': 'password'})
+    return f"session={client.get_cookie('session').value}"
+
+
+def run_sync(flask_app, cookie, body, n, workers):
+    def one():
+        client = flask_app.test_client()
+        client.set_cookie('session', cookie.split('=', 1)[1])
+        started = time.perf_counter()
+        response = client.post('/api/chat/stream', data=body, content_type='application/json',
+                               buffered=False)
+        first_byte = None
+        for chunk in response.response:
+            if chunk and first_byte is None:
+                first_byte = time.perf_counter() - started
+        response.close()
+        return first_byte
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda _: one(), range(n)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--streams', default='100,250,500,1000',
+                        help='comma separated concurrency levels')
+    parser.add_argument('--chunks', type=int, default=20)
+    parser.add_argument('--interval', type=float, default=0.05)
+    parser.add_argument('--sync-workers', type=int, default=2,
+                        help='threads for the sync comparison run, 0 to skip')
+    args = parser.parse_args()
+
+    flask_app = create_app()
+    flask_app.config['WTF_CSRF_ENABLED'] = False
+    with flask_app.app_context():
+        db.create_all()
+        user = User(name='Bench', email='bench@example.com', phone='0000000000')
+        user.set_password('password')
+        db.session.add(user)
+        db.session.commit()
+
+    asgi_app = create_asgi_app(flask_app)
+    cookie = login_cookie(flask_app)
+    # Opt out of caching and coalescing so every stream reaches the provider.
+    body = json.dumps({'message': 'Hello', 'model': 'gpt-4o', 'cache': False}).encode()
+    stream_seconds = args.chunks * args.interval
+
+    levels = [int(s) for s in args.streams.split(',')]
+    modes = [('asgi', None, levels)]
+    if args.sync_workers:
+        # A sync worker holds one stream at a time; keep that run short.
+        modes.append(('wsgi-sync', args.sync_workers, [args.sync_workers * 10]))
+
+    for mode, workers, levels in modes:
+        for n in levels:
+            tracker = OpenStreams()
+            started = time.perf_counter()
+            if mode == 'asgi':
+                client = fake_client(FakeAsyncCompletions(tracker, args.chunks, args.interval))
+                with patch('app.providers.async_openai_client', client):
+                    ttfb = asyncio.run(run_async(asgi_app, cookie, body, n))
+            else:
+                client = fake_client(FakeSyncCompletions(tracker, args.chunks, args.interval))
+                with patch('app.providers.openai_client', client):
+                    ttfb = run_sync(flask_app, cookie, body, n, workers)
+            wall = time.perf_counter() - started
+            ttfb = sorted(t for t in ttfb if t is not None)
+            print(json.dumps({
+                'mode': mode,
+                'workers': workers,
+                'streams': n,
+                'stream_seconds': stream_seconds,
+                'wall_seconds': round(wall, 3),
+                'peak_open_streams': tracker.peak,
+                'ttfb_p50': round(statistics.median(ttfb), 4),
+                'ttfb_p99': round(ttfb[int(len(ttfb) * 0.99) - 1 if len(ttfb) > 1 else 0], 4),
+            }), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Prompt size and trimming cost on synthetic 200-turn conversations.
+
+Builds ``--conversations`` chats of ``--turns`` user/assistant pairs under a
+system prompt and, for each strategy, reports the prompt tokens before and
+after trimming to ``--budget`` and the time ``context.trim`` takes on a cold
+token cache and on a warm one (a client resending its history with one more
+turn), as one JSON object per line.
+
+    python benchmarks/context_trim.py --turns 200 --budget 4000
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import context  # noqa: E402
+
+WORDS = ('packet', 'firewall', 'token', 'latency', 'cipher', 'request', 'policy', 'audit', 'router', 'header')
+
+
+def conversation(rng, turns):
+    messages = [{"role": "system", "content": "You are a careful security assistant."}]
+    for i in range(turns):
+        for role, length in (('user', rng.randint(10, 80)), ('assistant', rng.randint(40, 300))):
+            text = ' '.join(rng.choice(WORDS) for _ in range(length))
+            messages.append({"role": role, "content": f'{role} turn {i}: {text}'})
+    messages.append({"role": "user", "content": "And what should I do next?"})
+    return messages
+
+
+def timed_trim(model, messages, budget, strategy):
+    started = time.perf_counter()
+    result = context.trim(model, messages, budget, strategy)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def run(strategy, chats, model, budget):
+    context._counts.clear()
+    cold, warm, before, after = [], [], [], []
+    for messages in chats:
+        (_, tokens_before, tokens_after), elapsed = timed_trim(model, messages[:-2], budget, strategy)
+        cold.append(elapsed)
+        (_, tokens_before, tokens_after), elapsed = timed_trim(model, messages, budget, strategy)
+        warm.append(elapsed)
+        before.append(tokens_before)
+        after.append(tokens_after)
+    return {
+        'strategy': strategy,
+        'model': model,
+        'tokenizer': context.encoding_name(model),
+        'budget': budget,
+        'prompt_tokens_before_mean': round(statistics.mean(before)),
+        'prompt_tokens_after_mean': round(statistics.mean(after)),
+        'trim_ms_cold_p50': round(statistics.median(cold), 3),
+        'trim_ms_warm_p50': round(statistics.median(warm), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--conversations', type=int, default=20)
+    parser.add_argument('--budget', type=int, default=4000)
+    parser.add_argument('--model', default='gpt-4o')
+    parser.add_argument('--strategies', default='none,window,pinned,summary')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    chats = [conversation(rng, args.turns) for _ in range(args.conversations)]
+    for strategy in args.strategies.split(','):
+        print(json.dumps(run(strategy, chats, args.model, args.budget)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""Throughput and latency of the gateway against a mock provider.
+
+Starts ``mock_provider.MockProvider`` in this process and the app in a
+child process pointed at it with ``OPENAI_BASE_URL``, on a threaded
+werkzeug server (``--server wsgi``) or the ASGI gateway under uvicorn
+(``--server asgi``). The child gets a fresh SQLite database with
+``--users`` accounts and its own instance files. CSRF checks are off, as
+for an API client, and login limits are lifted so the login scenario
+measures password hashing, not the throttle.
+
+Each scenario sends ``--requests`` requests from ``--concurrency``
+threads after ``--warmup`` untimed ones: ``login`` posts credentials,
+``chat`` and ``chat_stream`` send a distinct message each so neither the
+cache nor request coalescing answers them, ``history`` lists
+conversations, and ``tts`` asks for speech. Every result is a JSON
+object with requests per second, p50/p99 latency, time to first token
+for streams and the server's peak RSS during the scenario (Linux only).
+``--output`` writes the run to a file and ``--compare`` prints the
+change against an earlier one.
+
+    python benchmarks/load.py --concurrency 16 --requests 400 --output run.json
+    python benchmarks/load.py --server asgi --compare run.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from mock_provider import MockProvider  # noqa: E402
+
+SCENARIOS = ('login', 'chat', 'chat_stream', 'history', 'tts')
+DEFAULT_SCENARIOS = ('login', 'chat', 'chat_stream', 'history')
+PASSWORD = 'bench-password'
+INSTANCE_FILES = ('COMPLETION_CACHE_PATH', 'SINGLE_FLIGHT_PATH', 'USER_VERSIONS_PATH', 'RATE_LIMIT_PATH',
+                  'QUOTA_PATH', 'METRICS_PATH', 'PERSIST_JOURNAL_PATH', 'STT_CACHE_PATH', 'JOBS_PATH')
+
+
+def email(index):
+    return f'bench{index}@example.com'
+
+
+def serve(server, users):
+    """Child process: seed ``users`` accounts, print the port and serve until killed."""
+    import logging
+
+    from app import create_app, db
+    from app.models import User
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    flask_app = create_app()
+    flask_app.config['WTF_CSRF_ENABLED'] = False
+    with flask_app.app_context():
+        db.create_all()
+        for index in range(users):
+            user = User(name=f'Bench {index}', email=email(index), phone=f'{index:010d}')
+            user.set_password(PASSWORD)
+            db.session.add(user)
+        db.session.commit()
+
+    if server == 'wsgi':
+        from werkzeug.serving import make_server
+        httpd = make_server('127.0.0.1', 0, flask_app, threaded=True)
+        print(httpd.server_port, flush=True)
+        httpd.serve_forever()
+        return
+
+    import uvicorn
+
+    from app.gateway import create_asgi_app
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    print(sock.getsockname()[1], flush=True)
+    config = uvicorn.Config(create_asgi_app(flask_app), log_level='warning', lifespan='on')
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def start_server(args, provider):
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    env = dict(os.environ, **{
+        'OPENAI_BASE_URL': provider.base_url,
+        'OPENAI_API_KEY': 'bench-key',
+        'DATABASE_URL': 'sqlite:///' + os.path.join(workdir, 'bench.sqlite3'),
+        'TTS_CACHE_DIR': os.path.join(workdir, 'tts_cache'),
+        'IMAGE_CACHE_DIR': os.path.join(workdir, 'images'),
+        'PROFILE_DIR': os.path.join(workdir, 'profiles'),
+        'LOGIN_IP_BURST': str(10 ** 9),
+        'LOGIN_ACCOUNT_BURST': str(10 ** 9),
+        'PYTHONPATH': ROOT,
+    })
+    env.pop('GEMINI_API_KEY', None)
+    for name in INSTANCE_FILES:
+        env[name] = os.path.join(workdir, name.lower() + '.sqlite3')
+    for item in args.env:
+        name, _, value = item.partition('=')
+        env[name] = value
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', args.server,
+                              '--users', str(args.users)], env=env, stdout=subprocess.PIPE, text=True)
+    port = int(child.stdout.readline())
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return child, port
+
+
+def request(port, method, path, body=None, cookie=None, stream=False):
+    """Send one request; return ``(status, seconds to first content or None, response headers)``."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    headers = {'Content-Type': 'application/json'}
+    if cookie:
+        headers['Cookie'] = cookie
+    started = time.perf_counter()
+    try:
+        conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+        response = conn.getresponse()
+        first = None
+        if stream:
+            for line in response:
+                if first is None and line.startswith(b'data:') and b'"content"' in line:
+                    first = time.perf_counter() - started
+        else:
+            response.read()
+        return response.status, first, response
+    finally:
+        conn.close()
+
+
+def login(port, index):
+    status, _, response = request(port, 'POST', '/login', {'email_or_phone': email(index), 'password': PASSWORD})
+    if status != 200:
+        raise RuntimeError(f'Login as {email(index)} failed with {status}')
+    return response.getheader('Set-Cookie').split(';', 1)[0]
+
+
+def scenario_call(name, port, cookies, model, index):
+    cookie = cookies[index % len(cookies)]
+    if name == 'login':
+        return request(port, 'POST', '/login', {'email_or_phone': email(index % len(cookies)), 'password': PASSWORD})
+    if name == 'chat':
+        return request(port, 'POST', '/api/chat', {'message': f'bench {index} {time.time()}', 'model': model}, cookie)
+    if name == 'chat_stream':
+        return request(port, 'POST', '/api/chat/stream', {'message': f'bench {index} {time.time()}', 'model': model},
+                       cookie, stream=True)
+    if name == 'history':
+        return request(port, 'GET', '/api/chat/history?view=summary&limit=20', cookie=cookie)
+    return request(port, 'POST', '/voice/tts', {'text': f'Benchmark sentence number {index}.'}, cookie)
+
+
+def reset_peak_rss(pid):
+    # Writing 5 to clear_refs resets VmHWM (Linux 4.0+).
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 1)
+
+
+def run_scenario(name, args, port, cookies, pid):
+    call = lambda index: scenario_call(name, port, cookies, args.model, index)  # noqa: E731
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(call, range(args.warmup)))
+    reset_peak_rss(pid)
+
+    latencies, ttfts, statuses = [], [], Counter()
+    lock = threading.Lock()
+
+    def timed(index):
+        started = time.perf_counter()
+        try:
+            status, first, _ = call(index)
+        except OSError as e:
+            status, first = type(e).__name__, None
+        elapsed = time.perf_counter() - started
+        with lock:
+            statuses[status] += 1
+            if status == 200:
+                latencies.append(elapsed)
+                if first is not None:
+                    ttfts.append(first)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(timed, range(args.warmup, args.warmup + args.requests)))
+    wall = time.perf_counter() - started
+    return {
+        'scenario': name,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'errors': args.requests - statuses[200],
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'rps': round(len(latencies) / wall, 1),
+        'p50_ms': percentile(latencies, 0.5),
+        'p99_ms': percentile(latencies, 0.99),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 1) if latencies else None,
+        'ttft_p50_ms': percentile(ttfts, 0.5),
+        'ttft_p99_ms': percentile(ttfts, 0.99),
+        'server_peak_rss_mb': peak_rss_mb(pid),
+    }
+
+
+def compare(results, baseline):
+    """Print the relative change of each figure against the same scenario in ``baseline``."""
+    previous = {result['scenario']: result for result in baseline['results']}
+    for result in results:
+        before = previous.get(result['scenario'])
+        if before is None:
+            continue
+        changes = {}
+        for key in ('rps', 'p50_ms', 'p99_ms', 'ttft_p50_ms', 'ttft_p99_ms', 'server_peak_rss_mb'):
+            if result.get(key) is not None and before.get(key):
+                changes[key] = f'{(result[key] - before[key]) / before[key]:+.1%}'
+        print(json.dumps({'scenario': result['scenario'], 'change': changes}), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--scenarios', default=','.join(DEFAULT_SCENARIOS),
+                        help=f'comma-separated, from {", ".join(SCENARIOS)}')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--users', type=int, help='accounts to spread requests over (default: concurrency)')
+    parser.add_argument('--model', default='gpt-4o')
+    parser.add_argument('--latency', type=float, default=0.1, help='provider seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=100.0)
+    parser.add_argument('--chunk-tokens', type=int, default=1)
+    parser.add_argument('--reply-tokens', type=int, default=50)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for the server, e.g. QUOTA_USER_CONCURRENCY=0')
+    parser.add_argument('--output', help='write the run as JSON to this file')
+    parser.add_argument('--compare', help='JSON file from an earlier --output to compare against')
+    parser.add_argument('--serve', choices=('wsgi', 'asgi'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.users = args.users or args.concurrency
+    if args.serve:
+        return serve(args.serve, args.users)
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    provider = MockProvider(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                            chunk_tokens=args.chunk_tokens, reply_tokens=args.reply_tokens).start()
+    child, port = start_server(args, provider)
+    config = {key: value for key, value in vars(args).items() if key not in ('serve', 'output', 'compare')}
+    config.update(python=platform.python_version(), cpus=os.cpu_count())
+    print(json.dumps({'config': config}), flush=True)
+    try:
+        cookies = [login(port, index) for index in range(args.users)]
+        results = []
+        for name in scenarios:
+            result = run_scenario(name, args, port, cookies, child.pid)
+            results.append(result)
+            print(json.dumps(result), flush=True)
+    finally:
+        child.terminate()
+        child.wait(timeout=30)
+        provider.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
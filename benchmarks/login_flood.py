@@ -0,0 +1,235 @@
+"""Chat latency while the server is flooded with login attempts.
+
+Serves the Flask app with a fake OpenAI client that answers after
+``--upstream`` seconds, either on a threaded werkzeug server in this process
+or, with ``--server gunicorn``, under gunicorn with the deployment's flags
+(``GUNICORN_ARGS``). The hashing limits are per worker process, so only the
+latter shows what a deployment does under a flood. A logged-in
+client sends ``--requests`` sequential ``/api/chat`` requests while
+``--flooders`` threads in a separate process post wrong passwords for the same account to
+``/login`` as fast as they can, so every attempt that gets through costs a
+password hash. Three runs print one JSON object per line:
+no flood, a flood against the default limits, and a flood with the
+limiter and the hashing pool opened up so every attempt is hashed, which
+is how login behaved before they existed.
+
+    python benchmarks/login_flood.py --flooders 32 --requests 200
+    python benchmarks/login_flood.py --server gunicorn
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+from unittest.mock import patch
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+os.environ.setdefault('OPENAI_API_KEY', 'bench-key')
+os.environ.pop('GEMINI_API_KEY', None)
+
+from werkzeug.serving import make_server  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.models import User  # noqa: E402
+
+UNBOUNDED = {
+    'LOGIN_IP_BURST': 10 ** 9, 'LOGIN_ACCOUNT_BURST': 10 ** 9,
+    'PASSWORD_HASH_WORKERS': 256, 'PASSWORD_HASH_QUEUE': 10 ** 6,
+}
+# As deployed in .replit.
+GUNICORN_ARGS = ['--workers=2', '--worker-class=gthread', '--threads=8', '--timeout=120', '--preload']
+
+
+class FakeCompletions:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def create(self, **kwargs):
+        time.sleep(self.delay)
+        message = SimpleNamespace(content='ok')
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def build_app(overrides):
+    workdir = tempfile.mkdtemp()
+    flask_app = create_app()
+    flask_app.config.update({
+        'WTF_CSRF_ENABLED': False,
+        'RATE_LIMIT_PATH': os.path.join(workdir, 'ratelimits.sqlite3'),
+        'USER_VERSIONS_PATH': os.path.join(workdir, 'user_versions.sqlite3'),
+        'PERSIST_JOURNAL_PATH': os.path.join(workdir, 'turns.sqlite3'),
+        'SINGLE_FLIGHT_ENABLED': False,
+        **overrides,
+    })
+    with flask_app.app_context():
+        db.create_all()
+        if not User.query.filter_by(email='bench@example.com').first():
+            user = User(name='Bench', email='bench@example.com', phone='0000000000')
+            user.set_password('password')
+            db.session.add(user)
+            db.session.commit()
+    return flask_app
+
+
+def fake_openai(upstream):
+    return SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions(upstream)))
+
+
+def gunicorn_app():
+    """Gunicorn app factory: the benchmark app, set up from the environment ``measure`` passes."""
+    from app import providers
+    fake = fake_openai(float(os.environ['LOGIN_FLOOD_UPSTREAM']))
+
+    def use_fake():
+        providers.openai_client = fake
+
+    # Workers drop the clients they inherit; this runs after that.
+    os.register_at_fork(after_in_child=use_fake)
+    use_fake()
+    return build_app(json.loads(os.environ['LOGIN_FLOOD_OVERRIDES']))
+
+
+class WerkzeugServer:
+    def __init__(self, overrides, upstream):
+        self.patch = patch('app.providers.openai_client', fake_openai(upstream))
+        self.patch.start()
+        self.server = make_server('127.0.0.1', 0, build_app(overrides), threaded=True)
+        self.port = self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.patch.stop()
+
+
+class GunicornServer:
+    def __init__(self, overrides, upstream):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+        env = dict(os.environ, LOGIN_FLOOD_OVERRIDES=json.dumps(overrides), LOGIN_FLOOD_UPSTREAM=str(upstream),
+                   PYTHONPATH=ROOT)
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', f'--bind=127.0.0.1:{self.port}', '--log-level=warning',
+             *GUNICORN_ARGS, 'benchmarks.login_flood:gunicorn_app()'],
+            cwd=ROOT, env=env
+        )
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline or self.process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.2)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(timeout=60)
+
+
+SERVERS = {'werkzeug': WerkzeugServer, 'gunicorn': GunicornServer}
+
+
+def post(port, path, body, cookie=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    headers = {'Content-Type': 'application/json'}
+    if cookie:
+        headers['Cookie'] = cookie
+    conn.request('POST', path, body=json.dumps(body), headers=headers)
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response
+
+
+def flood(port, flooders):
+    """Child process: post logins from ``flooders`` threads until stdin closes, then print the statuses."""
+    stop = threading.Event()
+    statuses = Counter()
+
+    def run():
+        while not stop.is_set():
+            response = post(port, '/login', {'email_or_phone': 'bench@example.com', 'password': 'wrong-password'})
+            statuses[response.status] += 1
+
+    threads = [threading.Thread(target=run, daemon=True) for _ in range(flooders)]
+    for thread in threads:
+        thread.start()
+    sys.stdin.read()
+    stop.set()
+    for thread in threads:
+        thread.join()
+    print(json.dumps({str(status): count for status, count in sorted(statuses.items())}), flush=True)
+
+
+def measure(server_class, label, overrides, flooders, requests, upstream):
+    server = server_class(overrides, upstream)
+    port = server.port
+    login = post(port, '/login', {'email_or_phone': 'bench@example.com', 'password': 'password'})
+    cookie = login.getheader('Set-Cookie').split(';', 1)[0]
+
+    flooder = None
+    if flooders:
+        flooder = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--flood', str(port),
+                                    '--flooders', str(flooders)], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   text=True)
+        time.sleep(1)
+
+    latencies = []
+    for i in range(requests):
+        started = time.perf_counter()
+        response = post(port, '/api/chat', {'message': f'ping {i}'}, cookie)
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert response.status == 200, response.status
+
+    statuses = {}
+    if flooder:
+        statuses = json.loads(flooder.communicate('', timeout=300)[0])
+    server.stop()
+    latencies.sort()
+    return {
+        'mode': label,
+        'server': server_class.__name__.removesuffix('Server').lower(),
+        'flooders': flooders,
+        'chat_requests': requests,
+        'chat_p50_ms': round(statistics.median(latencies), 1),
+        'chat_p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 1),
+        'chat_max_ms': round(latencies[-1], 1),
+        'login_statuses': statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--flooders', type=int, default=32, help='threads posting logins')
+    parser.add_argument('--requests', type=int, default=200, help='chat requests per run')
+    parser.add_argument('--upstream', type=float, default=0.02, help='fake completion latency in seconds')
+    parser.add_argument('--server', choices=SERVERS, default='werkzeug', help='server to flood')
+    parser.add_argument('--flood', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.flood:
+        return flood(args.flood, args.flooders)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    runs = [('baseline', {}, 0), ('limited', {}, args.flooders), ('unbounded', UNBOUNDED, args.flooders)]
+    for label, overrides, flooders in runs:
+        result = measure(SERVERS[args.server], label, overrides, flooders, args.requests, args.upstream)
+        print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()
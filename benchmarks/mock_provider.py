@@ -0,0 +1,155 @@
+"""A local stand-in for the OpenAI API with configurable speed.
+
+Speaks enough of the wire format for the gateway's OpenAI calls: chat
+completions, streamed as server-sent events when asked, with usage in a
+final chunk for ``stream_options.include_usage``; ``/v1/audio/speech``,
+which returns silent MP3 frames; ``/v1/audio/transcriptions``; and
+``/v1/models`` for pre-warming. Each response waits ``latency`` seconds,
+then produces ``reply_tokens`` tokens at ``tokens_per_second``, streamed
+``chunk_tokens`` at a time. Speech takes one token per word of input. Point the app at it with ``OPENAI_BASE_URL``.
+
+    python benchmarks/mock_provider.py --port 8900 --latency 0.2 --tokens-per-second 80
+"""
+import argparse
+import json
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+# One MPEG-1 layer III frame, 128 kbit/s at 44.1 kHz: 26 ms of silence.
+MP3_FRAME = b'\xff\xfb\x90\x00' + bytes(413)
+SPEECH_CHARS_PER_SECOND = 15
+
+
+class MockProvider(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.1, tokens_per_second=100.0, chunk_tokens=1, reply_tokens=50):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.reply_tokens = reply_tokens
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_port}/v1'
+
+    def start(self):
+        Thread(target=self.serve_forever, name='mock-provider', daemon=True).start()
+        return self
+
+    def pace(self, tokens):
+        if self.tokens_per_second > 0:
+            time.sleep(tokens / self.tokens_per_second)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/v1/models':
+            return self.send_json({'object': 'list', 'data': [{'id': 'gpt-4o', 'object': 'model', 'owned_by': 'mock'}]})
+        self.send_json({'error': {'message': 'Not found'}}, 404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        routes = {
+            '/v1/chat/completions': self.chat,
+            '/v1/audio/speech': self.speech,
+            '/v1/audio/transcriptions': self.transcription,
+        }
+        handler = routes.get(self.path.split('?', 1)[0])
+        if handler is None:
+            return self.send_json({'error': {'message': 'Not found'}}, 404)
+        handler(body)
+
+    def chat(self, body):
+        request = json.loads(body)
+        server = self.server
+        prompt_tokens = sum(len(str(message.get('content', '')).split()) for message in request['messages'])
+        reply_tokens = min(server.reply_tokens, request.get('max_tokens') or server.reply_tokens)
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': reply_tokens,
+                 'total_tokens': prompt_tokens + reply_tokens}
+        base = {'id': f'chatcmpl-{uuid.uuid4().hex}', 'created': int(time.time()), 'model': request['model']}
+        time.sleep(server.latency)
+
+        if not request.get('stream'):
+            server.pace(reply_tokens)
+            return self.send_json({
+                **base, 'object': 'chat.completion', 'usage': usage,
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': words(0, reply_tokens)}}],
+            })
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        chunk = dict(base, object='chat.completion.chunk')
+        for start in range(0, reply_tokens, server.chunk_tokens):
+            count = min(server.chunk_tokens, reply_tokens - start)
+            server.pace(count)
+            delta = {'content': words(start, count)}
+            if start == 0:
+                delta['role'] = 'assistant'
+            self.send_event({**chunk, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})
+        self.send_event({**chunk, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+        if (request.get('stream_options') or {}).get('include_usage'):
+            self.send_event({**chunk, 'choices': [], 'usage': usage})
+        self.send_chunk(b'data: [DONE]\n\n')
+        self.send_chunk(b'')
+
+    def speech(self, body):
+        text = json.loads(body).get('input', '')
+        time.sleep(self.server.latency)
+        self.server.pace(len(text.split()))
+        frames = max(1, int(len(text) / SPEECH_CHARS_PER_SECOND / 0.026))
+        self.send_bytes(MP3_FRAME * frames, 'audio/mpeg')
+
+    def transcription(self, body):
+        time.sleep(self.server.latency)
+        self.server.pace(self.server.reply_tokens)
+        self.send_json({'text': words(0, self.server.reply_tokens)})
+
+    def send_json(self, payload, status=200):
+        self.send_bytes(json.dumps(payload).encode(), 'application/json', status)
+
+    def send_bytes(self, data, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_event(self, payload):
+        self.send_chunk(f'data: {json.dumps(payload)}\n\n'.encode())
+
+    def send_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+
+def words(start, count):
+    return ''.join(f'tok{i} ' for i in range(start, start + count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=100.0, help='0 sends every token at once')
+    parser.add_argument('--chunk-tokens', type=int, default=1, help='tokens per streamed chunk')
+    parser.add_argument('--reply-tokens', type=int, default=50, help='tokens per reply')
+    args = parser.parse_args()
+    server = MockProvider(args.port, args.latency, args.tokens_per_second, args.chunk_tokens, args.reply_tokens)
+    print(f'Serving a mock OpenAI API at {server.base_url}', flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
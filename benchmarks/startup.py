@@ -0,0 +1,137 @@
+"""Worker cold start, phase by phase.
+
+Each run starts a fresh interpreter that times, in order: importing Flask
+and its extensions, importing the ``app`` package, ``create_app``, the
+first request (``/health``, which opens the first database connection),
+building the OpenAI and Gemini clients, and ``migrate`` against an empty
+and an up-to-date database. It also records whether the provider SDKs were
+imported by the time the first request was answered. The parent prints the
+median of ``--runs`` runs per phase as JSON, along with the bare interpreter
+start and the whole child's wall time. With ``--imports N`` it also lists
+the N slowest modules from ``python -X importtime`` for ``create_app``.
+
+    python benchmarks/startup.py --runs 5 --imports 15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SDKS = ('openai', 'httpx', 'google.generativeai')
+
+
+def child():
+    timings = {}
+    started = time.perf_counter()
+
+    def phase(name):
+        nonlocal started
+        now = time.perf_counter()
+        timings[name] = round((now - started) * 1000, 1)
+        started = now
+
+    import flask  # noqa: F401
+    import flask_cors  # noqa: F401
+    import flask_login  # noqa: F401
+    import flask_sqlalchemy  # noqa: F401
+    import flask_wtf  # noqa: F401
+    phase('import_flask')
+
+    import app
+    from app import migrations, providers
+    phase('import_app')
+
+    flask_app = app.create_app()
+    phase('create_app')
+
+    flask_app.test_client().get('/health')
+    phase('first_request')
+    loaded = {name: name in sys.modules for name in SDKS}
+
+    providers.client('openai_client')
+    phase('openai_client')
+    providers.client('gemini_client')
+    phase('gemini_client')
+
+    with flask_app.app_context():
+        migrations.migrate()
+        phase('migrate_empty')
+        migrations.migrate()
+        phase('migrate_current')
+    print(json.dumps({'phases_ms': timings, 'sdks_loaded_at_first_request': loaded}))
+
+
+def run_child(env):
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+def interpreter_ms():
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    return (time.perf_counter() - started) * 1000
+
+
+def slowest_imports(env, count):
+    """Return the ``count`` modules with the largest cumulative import time under ``create_app``."""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app; app.create_app()'],
+                            env=env, capture_output=True, text=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = (part.strip() for part in line[len('import time:'):].split('|'))
+        if not module.startswith(' '):
+            rows.append((int(cumulative), module.strip()))
+    rows.sort(reverse=True)
+    return [{'module': module, 'cumulative_ms': round(us / 1000, 1)} for us, module in rows[:count]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--imports', type=int, default=0, help='list this many of the slowest imports')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child()
+
+    workdir = tempfile.mkdtemp(prefix='startup-')
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONWARNINGS='ignore')
+    env.setdefault('OPENAI_API_KEY', 'bench-key')
+    env.setdefault('GEMINI_API_KEY', 'bench-key')
+    for name in ('COMPLETION_CACHE_PATH', 'SINGLE_FLIGHT_PATH', 'USER_VERSIONS_PATH', 'RATE_LIMIT_PATH',
+                 'QUOTA_PATH', 'METRICS_PATH', 'PERSIST_JOURNAL_PATH', 'STT_CACHE_PATH', 'JOBS_PATH'):
+        env[name] = os.path.join(workdir, name.lower() + '.sqlite3')
+
+    runs = []
+    for index in range(args.runs):
+        env['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, f'run{index}.sqlite3')
+        runs.append(run_child(env))
+    phases = {name: statistics.median(run['phases_ms'][name] for run in runs) for name in runs[0]['phases_ms']}
+    result = {
+        'runs': args.runs,
+        'python': sys.version.split()[0],
+        'interpreter_ms': round(statistics.median(interpreter_ms() for _ in range(args.runs)), 1),
+        'process_ms': statistics.median(run['process_ms'] for run in runs),
+        'ready_ms': round(sum(phases[name] for name in ('import_flask', 'import_app', 'create_app',
+                                                        'first_request')), 1),
+        'phases_ms': phases,
+        'sdks_loaded_at_first_request': runs[0]['sdks_loaded_at_first_request'],
+    }
+    if args.imports:
+        result['slowest_imports'] = slowest_imports(env, args.imports)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
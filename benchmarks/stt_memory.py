@@ -0,0 +1,205 @@
+"""Peak server memory for one ``/voice/stt`` upload, per audio size.
+
+Every measurement runs the Flask app in a fresh server process, logs in and
+then streams a generated WAV file of ``--sizes`` megabytes to ``/voice/stt``
+from this process, so the client's copy of the upload is not counted. A fake
+Whisper client reads the file in chunks the way the OpenAI SDK does. The
+server samples its RSS (Linux ``/proc``) before and during the upload, and each run
+prints one JSON object per line. ``--read-copy`` also measures the old
+handler, which read the upload into memory and copied it into a BytesIO.
+
+    python benchmarks/stt_memory.py --sizes 1,10,24
+"""
+import argparse
+import gc
+import http.client
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import wave
+from types import SimpleNamespace
+from unittest.mock import patch
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+BOUNDARY = 'stt-memory-benchmark'
+READ_CHUNK = 64 * 1024
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+class RSSSampler(threading.Thread):
+    """Sample the current RSS every few milliseconds and keep the peak.
+
+    Import-time allocations push the process high-water mark above a single
+    request, so the peak is taken from samples rather than ``VmHWM``.
+    """
+
+    def __init__(self, interval=0.002):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = rss_kb()
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, rss_kb())
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.peak = max(self.peak, rss_kb())
+        return self.peak
+
+
+class FakeTranscriptions:
+    def create(self, model, file, **kwargs):
+        _, stream = file if isinstance(file, tuple) else (None, file)
+        size = 0
+        for chunk in iter(lambda: stream.read(READ_CHUNK), b''):
+            size += len(chunk)
+        return SimpleNamespace(text=f'{size} bytes')
+
+
+def read_copy_upload(audio_file):
+    buffer = io.BytesIO(audio_file.read())
+    buffer.name = 'audio.webm'
+    return buffer
+
+
+def serve(read_copy):
+    """Child process: serve login plus one upload, then print peak RSS."""
+    workdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.sqlite3')
+    os.environ['STT_CACHE_PATH'] = os.path.join(workdir, 'transcripts.sqlite3')
+    os.environ['STT_MAX_SECONDS'] = str(10 ** 6)
+    os.environ.setdefault('OPENAI_API_KEY', 'bench-key')
+    os.environ.pop('GEMINI_API_KEY', None)
+    sys.path.insert(0, ROOT)
+
+    from werkzeug.serving import make_server
+
+    from app import create_app, db
+    from app.models import User
+
+    flask_app = create_app()
+    flask_app.config['WTF_CSRF_ENABLED'] = False
+    with flask_app.app_context():
+        db.create_all()
+        user = User(name='Bench', email='bench@example.com', phone='0000000000')
+        user.set_password('password')
+        db.session.add(user)
+        db.session.commit()
+
+    server = make_server('127.0.0.1', 0, flask_app)
+    print(server.server_port, flush=True)
+    fake = SimpleNamespace(audio=SimpleNamespace(transcriptions=FakeTranscriptions()))
+    patches = [patch('app.providers.openai_client', fake)]
+    if read_copy:
+        patches.append(patch('app.routes.upload_file', read_copy_upload))
+    for p in patches:
+        p.start()
+
+    server.handle_request()  # login
+    gc.collect()
+    before = rss_kb()
+    sampler = RSSSampler()
+    sampler.start()
+    server.handle_request()  # upload
+    print(json.dumps({'rss_before_kb': before, 'rss_peak_kb': sampler.stop()}), flush=True)
+
+
+def write_wav(path, megabytes):
+    rate = 16000
+    frames = megabytes * 1024 * 1024 // 2
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        silence = b'\x00' * (rate * 2)
+        for start in range(0, frames, rate):
+            f.writeframes(silence[:(min(rate, frames - start)) * 2])
+
+
+def upload(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    conn.request('POST', '/login', body=json.dumps({'email_or_phone': 'bench@example.com',
+                                                     'password': 'password'}),
+                 headers={'Content-Type': 'application/json'})
+    login = conn.getresponse()
+    login.read()
+    cookie = login.getheader('Set-Cookie').split(';', 1)[0]
+
+    head = (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="audio"; filename="bench.wav"\r\n'
+            f'Content-Type: audio/wav\r\n\r\n').encode()
+    tail = f'\r\n--{BOUNDARY}--\r\n'.encode()
+    length = len(head) + os.path.getsize(path) + len(tail)
+
+    def body():
+        yield head
+        with open(path, 'rb') as f:
+            yield from iter(lambda: f.read(READ_CHUNK), b'')
+        yield tail
+
+    conn.request('POST', '/voice/stt', body=body(), headers={
+        'Content-Type': f'multipart/form-data; boundary={BOUNDARY}',
+        'Content-Length': str(length),
+        'Cookie': cookie,
+    })
+    response = conn.getresponse()
+    payload = json.loads(response.read())
+    conn.close()
+    return response.status, payload
+
+
+def measure(megabytes, read_copy):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.wav')
+        write_wav(path, megabytes)
+        command = [sys.executable, os.path.abspath(__file__), '--serve']
+        if read_copy:
+            command.append('--read-copy')
+        server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True, cwd=ROOT)
+        try:
+            port = int(server.stdout.readline())
+            status, payload = upload(port, path)
+            rss = json.loads(server.stdout.readline())
+        finally:
+            server.wait(timeout=60)
+    return {
+        'mode': 'read-copy' if read_copy else 'spooled',
+        'upload_mb': megabytes,
+        'status': status,
+        'error': payload.get('error'),
+        **rss,
+        'rss_growth_kb': rss['rss_peak_kb'] - rss['rss_before_kb'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1,10,24', help='comma separated upload sizes in MB')
+    parser.add_argument('--read-copy', action='store_true',
+                        help='also measure the old read-and-copy handler')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.read_copy)
+
+    modes = [False, True] if args.read_copy else [False]
+    for read_copy in modes:
+        for megabytes in (int(s) for s in args.sizes.split(',')):
+            print(json.dumps(measure(megabytes, read_copy)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Time to first audio of ``/voice/tts`` against ``/voice/tts/stream``.
+
+Serves the app like ``load.py``, in a child process pointed at
+``mock_provider.MockProvider``. The mock's speech endpoint waits
+``--latency`` seconds, then synthesizes ``--words-per-second``. For each
+text length in ``--sentences`` the script sends ``--requests`` distinct
+texts, one at a time, to each mode:
+
+- ``clip``: ``/voice/tts`` as JSON. The base64 audio is playable only once
+  the whole body has arrived, so first audio is the full response time.
+- ``clip_audio``: ``/voice/tts`` with ``Accept: audio/mpeg``.
+- ``stream``: ``/voice/tts/stream``.
+
+Each result is a JSON line with p50/p99 time to the first audio byte and
+to the end of the audio, in milliseconds.
+
+    python benchmarks/tts_latency.py --sentences 1,5,20 --requests 10
+"""
+import argparse
+import http.client
+import json
+import statistics
+import time
+
+from load import login, percentile, start_server
+from mock_provider import MockProvider
+
+MODES = ('clip', 'clip_audio', 'stream')
+SENTENCE = 'Sentence {index} of reply {reply} reads a handful of words aloud.'
+
+
+def text(reply, sentences):
+    return ' '.join(SENTENCE.format(index=index, reply=reply) for index in range(sentences))
+
+
+def speak(port, cookie, mode, body):
+    """Return ``(seconds to the first audio byte, seconds to the last, audio bytes)``."""
+    path = '/voice/tts/stream' if mode == 'stream' else '/voice/tts'
+    headers = {'Content-Type': 'application/json', 'Cookie': cookie}
+    if mode == 'clip_audio':
+        headers['Accept'] = 'audio/mpeg'
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    started = time.perf_counter()
+    try:
+        conn.request('POST', path, body=json.dumps(body), headers=headers)
+        response = conn.getresponse()
+        if response.status != 200:
+            raise RuntimeError(f'{path} answered {response.status}: {response.read()[:200]!r}')
+        first, size = None, 0
+        while True:
+            chunk = response.read1(65536)
+            if not chunk:
+                break
+            if first is None:
+                first = time.perf_counter() - started
+            size += len(chunk)
+        total = time.perf_counter() - started
+    finally:
+        conn.close()
+    if mode == 'clip':
+        first = total
+    return first, total, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--sentences', default='1,5,20', help='comma-separated text lengths, in sentences')
+    parser.add_argument('--requests', type=int, default=5, help='texts per mode and length')
+    parser.add_argument('--latency', type=float, default=0.3, help='provider seconds before synthesis starts')
+    parser.add_argument('--words-per-second', type=float, default=40.0)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for the server, e.g. TTS_STREAM_WINDOW=4')
+    args = parser.parse_args()
+    args.users = 1
+
+    provider = MockProvider(latency=args.latency, tokens_per_second=args.words_per_second).start()
+    child, port = start_server(args, provider)
+    reply = 0
+    try:
+        cookie = login(port, 0)
+        for sentences in [int(value) for value in args.sentences.split(',') if value.strip()]:
+            for mode in MODES:
+                firsts, totals, sizes = [], [], []
+                for _ in range(args.requests):
+                    reply += 1
+                    first, total, size = speak(port, cookie, mode, {'text': text(reply, sentences)})
+                    firsts.append(first)
+                    totals.append(total)
+                    sizes.append(size)
+                print(json.dumps({
+                    'mode': mode,
+                    'sentences': sentences,
+                    'requests': args.requests,
+                    'first_audio_p50_ms': percentile(firsts, 0.5),
+                    'first_audio_p99_ms': percentile(firsts, 0.99),
+                    'complete_p50_ms': percentile(totals, 0.5),
+                    'response_kb': round(statistics.fmean(sizes) / 1024, 1),
+                }), flush=True)
+    finally:
+        child.terminate()
+        child.wait(timeout=30)
+        provider.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+"""Gunicorn hooks; gunicorn reads this file from the working directory.
+
+With ``--preload`` the master builds the app once and forks its workers
+from it. The provider SDKs are imported lazily, so the master imports
+them here as well, before the fork, rather than leaving every worker to
+import its own copy. ``gc.freeze`` then moves the master's objects out of
+the collector's reach, so a worker's collections do not write to the
+shared pages and copy them.
+
+The master records its pid so that ``PROVIDER_PREWARM`` leaves pre-warming
+to the workers instead of running in the master while it forks.
+"""
+import gc
+import os
+
+os.environ['GUNICORN_MASTER_PID'] = str(os.getpid())
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    from app import providers
+    providers.import_sdks()
+    gc.freeze()
@@ -3,4 +3,7 @@ from app import create_app
 app = create_app()
 
 if __name__ == '__main__':
+    from app.migrations import migrate
+    with app.app_context():
+        migrate()
     app.run(host='0.0.0.0', port=5000, debug=True)
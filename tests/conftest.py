@@ -14,13 +14,31 @@ from app import create_app, db as flask_db
 from app.models import User
 
 @pytest.fixture
-def app():
+def app(tmp_path):
     app = create_app()
     app.config.update({
         'TESTING': True,
         'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
         'WTF_CSRF_ENABLED': False,  # Disable CSRF for easier testing
-        'SERVER_NAME': 'localhost.localdomain' # helps with url_for
+        'SERVER_NAME': 'localhost.localdomain', # helps with url_for
+        'TTS_CACHE_DIR': str(tmp_path / 'tts_cache'),
+        'IMAGE_CACHE_DIR': str(tmp_path / 'images'),
+        'STT_CACHE_PATH': str(tmp_path / 'transcripts.sqlite3'),
+        'COMPLETION_CACHE_PATH': str(tmp_path / 'completion_cache.sqlite3'),
+        'SINGLE_FLIGHT_PATH': str(tmp_path / 'singleflight.sqlite3'),
+        'PERSIST_JOURNAL_PATH': str(tmp_path / 'turns.sqlite3'),
+        'USER_VERSIONS_PATH': str(tmp_path / 'user_versions.sqlite3'),
+        'RATE_LIMIT_PATH': str(tmp_path / 'ratelimits.sqlite3'),
+        'QUOTA_PATH': str(tmp_path / 'quotas.sqlite3'),
+        'METRICS_PATH': str(tmp_path / 'metrics.sqlite3'),
+        'METRICS_PUSH_INTERVAL': 0,
+        'PROFILE_DIR': str(tmp_path / 'profiles'),
+        'JOBS_PATH': str(tmp_path / 'jobs.sqlite3'),
+        # Tests run jobs with ``job_runner().work()``.
+        'JOBS_WORKERS': 0,
+        # Write turns inline so tests see them; the background writer has its own tests.
+        'PERSIST_WRITE_BEHIND': False,
+        'USAGE_WRITE_BEHIND': False
     })
 
     with app.app_context():
@@ -1,6 +1,12 @@
 import pytest
 from unittest.mock import patch, MagicMock
 import io
+import threading
+import time
+import wave
+
+from app.audioinfo import audio_duration
+from app.media import speech_segments
 
 def test_chat_success(auth_client):
     with patch('app.openai_client.chat.completions.create') as mock_create:
@@ -43,7 +49,7 @@ def test_chat_invalid_model(auth_client):
     assert b"Invalid model" in response.data
 
 def test_voice_tts(auth_client):
-    with patch('app.routes.openai_client.audio.speech.create') as mock_create:
+    with patch('app.providers.openai_client.audio.speech.create') as mock_create:
         mock_response = MagicMock()
         mock_response.content = b"fake_audio_bytes"
         mock_create.return_value = mock_response
@@ -62,7 +68,7 @@ def test_voice_tts(auth_client):
         mock_create.assert_called_once()
 
 def test_voice_stt(auth_client):
-    with patch('app.routes.openai_client.audio.transcriptions.create') as mock_create:
+    with patch('app.providers.openai_client.audio.transcriptions.create') as mock_create:
         mock_create.return_value = MagicMock(text="Transcribed text")
 
         data = {
@@ -78,15 +84,15 @@ def test_voice_stt(auth_client):
         mock_create.assert_called_once()
 
 def test_image_generate(auth_client):
-    with patch('app.routes.genai.GenerativeModel') as mock_genai:
+    with patch('app.providers.model') as mock_model:
         mock_response = MagicMock()
         mock_candidate = MagicMock()
         mock_part = MagicMock()
-        mock_part.inline_data.data = b"fake_image_bytes"
+        mock_part.inline_data.data = b"\xff\xd8\xff" + b"fake_image_bytes"
         mock_part.inline_data.mime_type = "image/jpeg"
         mock_candidate.content.parts = [mock_part]
         mock_response.candidates = [mock_candidate]
-        mock_genai.return_value.generate_content.return_value = mock_response
+        mock_model.return_value.generate_content.return_value = mock_response
 
         response = auth_client.post('/image/generate', json={
             'prompt': 'A cute cat'
@@ -95,9 +101,22 @@ def test_image_generate(auth_client):
         assert response.status_code == 200
         data = response.get_json()
         assert data['success'] is True
-        assert 'image' in data
+        assert data['cached'] is False
         assert data['prompt'] == 'A cute cat'
 
+        repeat = auth_client.post('/image/generate', json={'prompt': 'A cute cat'}).get_json()
+        assert repeat['cached'] is True
+        assert repeat['url'] == data['url']
+        assert mock_model.return_value.generate_content.call_count == 1
+
+    image = auth_client.get(data['url'])
+    assert image.status_code == 200
+    assert image.mimetype == 'image/jpeg'
+    assert image.data == b"\xff\xd8\xff" + b"fake_image_bytes"
+    assert 'immutable' in image.headers['Cache-Control']
+    assert auth_client.get(data['url'], headers={'If-None-Match': image.headers['ETag']}).status_code == 304
+    image.close()
+
 def test_image_generate_unavailable(auth_client, app):
     with app.app_context():
         app.config['NANO_BANANA_AVAILABLE'] = False
@@ -129,3 +148,234 @@ def test_gemini_chat_stream_success(auth_client):
         assert response.mimetype == 'text/event-stream'
         lines = response.data.decode().split('\n')
         assert any("API key not valid" in line for line in lines)
+
+def _save_history(db, user, count):
+    from app.chat import record_turn
+    for i in range(count):
+        record_turn(user.id, None, [], [
+            {"role": "user", "content": f"Question {i}"},
+            {"role": "assistant", "content": f"Answer {i}"}
+        ])
+
+def test_chat_history_summary_pagination(auth_client, db, user):
+    _save_history(db, user, 5)
+
+    response = auth_client.get('/api/chat/history?view=summary&limit=2')
+    assert response.status_code == 200
+    page = response.get_json()
+    assert [item['title'] for item in page['items']] == ["Question 4", "Question 3"]
+    assert page['items'][0]['message_count'] == 2
+    assert 'conversation' not in page['items'][0]
+
+    titles = [item['title'] for item in page['items']]
+    while page['next_cursor']:
+        page = auth_client.get(f"/api/chat/history?view=summary&limit=2&cursor={page['next_cursor']}").get_json()
+        titles += [item['title'] for item in page['items']]
+    assert titles == [f"Question {i}" for i in range(4, -1, -1)]
+
+def test_chat_history_entry(auth_client, db, user):
+    _save_history(db, user, 1)
+    entry_id = auth_client.get('/api/chat/history?view=summary').get_json()['items'][0]['id']
+
+    response = auth_client.get(f'/api/chat/history/{entry_id}')
+    assert response.status_code == 200
+    assert response.get_json()['conversation'][1]['content'] == "Answer 0"
+
+    assert auth_client.get('/api/chat/history/9999').status_code == 404
+
+def test_chat_history_invalid_cursor(auth_client):
+    response = auth_client.get('/api/chat/history?view=summary&cursor=not-a-cursor')
+    assert response.status_code == 400
+
+def test_chat_appends_to_existing_conversation(auth_client, db):
+    from app.models import Conversation, Message
+    with patch('app.openai_client.chat.completions.create') as mock_create:
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock(message=MagicMock(content="First answer"))]
+        mock_response.usage = None
+        mock_create.return_value = mock_response
+        first = auth_client.post('/api/chat', json={'message': 'Hello', 'model': 'gpt-4o'}).get_json()
+
+        mock_response.choices = [MagicMock(message=MagicMock(content="Second answer"))]
+        # A client resending the whole history lands in the same conversation.
+        second = auth_client.post('/api/chat', json={
+            'message': 'And then?',
+            'model': 'gpt-4o',
+            'messages': first['conversation']
+        }).get_json()
+        third = auth_client.post('/api/chat', json={
+            'message': 'Thanks',
+            'model': 'gpt-4o',
+            'conversation_id': first['conversation_id']
+        }).get_json()
+
+    assert first['conversation_id'] == second['conversation_id'] == third['conversation_id']
+    assert Conversation.query.count() == 1
+    assert [m.seq for m in Message.query.order_by(Message.seq)] == list(range(6))
+    assert Conversation.query.one().message_count == 6
+
+def test_chat_unknown_conversation(auth_client):
+    response = auth_client.post('/api/chat', json={
+        'message': 'Hello',
+        'model': 'gpt-4o',
+        'conversation_id': 9999
+    })
+    assert response.status_code == 404
+
+def test_chat_with_server_held_history(auth_client, db):
+    from app import metrics
+    from app.models import Conversation
+    with patch('app.openai_client.chat.completions.create') as mock_create:
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock(message=MagicMock(content="First answer"))]
+        mock_response.usage = None
+        mock_create.return_value = mock_response
+        first = auth_client.post('/api/chat', json={'message': 'Hello', 'model': 'gpt-4o'}).get_json()
+
+        hits = metrics.value('conversation_cache_requests_total', result='hit')
+        mock_response.choices = [MagicMock(message=MagicMock(content="Second answer"))]
+        second = auth_client.post('/api/chat', json={
+            'message': 'And then?',
+            'model': 'gpt-4o',
+            'conversation_id': first['conversation_id']
+        }).get_json()
+        assert metrics.value('conversation_cache_requests_total', result='hit') == hits + 1
+
+        # Another worker appends a turn; the stale hot copy is reloaded.
+        conversation = Conversation.query.get(first['conversation_id'])
+        conversation.append([{"role": "user", "content": "Elsewhere"}, {"role": "assistant", "content": "Noted"}])
+        db.session.commit()
+        auth_client.post('/api/chat', json={
+            'message': 'Last one',
+            'model': 'gpt-4o',
+            'conversation_id': first['conversation_id']
+        })
+
+    assert 'conversation' not in second
+    assert second['response'] == "Second answer"
+    assert [m['content'] for m in mock_create.call_args_list[1][1]['messages']] == [
+        'Hello', 'First answer', 'And then?']
+    assert [m['content'] for m in mock_create.call_args[1]['messages']][-4:] == [
+        'Second answer', 'Elsewhere', 'Noted', 'Last one']
+
+def test_chat_body_limit(auth_client, app):
+    app.config['CHAT_MAX_BODY_BYTES'] = 100
+    response = auth_client.post('/api/chat', json={'message': 'x' * 200, 'model': 'gpt-4o'})
+    assert response.status_code == 413
+    assert 'error' in response.get_json()
+
+def test_voice_tts_cached_raw_audio(auth_client):
+    with patch('app.providers.openai_client.audio.speech.create') as mock_create:
+        mock_create.return_value = MagicMock(content=b"0123456789")
+        body = {'text': 'Hello world', 'voice': 'alloy', 'speed': 1.0}
+
+        first = auth_client.post('/voice/tts', json=body).get_json()
+        raw = auth_client.post('/voice/tts', json=body, headers={'Accept': 'audio/mpeg'})
+
+        assert mock_create.call_count == 1
+        assert first['cached'] is False
+        assert raw.status_code == 200
+        assert raw.mimetype == 'audio/mpeg'
+        assert raw.data == b"0123456789"
+        raw.close()
+
+        ranged = auth_client.get(first['url'], headers={'Range': 'bytes=2-5'})
+        assert ranged.status_code == 206
+        assert ranged.data == b"2345"
+        assert 'immutable' in ranged.headers['Cache-Control']
+        ranged.close()
+
+    assert auth_client.get('/voice/tts/audio/' + '0' * 64).status_code == 404
+
+def test_voice_tts_stream_sends_segments_in_order(auth_client, app):
+    app.config.update(TTS_STREAM_SEGMENT_CHARS=40, TTS_STREAM_FIRST_CHARS=20, TTS_STREAM_WINDOW=2)
+    lock = threading.Lock()
+    running = {'now': 0, 'peak': 0}
+
+    def create(**kwargs):
+        with lock:
+            running['now'] += 1
+            running['peak'] = max(running['peak'], running['now'])
+        # Later segments finish first, so the order comes from the server.
+        time.sleep(0.05 if kwargs['input'].startswith('One') else 0.01)
+        with lock:
+            running['now'] -= 1
+        return MagicMock(content=f"<{kwargs['input']}>".encode())
+
+    text = 'One short. Two is a little longer. Three, and four. Five!'
+    with patch('app.providers.openai_client.audio.speech.create', side_effect=create):
+        response = auth_client.post('/voice/tts/stream', json={'text': text})
+        assert response.status_code == 200
+        assert response.mimetype == 'audio/mpeg'
+        assert response.is_streamed
+        assert response.get_data() == b'<One short.><Two is a little longer. Three, and four.><Five!>'
+    assert response.headers['X-TTS-Segments'] == '3'
+    assert running['peak'] == 2
+
+    # Segments are cached like whole clips.
+    with patch('app.providers.openai_client.audio.speech.create') as mock_create:
+        assert auth_client.post('/voice/tts/stream', json={'text': text}).get_data().startswith(b'<One short.>')
+    mock_create.assert_not_called()
+
+    with patch('app.providers.openai_client.audio.speech.create', side_effect=RuntimeError('upstream down')):
+        failed = auth_client.post('/voice/tts/stream', json={'text': 'Something new.'})
+    assert failed.status_code == 500
+    assert failed.get_json() == {'error': 'upstream down'}
+    assert auth_client.post('/voice/tts/stream', json={'text': '  '}).status_code == 400
+
+def test_speech_segments():
+    text = 'Hi. She said "stop." Then, after a long pause, she left the room; nobody followed her out.'
+    assert speech_segments(text, 40, 10) == [
+        'Hi.', 'She said "stop."', 'Then, after a long pause,', 'she left the room;', 'nobody followed her out.'
+    ]
+    assert speech_segments('x' * 25, 10, 10) == ['x' * 10, 'x' * 10, 'x' * 5]
+    assert speech_segments('', 40, 10) == []
+
+def _wav(seconds, rate=8000):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(1)
+        f.setframerate(rate)
+        f.writeframes(b'\x80' * int(seconds * rate))
+    buffer.seek(0)
+    return buffer
+
+def test_voice_stt_duplicate_audio_is_cached(auth_client):
+    with patch('app.providers.openai_client.audio.transcriptions.create') as mock_create:
+        mock_create.return_value = MagicMock(text="Transcribed text")
+
+        first = auth_client.post('/voice/stt', data={'audio': (_wav(1), 'a.wav')},
+                                 content_type='multipart/form-data').get_json()
+        second = auth_client.post('/voice/stt', data={'audio': (_wav(1), 'b.wav')},
+                                  content_type='multipart/form-data').get_json()
+
+        assert mock_create.call_count == 1
+        filename, stream = mock_create.call_args.kwargs['file']
+        assert filename == 'audio.wav'
+        assert first['cached'] is False
+        assert second == {'text': "Transcribed text", 'language': 'en', 'cached': True}
+
+def test_voice_stt_limits(auth_client, app):
+    app.config['STT_MAX_SECONDS'] = 2
+    with patch('app.providers.openai_client.audio.transcriptions.create') as mock_create:
+        response = auth_client.post('/voice/stt', data={'audio': (_wav(3), 'long.wav')},
+                                    content_type='multipart/form-data')
+        assert response.status_code == 413
+
+        app.config['STT_MAX_BYTES'] = 100
+        response = auth_client.post('/voice/stt', data={'audio': (_wav(1), 'big.wav')},
+                                    content_type='multipart/form-data')
+        assert response.status_code == 413
+
+        app.config['MAX_CONTENT_LENGTH'] = 1000
+        response = auth_client.post('/voice/stt', data={'audio': (_wav(1), 'big.wav')},
+                                    content_type='multipart/form-data')
+        assert response.status_code == 413
+        assert 'error' in response.get_json()
+
+        mock_create.assert_not_called()
+
+def test_audio_duration():
+    assert audio_duration(_wav(1.5)) == pytest.approx(1.5)
+    assert audio_duration(io.BytesIO(b"fake_audio_content")) is None
@@ -96,3 +96,82 @@ def test_protected_routes(client):
     response = client.get('/logout')
     assert response.status_code == 302
     assert '/login' in response.location
+
+def test_login_throttled_before_hashing(app, client, user):
+    from unittest.mock import patch
+    app.config.update(LOGIN_ACCOUNT_BURST=2)
+    for _ in range(2):
+        response = client.post('/login', json={'email_or_phone': 'test@example.com', 'password': 'wrong'})
+        assert response.status_code == 401
+
+    with patch.object(User, 'check_password') as check:
+        response = client.post('/login', json={'email_or_phone': 'TEST@example.com', 'password': 'password'})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    check.assert_not_called()
+
+    # Other accounts from the same address are unaffected.
+    response = client.post('/login', json={'email_or_phone': 'other@example.com', 'password': 'password'})
+    assert response.status_code == 401
+
+def test_login_address_bucket_uses_forwarded_for(app, client, user):
+    app.config.update(LOGIN_IP_BURST=1, TRUSTED_PROXY_HOPS=1)
+
+    def login(forwarded_for):
+        return client.post('/login', json={'email_or_phone': 'nobody@example.com', 'password': 'wrong'},
+                           headers={'X-Forwarded-For': forwarded_for})
+
+    assert login('203.0.113.1').status_code == 401
+    assert login('203.0.113.1').status_code == 429
+    # Another client behind the same proxy has its own bucket...
+    assert login('203.0.113.2').status_code == 401
+    # ...and a client cannot pick one by prepending addresses the proxy did not add.
+    assert login('198.51.100.7, 203.0.113.1').status_code == 429
+
+def test_login_busy_hasher(client, user):
+    from unittest.mock import patch
+    from app.auth import HashingBusy
+    with patch.object(User, 'check_password', side_effect=HashingBusy):
+        response = client.post('/login', json={'email_or_phone': 'test@example.com', 'password': 'password'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+def test_login_rehashes_old_parameters(app, client, db):
+    from werkzeug.security import generate_password_hash
+    user = User(name="Old Hash", email="old@example.com", phone="5555555555")
+    user.password_hash = generate_password_hash('password', 'pbkdf2:sha256:1000')
+    db.session.add(user)
+    db.session.commit()
+
+    response = client.post('/login', json={'email_or_phone': 'old@example.com', 'password': 'password'})
+    assert response.status_code == 200
+    db.session.refresh(user)
+    assert user.password_hash.startswith('scrypt:')
+    assert user.check_password('password')
+
+def test_login_succeeds_when_rehash_is_busy(app, client, db):
+    from unittest.mock import patch
+    from werkzeug.security import generate_password_hash
+    from app.auth import HashingBusy, PasswordHasher
+    user = User(name="Old Hash", email="old@example.com", phone="5555555555")
+    user.password_hash = generate_password_hash('password', 'pbkdf2:sha256:1000')
+    db.session.add(user)
+    db.session.commit()
+
+    with patch.object(PasswordHasher, 'hash', side_effect=HashingBusy):
+        response = client.post('/login', json={'email_or_phone': 'old@example.com', 'password': 'password'})
+    assert response.status_code == 200
+    db.session.refresh(user)
+    assert user.password_hash.startswith('pbkdf2:')
+
+def test_token_buckets_refill(tmp_path, monkeypatch):
+    from app import limits
+    buckets = limits.TokenBuckets(str(tmp_path / 'buckets.sqlite3'))
+    now = [1000.0]
+    monkeypatch.setattr(limits.time, 'time', lambda: now[0])
+    assert buckets.take('k', 2, 10) == 0
+    assert buckets.take('k', 2, 10) == 0
+    assert buckets.take('k', 2, 10) == 5
+    now[0] += 5
+    assert buckets.take('k', 2, 10) == 0
+    assert limits.retry_after(0.2) == '1'
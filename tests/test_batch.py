@@ -0,0 +1,83 @@
+import json
+import threading
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from app.gateway import create_asgi_app
+from app.models import UsageRecord
+from test_gateway import login, request
+
+
+def _completion(text):
+    response = MagicMock()
+    response.choices = [MagicMock(message=MagicMock(content=text))]
+    response.usage.prompt_tokens = 10
+    response.usage.completion_tokens = 5
+    response.usage.total_tokens = 15
+    return response
+
+
+def _lines(data):
+    return {line['index']: line for line in map(json.loads, data.decode().splitlines())}
+
+
+def test_batch_streams_each_item_and_isolates_failures(app, auth_client):
+    app.config['BATCH_CONCURRENCY'] = 2
+    lock = threading.Lock()
+    running = {'now': 0, 'peak': 0}
+
+    def create(**kwargs):
+        prompt = kwargs['messages'][-1]['content']
+        with lock:
+            running['now'] += 1
+            running['peak'] = max(running['peak'], running['now'])
+        try:
+            time.sleep(0.05)
+            if prompt == 'boom':
+                raise RuntimeError('upstream failed')
+            return _completion(prompt.upper())
+        finally:
+            with lock:
+                running['now'] -= 1
+
+    items = [{'id': f'job-{n}', 'message': f'prompt {n}'} for n in range(4)]
+    items += [{'message': 'boom'}, {'message': 'x', 'model': 'nope'}, {'model': 'gpt-4o'}]
+    with patch('app.openai_client.chat.completions.create', side_effect=create):
+        response = auth_client.post('/api/chat/batch', json={'items': items})
+        lines = _lines(response.get_data())
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert sorted(lines) == list(range(7))
+    assert lines[0] == {**lines[0], 'id': 'job-0', 'status': 200, 'response': 'PROMPT 0', 'cached': False}
+    assert lines[4]['status'] == 500 and 'upstream failed' in lines[4]['error']
+    assert lines[5]['status'] == 400 and lines[6]['status'] == 400
+    assert running['peak'] == 2
+
+    records = UsageRecord.query.filter_by(endpoint='chat_batch').all()
+    assert len(records) == 4 and all(r.total_tokens == 15 for r in records)
+
+
+def test_batch_rejects_bad_bodies(app, auth_client):
+    app.config['BATCH_MAX_ITEMS'] = 2
+    assert auth_client.post('/api/chat/batch', json={'items': []}).status_code == 400
+    assert auth_client.post('/api/chat/batch', json={'items': [{'message': 'a'}] * 3}).status_code == 400
+
+
+def test_gateway_batch(app, user):
+    asgi_app = create_asgi_app(app)
+    cookie = login(asgi_app)
+    mock_client = MagicMock()
+    mock_client.chat.completions.create = AsyncMock(
+        side_effect=lambda **kwargs: _completion(kwargs['messages'][-1]['content'] + '!'))
+
+    with patch('app.providers.async_openai_client', mock_client):
+        status, headers, content = request(asgi_app, 'POST', '/api/chat/batch', {
+            'items': [{'message': 'one'}, {'message': 'two', 'model': 'nope'}, {'message': 'three'}]
+        }, cookie)
+
+    assert status == 200
+    assert headers['content-type'].startswith('application/x-ndjson')
+    lines = _lines(content)
+    assert [lines[i]['status'] for i in range(3)] == [200, 400, 200]
+    assert lines[2]['response'] == 'three!'
@@ -0,0 +1,132 @@
+import json
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app import metrics
+from app.cache import LRUCache, SQLiteCache, TieredCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache(max_entries=2, ttl=60)
+    cache.set('a', 1, ttl=-1)
+    assert cache.get('a') is None
+
+
+def test_sqlite_cache_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'shared.sqlite3')
+    first = SQLiteCache(path, max_entries=2, ttl=60)
+    second = SQLiteCache(path, max_entries=2, ttl=60)
+
+    first.set('a', {'response': 'cached'})
+    assert second.get('a') == {'response': 'cached'}
+
+    time.sleep(0.01)
+    second.set('b', 2)
+    time.sleep(0.01)
+    second.set('c', 3)
+    assert first.get('a') is None
+    assert first.get('c') == 3
+
+
+def test_tiered_cache_promotes_shared_hits(tmp_path):
+    shared = SQLiteCache(str(tmp_path / 'shared.sqlite3'), max_entries=10, ttl=60)
+    writer = TieredCache(LRUCache(10, 60), shared)
+    reader = TieredCache(LRUCache(10, 60), shared)
+
+    writer.set('key', 'value')
+    assert reader.get('key') == ('value', 'shared')
+    assert reader.get('key') == ('value', 'local')
+    assert reader.get('missing') == (None, None)
+
+
+@pytest.fixture
+def cached_app(app, tmp_path):
+    app.config['COMPLETION_CACHE_ENABLED'] = True
+    app.config['COMPLETION_CACHE_PATH'] = str(tmp_path / 'completions.sqlite3')
+    app.extensions.pop('completion_cache', None)
+    return app
+
+
+def test_chat_served_from_cache(cached_app, auth_client):
+    with patch('app.openai_client.chat.completions.create') as mock_create:
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock(message=MagicMock(content="Hello there!"))]
+        mock_response.usage = None
+        mock_create.return_value = mock_response
+
+        hits = metrics.value('completion_cache_requests_total', result='hit', tier='local')
+        first = auth_client.post('/api/chat', json={'message': 'Hello', 'model': 'gpt-4o'}).get_json()
+        second = auth_client.post('/api/chat', json={'message': 'Hello', 'model': 'gpt-4o'}).get_json()
+        bypass = auth_client.post('/api/chat', json={'message': 'Hello', 'model': 'gpt-4o',
+                                                     'cache': False}).get_json()
+
+    assert first['cached'] is False
+    assert second['cached'] is True
+    assert second['response'] == "Hello there!"
+    assert bypass['cached'] is False
+    assert mock_create.call_count == 2
+    assert metrics.value('completion_cache_requests_total', result='hit', tier='local') == hits + 1
+    cached_app.config['ADMIN_EMAILS'] = {'test@example.com'}
+    assert b'completion_cache_requests_total' in auth_client.get('/metrics').data
+
+
+def test_chat_stream_replays_cached_answer(cached_app, auth_client):
+    with patch('app.openai_client.chat.completions.create') as mock_create:
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock(message=MagicMock(content="A cached answer"))]
+        mock_response.usage = None
+        mock_create.return_value = mock_response
+        auth_client.post('/api/chat', json={'message': 'Hello', 'model': 'gpt-4o'})
+
+        response = auth_client.post('/api/chat/stream', json={'message': 'Hello', 'model': 'gpt-4o'})
+
+    events = [json.loads(line[6:]) for line in response.data.decode().split('\n') if line.startswith('data: ')]
+    assert events[0] == {'cached': True}
+    assert ''.join(e.get('content', '') for e in events) == "A cached answer"
+    assert events[-1] == {'done': True}
+    assert mock_create.call_count == 1
+
+
+def test_blob_store_evicts_least_recently_read(tmp_path):
+    import os
+    from app.blobstore import BlobStore, content_key
+
+    store = BlobStore(str(tmp_path), max_bytes=10)
+    a, b, c = content_key('a'), content_key('b'), content_key('c')
+    store.put(a, b'12345')
+    store.put(b, b'12345')
+    os.utime(store.path(a), (1, 1))
+    os.utime(store.path(b), (2, 2))
+    assert store.get(a) is not None  # reading refreshes a
+    store.put(c, b'12345')
+
+    assert store.get(b) is None
+    assert open(store.get(a), 'rb').read() == b'12345'
+    assert store.get(c) is not None
+
+
+def test_blob_store_sweeps_only_past_its_cap(tmp_path):
+    from unittest.mock import patch
+    from app.blobstore import BlobStore, content_key
+
+    store = BlobStore(str(tmp_path), max_bytes=20)
+    with patch.object(BlobStore, 'evict', autospec=True, side_effect=BlobStore.evict) as evict:
+        for i in range(4):
+            store.put(content_key(str(i)), b'12345')
+        assert evict.call_count == 1  # the first write seeds the total
+        store.put(content_key('4'), b'12345')
+        assert evict.call_count == 2
+    assert sum(store.get(content_key(str(i))) is not None for i in range(5)) == 4
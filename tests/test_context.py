@@ -0,0 +1,78 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app import context
+
+
+def _conversation(turns, words=50):
+    messages = [{"role": "system", "content": "You are terse."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " + "word " * words})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "word " * words})
+    messages.append({"role": "user", "content": "latest question"})
+    return messages
+
+
+def test_token_counts_are_cached_per_message(monkeypatch):
+    calls = []
+    estimate = context.text_tokens
+    monkeypatch.setattr(context, 'text_tokens', lambda encoding, text: calls.append(text) or estimate(encoding, text))
+    message = {"role": "user", "content": "cache me please"}
+    first = context.count_tokens('gpt-4o', [message])
+    calls.clear()
+    assert context.count_tokens('gpt-4o', [dict(message)]) == first
+    assert calls == []
+
+
+@pytest.mark.parametrize('strategy', ['window', 'pinned', 'summary'])
+def test_trim_fits_budget_and_keeps_latest_turn(strategy):
+    messages = _conversation(200)
+    kept, before, after = context.trim('gpt-4o', messages, 2000, strategy, summary_tokens=300)
+
+    assert before > 2000 >= after == context.count_tokens('gpt-4o', kept)
+    assert kept[-1] == messages[-1]
+    assert kept[-2]['content'].startswith('answer 199')
+    assert (kept[0] == messages[0]) == (strategy != 'window')
+    if strategy == 'summary':
+        summary = kept[1]['content']
+        assert summary.startswith(context.SUMMARY_HEADER)
+        assert 'question' in summary
+
+
+def test_trim_drops_orphaned_reply_and_leaves_short_chats_alone():
+    messages = _conversation(3)
+    assert context.trim('gpt-4o', messages, 10000) == (messages, *[context.count_tokens('gpt-4o', messages)] * 2)
+
+    kept, _, _ = context.trim('gpt-4o', messages, context.count_tokens('gpt-4o', messages[-3:]) + 5, 'window')
+    assert kept[0]['role'] == 'user'
+    with pytest.raises(ValueError):
+        context.trim('gpt-4o', messages, 10, 'truncate')
+
+
+def test_chat_reports_trimmed_prompt_tokens(app, auth_client):
+    app.config['CONTEXT_MAX_TOKENS'] = 1000
+    with patch('app.openai_client.chat.completions.create') as mock_create:
+        mock_create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content="Short"))], usage=None)
+        response = auth_client.post('/api/chat', json={
+            'message': 'latest question',
+            'model': 'gpt-4o',
+            'messages': _conversation(50)[:-1]
+        })
+
+    data = response.get_json()
+    usage = data['usage']
+    assert usage['prompt_tokens_before_trim'] > 1000 >= usage['prompt_tokens_after_trim']
+    sent = mock_create.call_args[1]['messages']
+    assert sent[0]['content'] == "You are terse."
+    assert sent[-1] == {"role": "user", "content": "latest question"}
+    # The stored conversation is untouched by trimming.
+    assert len(data['conversation']) == 103
+
+
+def test_approximate_counts_keep_a_margin(monkeypatch):
+    monkeypatch.setattr(context, 'tiktoken', None)
+    text = '日本語のテキスト' * 10
+    assert context.text_tokens(context.encoding_name('gpt-4o'), text) >= len(text)
+    assert context.budget(['gemini-pro'], 1000, margin=0.1) == int(30720 * 0.9) - 1000
+    assert context.budget(['gpt-4o'], 1000, margin=0.1) == int(128000 * 0.9) - 1000
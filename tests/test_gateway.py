@@ -0,0 +1,243 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from app.gateway import create_asgi_app
+
+
+def serve(coro):
+    """Run ``coro`` on a fresh thread, outside the test's app context, as a server would."""
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+async def _call(asgi_app, method, path, body=b'', headers=()):
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': b'',
+        'http_version': '1.1',
+        'headers': [(k.encode(), v.encode()) for k, v in headers],
+        'server': ('localhost.localdomain', 80),
+        'client': ('127.0.0.1', 1234),
+    }
+    await asgi_app(scope, receive, send)
+    start = sent[0]
+    content = b''.join(m.get('body', b'') for m in sent[1:])
+    return start['status'], dict((k.decode(), v.decode()) for k, v in start['headers']), content
+
+
+def request(asgi_app, method, path, json_body=None, cookie=None):
+    headers = []
+    body = b''
+    if json_body is not None:
+        body = json.dumps(json_body).encode()
+        headers += [('content-type', 'application/json'), ('content-length', str(len(body)))]
+    if cookie:
+        headers.append(('cookie', cookie))
+    return serve(_call(asgi_app, method, path, body, headers))
+
+
+def login(asgi_app):
+    status, headers, _ = request(asgi_app, 'POST', '/login', {
+        'email_or_phone': 'test@example.com',
+        'password': 'password'
+    })
+    assert status == 200
+    return headers['set-cookie'].split(';', 1)[0]
+
+
+def test_gateway_falls_back_to_flask(app):
+    status, _, content = request(create_asgi_app(app), 'GET', '/health')
+    assert status == 200
+    assert json.loads(content)['status'] == 'healthy'
+
+
+def test_gateway_streams_flask_file_responses(app, user):
+    from app.media import image_store
+    asgi_app = create_asgi_app(app)
+    cookie = login(asgi_app)
+    data = b'\xff\xd8\xff' + bytes(range(256)) * 1024
+    key = 'ab' * 32
+    image_store().put(key, data)
+
+    async def call():
+        sent = []
+        scope = {'type': 'http', 'method': 'GET', 'path': f'/image/{key}', 'query_string': b'',
+                 'http_version': '1.1', 'headers': [(b'cookie', cookie.encode())],
+                 'server': ('localhost.localdomain', 80), 'client': ('127.0.0.1', 1234)}
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+        await asgi_app(scope, receive, send)
+        return sent
+
+    sent = serve(call())
+    assert sent[0]['status'] == 200
+    bodies = [message['body'] for message in sent[1:] if message.get('body')]
+    assert len(bodies) > 1
+    assert b''.join(bodies) == data
+    assert sent[-1] == {'type': 'http.response.body'}
+
+
+def test_gateway_requires_login(app):
+    status, headers, _ = request(create_asgi_app(app), 'POST', '/api/chat', {'message': 'Hello'})
+    assert status == 302
+    assert '/login' in headers['location']
+
+
+def test_gateway_chat(app, user):
+    asgi_app = create_asgi_app(app)
+    cookie = login(asgi_app)
+
+    mock_client = MagicMock()
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock(message=MagicMock(content="Hello there!"))]
+    mock_response.usage.prompt_tokens = 10
+    mock_response.usage.completion_tokens = 5
+    mock_response.usage.total_tokens = 15
+    mock_client.chat.completions.create = AsyncMock(return_value=mock_response)
+
+    with patch('app.providers.async_openai_client', mock_client):
+        status, _, content = request(asgi_app, 'POST', '/api/chat', {
+            'message': 'Hello',
+            'model': 'gpt-4o'
+        }, cookie)
+
+    assert status == 200
+    data = json.loads(content)
+    assert data['response'] == "Hello there!"
+    assert data['usage']['total_tokens'] == 15
+    assert mock_client.chat.completions.create.call_args[1]['messages'][0]['content'] == 'Hello'
+
+
+def test_gateway_chat_stream(app, user):
+    asgi_app = create_asgi_app(app)
+    cookie = login(asgi_app)
+
+    async def chunks():
+        for text in ("Hel", "lo"):
+            yield MagicMock(choices=[MagicMock(delta=MagicMock(content=text))], usage=None)
+
+    mock_client = MagicMock()
+    mock_client.chat.completions.create = AsyncMock(return_value=chunks())
+
+    with patch('app.providers.async_openai_client', mock_client):
+        status, headers, content = request(asgi_app, 'POST', '/api/chat/stream', {
+            'message': 'Hello',
+            'model': 'gpt-4o'
+        }, cookie)
+
+    assert status == 200
+    assert headers['content-type'].startswith('text/event-stream')
+    events = [json.loads(line[6:]) for line in content.decode().split('\n') if line.startswith('data: ')]
+    assert [e['content'] for e in events if 'content' in e] == ["Hel", "lo"]
+    assert events[-1] == {'done': True}
+
+
+def test_gateway_rejects_oversized_body(app):
+    app.config['MAX_CONTENT_LENGTH'] = 10
+    status, _, content = serve(_call(create_asgi_app(app), 'POST', '/voice/stt', b'x' * 11,
+                                           [('content-type', 'application/octet-stream')]))
+    assert status == 413
+    assert 'error' in json.loads(content)
+
+
+def test_gateway_coalesces_identical_streams(app, user):
+    asgi_app = create_asgi_app(app)
+    cookie = login(asgi_app)
+
+    async def chunks():
+        for text in ("Hel", "lo"):
+            await asyncio.sleep(0.1)
+            yield MagicMock(choices=[MagicMock(delta=MagicMock(content=text))], usage=None)
+
+    mock_client = MagicMock()
+    mock_client.chat.completions.create = AsyncMock(side_effect=lambda **kwargs: chunks())
+    body = json.dumps({'message': 'Trending', 'model': 'gpt-4o'}).encode()
+    headers = [('content-type', 'application/json'), ('cookie', cookie)]
+
+    async def both():
+        return await asyncio.gather(*(_call(asgi_app, 'POST', '/api/chat/stream', body, headers)
+                                      for _ in range(2)))
+
+    with patch('app.providers.async_openai_client', mock_client):
+        responses = serve(both())
+
+    assert mock_client.chat.completions.create.call_count == 1
+    for status, _, content in responses:
+        assert status == 200
+        events = [json.loads(line[6:]) for line in content.decode().split('\n') if line.startswith('data: ')]
+        assert ''.join(e.get('content', '') for e in events) == "Hello"
+
+
+def test_gateway_applies_chat_body_limit(app):
+    app.config['CHAT_MAX_BODY_BYTES'] = 100
+    body = json.dumps({'message': 'x' * 200}).encode()
+    status, _, _ = serve(_call(create_asgi_app(app), 'POST', '/api/chat', body,
+                                     [('content-type', 'application/json')]))
+    assert status == 413
+
+
+def test_gateway_stream_quota(app, user):
+    from app.quotas import quotas
+    app.config['QUOTA_USER_CONCURRENCY'] = 1
+    asgi_app = create_asgi_app(app)
+    cookie = login(asgi_app)
+
+    async def chunks():
+        yield MagicMock(choices=[MagicMock(delta=MagicMock(content="Hi"))], usage=None)
+
+    mock_client = MagicMock()
+    mock_client.chat.completions.create = AsyncMock(side_effect=lambda **kwargs: chunks())
+
+    with patch('app.providers.async_openai_client', mock_client):
+        held = quotas().admit(user.id, 'gpt-4o', 10)
+        status, headers, _ = request(asgi_app, 'POST', '/api/chat/stream', {'message': 'Hello'}, cookie)
+        assert status == 429
+        assert headers['retry-after'] == '1'
+
+        held.settle(0)
+        status, _, content = request(asgi_app, 'POST', '/api/chat/stream', {'message': 'Hello'}, cookie)
+        assert status == 200
+        assert b'"done": true' in content
+    assert quotas().leases.counts() == {}
+
+
+def test_gateway_tts_stream(app, user):
+    app.config.update(TTS_STREAM_SEGMENT_CHARS=20, TTS_STREAM_FIRST_CHARS=10)
+    asgi_app = create_asgi_app(app)
+    cookie = login(asgi_app)
+
+    async def create(**kwargs):
+        await asyncio.sleep(0.02 if kwargs['input'] == 'First.' else 0)
+        return MagicMock(content=kwargs['input'].encode())
+
+    mock_client = MagicMock()
+    mock_client.audio.speech.create = AsyncMock(side_effect=create)
+
+    with patch('app.providers.async_openai_client', mock_client):
+        status, headers, content = request(asgi_app, 'POST', '/voice/tts/stream', {
+            'text': 'First. Second one. Third one.'
+        }, cookie)
+
+    assert status == 200
+    assert headers['content-type'] == 'audio/mpeg'
+    assert headers['x-tts-segments'] == '3'
+    assert content == b'First.Second one.Third one.'
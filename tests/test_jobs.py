@@ -0,0 +1,99 @@
+import json
+from unittest.mock import MagicMock, patch
+
+from app.gateway import create_asgi_app
+from app.jobs import RUNNING, job_runner
+from test_gateway import login, request
+
+
+def _speech(content=b'ID3fake-mp3'):
+    return MagicMock(content=content)
+
+
+def _events(data):
+    return [json.loads(line[len('data: '):]) for line in data.decode().split('\n\n') if line.startswith('data: ')]
+
+
+def test_tts_job_is_queued_then_run_in_the_background(app, auth_client):
+    response = auth_client.post('/api/jobs', json={'kind': 'tts', 'text': 'A long reply.', 'voice': 'nova'})
+    assert response.status_code == 202
+    job = response.get_json()
+    assert job['state'] == 'queued'
+    assert response.headers['Location'] == job['status_url']
+
+    queued = auth_client.get(job['events_url']).data.decode()
+    assert queued.startswith('retry: ')
+    assert [event['state'] for event in _events(queued.encode().split(b'\n', 1)[1])] == ['queued']
+
+    pending = auth_client.get(job['result_url'])
+    assert pending.status_code == 202
+    assert pending.get_json()['state'] == 'queued'
+
+    with patch('app.providers.openai_client.audio.speech.create', return_value=_speech()) as mock_create:
+        assert job_runner().work() == 1
+    mock_create.assert_called_once()
+    assert mock_create.call_args.kwargs['voice'] == 'nova'
+
+    status = auth_client.get(job['status_url']).get_json()
+    assert status['state'] == 'done'
+    assert status['attempts'] == 1
+
+    result = auth_client.get(job['result_url'])
+    assert result.status_code == 200
+    assert result.get_json()['voice'] == 'nova'
+    audio = auth_client.get(result.get_json()['url'])
+    assert audio.data == b'ID3fake-mp3'
+
+    events = _events(auth_client.get(job['events_url']).data)
+    assert [event['state'] for event in events] == ['done']
+    assert events[0]['result']['url'] == result.get_json()['url']
+
+    asgi_app = create_asgi_app(app)
+    status, headers, content = request(asgi_app, 'GET', job['events_url'], cookie=login(asgi_app))
+    assert status == 200
+    assert headers['content-type'].startswith('text/event-stream')
+    assert _events(content) == events
+
+
+def test_jobs_run_by_priority_and_retry_until_attempts_run_out(app, auth_client):
+    app.config.update(JOBS_RETRY_DELAY=0, JOBS_MAX_ATTEMPTS=2)
+    low = auth_client.post('/api/jobs', json={'kind': 'tts', 'text': 'low'}).get_json()
+    high = auth_client.post('/api/jobs', json={'kind': 'tts', 'text': 'high', 'priority': 5}).get_json()
+    flaky = auth_client.post('/api/jobs', json={'kind': 'tts', 'text': 'flaky', 'priority': -1}).get_json()
+
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs['input'])
+        if kwargs['input'] == 'flaky':
+            raise RuntimeError('upstream timed out')
+        return _speech(kwargs['input'].encode())
+
+    with patch('app.providers.openai_client.audio.speech.create', side_effect=create):
+        job_runner().work()
+
+    assert calls == ['high', 'low', 'flaky', 'flaky']
+    assert auth_client.get(high['status_url']).get_json()['state'] == 'done'
+    assert auth_client.get(low['status_url']).get_json()['state'] == 'done'
+    failed = auth_client.get(flaky['result_url'])
+    assert failed.status_code == 502
+    assert failed.get_json()['attempts'] == 2
+    assert failed.get_json()['error'] == 'upstream timed out'
+
+    assert auth_client.post('/api/jobs', json={'kind': 'tts', 'text': 'x', 'priority': 99}).status_code == 400
+    assert auth_client.post('/api/jobs', json={'kind': 'video', 'text': 'x'}).status_code == 400
+
+
+def test_job_of_a_dead_worker_is_queued_again(app, auth_client, user):
+    job = auth_client.post('/api/jobs', json={'kind': 'tts', 'text': 'orphan'}).get_json()
+    queue = job_runner().queue
+    assert queue.claim()['id'] == job['id']
+    with queue.transaction() as connection:
+        connection.execute('UPDATE jobs SET owner = ? WHERE id = ?', (f'{queue.host}:999999999', job['id']))
+
+    assert queue.get(job['id'], user.id)['state'] == RUNNING
+    assert queue.claim() is None
+    assert queue.claim(sweep=True)['id'] == job['id']
+    assert queue.get(job['id'], user.id)['attempts'] == 2
+    assert queue.get(job['id'], user.id + 1) is None
+    assert auth_client.get('/api/jobs/' + 'f' * 32).status_code == 404
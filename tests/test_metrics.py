@@ -0,0 +1,72 @@
+from unittest.mock import MagicMock, patch
+
+from app import metrics
+from app.metrics import SharedMetrics
+
+
+def test_histogram_render():
+    metrics.histogram('test_latency_seconds', 'Test latency.', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        metrics.observe('test_latency_seconds', value, route='/x')
+    lines = [line for line in metrics.render().splitlines() if 'test_latency_seconds' in line]
+    assert lines == [
+        '# HELP test_latency_seconds Test latency.',
+        '# TYPE test_latency_seconds histogram',
+        'test_latency_seconds_bucket{route="/x",le="0.1"} 1',
+        'test_latency_seconds_bucket{route="/x",le="1"} 2',
+        'test_latency_seconds_bucket{route="/x",le="+Inf"} 3',
+        'test_latency_seconds_sum{route="/x"} 5.55',
+        'test_latency_seconds_count{route="/x"} 3',
+    ]
+
+
+def test_shared_metrics_sum_workers(tmp_path):
+    store = SharedMetrics(str(tmp_path / 'metrics.sqlite3'))
+    other = SharedMetrics(store.path)
+    dead = SharedMetrics(store.path)
+    with patch.object(SharedMetrics, 'owner', new=property(lambda self: f'{self.host}:1' if self is other else
+                                                             f'{self.host}:999999999' if self is dead else
+                                                             f'{self.host}:0')):
+        other.push([('test_shared_total', (), 'counter', 2), ('test_shared_open', (), 'gauge', 1)])
+        dead.push([('test_shared_total', (), 'counter', 5), ('test_shared_open', (), 'gauge', 7)])
+        with patch('app.metrics.snapshot', return_value=[('test_shared_total', (), 'counter', 1),
+                                                         ('test_shared_open', (), 'gauge', 3)]), \
+                patch('app.metrics.owner_alive', side_effect=lambda owner, host: not owner.endswith('999999999')):
+            merged = {name: value for name, _, _, value in store.merged()}
+            # The exited worker's counter stays in the total and its gauge is dropped.
+            assert merged == {'test_shared_total': 8, 'test_shared_open': 4}
+            assert {name: value for name, _, _, value in store.merged()} == merged
+
+
+def test_metrics_endpoint_covers_streams_and_database(app, auth_client):
+    app.config['ADMIN_EMAILS'] = {'test@example.com'}
+    chunks = [MagicMock(choices=[MagicMock(delta=MagicMock(content=text))], usage=None) for text in ("a", "b")]
+    with patch('app.providers.openai_client.chat.completions.create', return_value=iter(chunks)):
+        auth_client.post('/api/chat/stream', json={'message': 'Hello', 'model': 'gpt-4o'}).get_data()
+
+    body = auth_client.get('/metrics').get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{method="POST",route="/api/chat/stream",status="200"}' in body
+    assert 'chat_stream_ttft_seconds_count{model="gpt-4o"}' in body
+    assert 'chat_stream_chunk_gap_seconds_count{model="gpt-4o"}' in body
+    assert 'provider_request_duration_seconds_count{model="gpt-4o",outcome="ok"}' in body
+    assert 'db_query_duration_seconds_count{operation="select"}' in body
+    assert 'chat_streams_in_flight 0' in body
+
+
+def test_metrics_endpoint_needs_an_admin_or_the_token(app, client, user):
+    assert client.get('/metrics').status_code in (302, 401)
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code in (302, 401)
+    app.config['METRICS_TOKEN'] = 'secret'
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code in (302, 401)
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+    client.post('/login', json={'email_or_phone': 'test@example.com', 'password': 'password'})
+    assert client.get('/metrics').status_code == 403
+
+
+def test_health_reports_database_failure(client):
+    assert client.get('/health').get_json()['database'] == 'Connected'
+    with patch('app.monitoring.db.session.execute', side_effect=Exception('down')):
+        response = client.get('/health')
+    assert response.status_code == 503
+    assert response.get_json()['database'] == 'Unavailable'
@@ -1,4 +1,6 @@
-from app.models import User
+from datetime import datetime, timedelta
+from app.models import User, ChatHistory, Conversation
+from app.migrations import rollup_chat_history
 
 def test_user_creation(user):
     assert user.name == "Test User"
@@ -15,3 +17,34 @@ def test_user_repr(user):
     # If the model had a __repr__ method, we'd test it here.
     # Since it doesn't, we can just check if str(user) works or add a test if we add __repr__
     pass
+
+def test_rollup_chat_history(db, user):
+    turns = [
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello"},
+        {"role": "user", "content": "How are you?"},
+        {"role": "assistant", "content": "Fine"},
+    ]
+    start = datetime(2025, 1, 1)
+    # Each legacy snapshot repeats the whole conversation so far.
+    db.session.add(ChatHistory(user_id=user.id, conversation=turns[:2], created_at=start))
+    db.session.add(ChatHistory(user_id=user.id, conversation=turns, created_at=start + timedelta(minutes=1)))
+    db.session.add(ChatHistory(user_id=user.id, conversation=[{"role": "user", "content": "Other"}],
+                               created_at=start + timedelta(minutes=2)))
+    db.session.commit()
+
+    rollup_chat_history()
+
+    assert ChatHistory.query.count() == 0
+    conversations = Conversation.query.order_by(Conversation.id).all()
+    assert len(conversations) == 2
+    assert conversations[0].to_messages() == turns
+    assert conversations[0].title == "Hi"
+    assert conversations[1].message_count == 1
+
+def test_migrate_command_creates_schema(app, db):
+    db.drop_all()
+    result = app.test_cli_runner().invoke(args=['migrate'])
+    assert result.exit_code == 0, result.output
+    assert User.query.count() == 0
+    assert app.test_cli_runner().invoke(args=['migrate']).exit_code == 0
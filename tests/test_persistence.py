@@ -0,0 +1,66 @@
+import json
+import time
+from unittest.mock import MagicMock, patch
+
+from app import metrics
+from app.models import Conversation, Message
+from app.persistence import TurnJournal, TurnWriter
+
+
+def _turn(i):
+    return [{"role": "user", "content": f"Question {i}"}, {"role": "assistant", "content": f"Answer {i}"}]
+
+
+def test_writer_batches_turns_behind_the_response(app, db, user, tmp_path):
+    conversation = Conversation(user.id)
+    db.session.add(conversation)
+    db.session.commit()
+    writer = TurnWriter(app, TurnJournal(str(tmp_path / 'journal.sqlite3')), batch_size=2, flush_interval=60)
+
+    writer.submit(user.id, conversation.id, _turn(0), None)
+    assert Message.query.count() == 0
+    assert writer.unwritten(conversation.id, None) == _turn(0)
+    assert metrics.value('persist_queue_depth') == 1
+
+    writer.submit(user.id, conversation.id, _turn(1), None)
+    deadline = time.monotonic() + 5
+    while metrics.value('persist_queue_depth') and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.close()
+
+    db.session.expire_all()
+    stored = db.session.get(Conversation, conversation.id)
+    assert [m['content'] for m in stored.to_messages()] == ['Question 0', 'Answer 0', 'Question 1', 'Answer 1']
+    assert writer.unwritten(conversation.id, stored.head_hash) == []
+    assert writer.conversation_for(user.id, stored.head_hash) == conversation.id
+
+
+def test_turns_of_a_dead_worker_are_adopted(app, db, user, tmp_path):
+    conversation = Conversation(user.id)
+    db.session.add(conversation)
+    db.session.commit()
+    journal = TurnJournal(str(tmp_path / 'journal.sqlite3'))
+    with journal.transaction() as connection:
+        connection.execute(
+            'INSERT INTO turns (owner, conversation_id, messages, created_at) VALUES (?, ?, ?, ?)',
+            (f'{journal.host}:999999999', conversation.id, json.dumps(_turn(0)), time.time())
+        )
+    writer = TurnWriter(app, journal, batch_size=10, flush_interval=60, background=False)
+
+    assert writer.flush() == 0
+    assert writer.flush(adopt=True) == 1
+    assert db.session.get(Conversation, conversation.id).message_count == 2
+    assert journal.claim(10, adopt=True) == []
+
+
+def test_streamed_turn_is_saved(auth_client, db):
+    chunks = [MagicMock(choices=[MagicMock(delta=MagicMock(content=text))], usage=None) for text in ("Hel", "lo")]
+    with patch('app.providers.openai_client.chat.completions.create', return_value=iter(chunks)):
+        response = auth_client.post('/api/chat/stream', json={'message': 'Hi', 'model': 'gpt-4o'})
+
+    events = [json.loads(line[6:]) for line in response.data.decode().split('\n') if line.startswith('data: ')]
+    conversation_id = next(e['conversation_id'] for e in events if 'conversation_id' in e)
+    assert events[-1] == {'done': True}
+    conversation = db.session.get(Conversation, conversation_id)
+    assert conversation.to_messages() == [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}]
+    assert conversation.title == 'Hi'
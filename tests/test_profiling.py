@@ -0,0 +1,35 @@
+import os
+
+
+def test_admin_header_profiles_request(app, auth_client):
+    app.config['ADMIN_EMAILS'] = {'test@example.com'}
+    response = auth_client.get('/api/chat/history', headers={'X-Profile': '1'})
+    assert response.status_code == 200
+    profile_id = response.headers['X-Profile-Id']
+
+    index = auth_client.get('/admin/profiles').get_json()['items']
+    assert [entry['id'] for entry in index] == [profile_id]
+    assert index[0]['path'] == '/api/chat/history'
+    assert index[0]['reason'] == 'header'
+
+    report = auth_client.get(f'/admin/profiles/{profile_id}').get_json()
+    assert any('FROM conversations' in entry['statement'] for entry in report['sql']['statements'])
+    assert report['sql']['count'] >= 1
+    assert report['functions']
+    stats = auth_client.get(f'/admin/profiles/{profile_id}/stats')
+    assert stats.status_code == 200 and stats.data
+    assert auth_client.get('/admin/profiles/..%2f..%2fetc').status_code == 404
+
+
+def test_profiling_is_admin_only(app, auth_client):
+    response = auth_client.get('/api/chat/history', headers={'X-Profile': '1'})
+    assert 'X-Profile-Id' not in response.headers
+    assert not os.path.exists(app.config['PROFILE_DIR'])
+    assert auth_client.get('/admin/profiles').status_code == 403
+
+
+def test_sampled_profiles_are_bounded(app, client):
+    app.config.update({'PROFILE_SAMPLE_RATE': 1.0, 'PROFILE_KEEP': 3})
+    ids = [client.get('/health').headers['X-Profile-Id'] for _ in range(5)]
+    names = sorted(os.listdir(app.config['PROFILE_DIR']))
+    assert names == sorted(f'{profile_id}{suffix}' for profile_id in ids[2:] for suffix in ('.json', '.prof'))
@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+from unittest.mock import MagicMock, patch
+
+from app import providers
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def test_clients_use_configured_pool(app):
+    client = providers.openai_client
+    assert client.max_retries == app.config['PROVIDER_MAX_RETRIES']
+    assert client.timeout.connect == app.config['PROVIDER_CONNECT_TIMEOUT']
+    assert client.timeout.read == app.config['PROVIDER_TIMEOUT']
+
+
+def test_model_handles_are_cached(app, monkeypatch):
+    monkeypatch.setattr(providers, '_models', {})
+    with patch('app.providers.genai.GenerativeModel') as mock_model:
+        mock_model.side_effect = lambda name: MagicMock(name=name)
+        first = providers.model('gemini-pro-vision')
+        assert providers.model('gemini-pro-vision') is first
+        assert providers.model('gemini-pro') is not first
+    assert mock_model.call_count == 2
+
+
+def test_fork_rebuilds_clients(app, monkeypatch):
+    for name in ('openai_client', 'async_openai_client', 'gemini_client'):
+        monkeypatch.setattr(providers, name, getattr(providers, name))
+    monkeypatch.setattr(providers, '_models', {'gemini-pro-vision': object()})
+    parent = providers.openai_client
+
+    providers._after_fork()
+
+    assert providers.openai_client is not parent
+    assert 'gemini-pro-vision' not in providers._models
+    assert providers.gemini_client is providers._models['gemini-pro']
+
+
+def test_fork_while_a_model_is_built_does_not_deadlock(app):
+    held = providers._models_lock
+    held.acquire()
+    try:
+        providers._after_fork()
+        assert providers._models_lock is not held
+        providers.model('gemini-pro')
+    finally:
+        held.release()
+
+
+def test_preloading_master_leaves_prewarm_to_workers(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'PROVIDER_PREWARM', True)
+    monkeypatch.setenv('GUNICORN_MASTER_PID', str(os.getpid()))
+    for name in providers.CLIENTS:
+        monkeypatch.delitem(vars(providers), name, raising=False)
+    with patch.object(providers, 'start_prewarm') as mock_prewarm:
+        providers.init_app(app)
+        mock_prewarm.assert_not_called()
+        monkeypatch.setenv('GUNICORN_MASTER_PID', '1')
+        providers.init_app(app)
+        mock_prewarm.assert_called_once()
+
+
+def test_prewarm_opens_provider_connections(app):
+    with patch.object(providers.openai_client, 'with_options') as mock_options, \
+            patch('app.providers.genai.list_models', return_value=iter([])) as mock_list:
+        providers.prewarm()
+    mock_options.return_value.models.list.assert_called_once()
+    mock_list.assert_called_once()
+
+
+def test_create_app_leaves_sdks_unimported(tmp_path):
+    code = ('import sys; from app import create_app; create_app(); '
+            'print(any(name in sys.modules for name in ("openai", "google.generativeai")))')
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{tmp_path}/db.sqlite3', PYTHONPATH=ROOT)
+    output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == 'False'
@@ -0,0 +1,80 @@
+from unittest.mock import MagicMock, patch
+
+from app import metrics
+from app.limits import Leases
+from app.quotas import quotas
+
+
+def _completion(total_tokens):
+    response = MagicMock()
+    response.choices = [MagicMock(message=MagicMock(content="Hi"))]
+    response.usage.prompt_tokens = 10
+    response.usage.completion_tokens = total_tokens - 10
+    response.usage.total_tokens = total_tokens
+    return response
+
+
+def test_leases_limit_and_reclaim(tmp_path):
+    leases = Leases(str(tmp_path / 'quotas.sqlite3'))
+    ids, full = leases.acquire([('user:1', 2), ('model:m', 5)], ttl=60)
+    assert len(ids) == 2 and full is None
+    assert leases.acquire([('user:1', 2)], ttl=60)[0] is not None
+    assert leases.acquire([('user:1', 2), ('model:m', 5)], ttl=60) == (None, 'user:1')
+    assert leases.counts() == {'user:1': 2, 'model:m': 1}
+
+    leases.release(ids)
+    assert leases.counts() == {'user:1': 1}
+
+    # A lease left by a worker that exited is reclaimed when the key is full.
+    with leases.transaction() as connection:
+        connection.execute("UPDATE leases SET owner = ?", (f'{leases.host}:999999999',))
+    assert leases.acquire([('user:1', 1)], ttl=60)[0] is not None
+
+
+def test_chat_concurrency_limit(app, auth_client, user):
+    app.config['QUOTA_USER_CONCURRENCY'] = 1
+    held = quotas().admit(user.id, 'gpt-4o', 10)
+    before = metrics.value('quota_rejections_total', scope='user', limit='concurrency')
+
+    with patch('app.openai_client.chat.completions.create') as mock_create:
+        response = auth_client.post('/api/chat', json={'message': 'Hello', 'model': 'gpt-4o'})
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '1'
+        mock_create.assert_not_called()
+
+        held.settle(0)
+        mock_create.return_value = _completion(15)
+        response = auth_client.post('/api/chat', json={'message': 'Hello', 'model': 'gpt-4o'})
+        assert response.status_code == 200
+
+    assert metrics.value('quota_rejections_total', scope='user', limit='concurrency') == before + 1
+    assert quotas().leases.counts() == {}
+
+
+def test_model_tokens_per_minute(app, auth_client):
+    app.config['QUOTA_MODELS'] = {'gpt-4o': {'tpm': 600}}
+    with patch('app.openai_client.chat.completions.create') as mock_create:
+        mock_create.return_value = _completion(1000)
+        assert auth_client.post('/api/chat', json={'message': 'One', 'model': 'gpt-4o'}).status_code == 200
+
+        # The first reply put the bucket 400 tokens in debt: 40s of refill at 10 tokens a second.
+        response = auth_client.post('/api/chat', json={'message': 'Two', 'model': 'gpt-4o'})
+        assert response.status_code == 429
+        assert 40 <= int(response.headers['Retry-After']) <= 42
+        assert mock_create.call_count == 1
+
+    app.config['ADMIN_EMAILS'] = {'test@example.com'}
+    body = auth_client.get('/metrics').get_data(as_text=True)
+    assert 'quota_generations_in_flight{model="gpt-4o"} 0' in body
+    assert 'quota_tokens_available{model="gpt-4o"} -' in body
+
+
+def test_stream_releases_lease(app, auth_client):
+    app.config['QUOTA_USER_CONCURRENCY'] = 1
+    chunk = MagicMock(usage=None)
+    chunk.choices = [MagicMock(delta=MagicMock(content="Hi"))]
+    with patch('app.providers.openai_client.chat.completions.create', return_value=iter([chunk])):
+        response = auth_client.post('/api/chat/stream', json={'message': 'Hello', 'model': 'gpt-4o'})
+        assert response.status_code == 200
+        assert '"done": true' in response.get_data(as_text=True)
+    assert quotas().leases.counts() == {}
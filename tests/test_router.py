@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app import router
+
+
+@pytest.fixture(autouse=True)
+def clear_stats():
+    router.stats.clear()
+    yield
+    router.stats.clear()
+
+
+def test_stats_percentiles_and_health(app):
+    for latency in (0.1, 0.2, 0.3, 0.4, 1.0):
+        router.stats.record('gpt-4o', latency)
+    snapshot = router.stats.snapshot('gpt-4o')
+    assert snapshot['p50'] == 0.3
+    assert snapshot['p99'] == 1.0
+    assert router.stats.healthy('gpt-4o')
+
+    for _ in range(6):
+        router.stats.record('gpt-4o', ok=False)
+    assert not router.stats.healthy('gpt-4o')
+    assert router.resolve('fast').models[-1] == 'gpt-4o'
+
+
+def test_fast_alias_prefers_lowest_latency(app):
+    for _ in range(5):
+        router.stats.record('gpt-4o', 2.0)
+        router.stats.record('gpt-3.5-turbo', 1.0)
+        router.stats.record('gemini-pro', 0.5)
+    assert router.resolve('fast').models == ('gemini-pro', 'gpt-3.5-turbo', 'gpt-4o')
+    assert router.resolve('nope') is None
+
+
+def test_alias_falls_back_to_next_model(auth_client):
+    with patch('app.openai_client.chat.completions.create') as mock_openai, \
+            patch('app.gemini_client.generate_content') as mock_gemini:
+        mock_openai.side_effect = Exception("503 overloaded")
+        mock_gemini.return_value = MagicMock(text="From Gemini")
+
+        response = auth_client.post('/api/chat', json={'message': 'Hello', 'model': 'cheap'})
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['response'] == "From Gemini"
+    assert data['model'] == 'gemini-pro'
+    assert mock_gemini.call_args[0][0][-1] == {"role": "user", "parts": ["Hello"]}
+    assert router.stats.snapshot('gpt-3.5-turbo')['error_rate'] == 1.0
+
+
+def _slow_then_fast(closed):
+    def produce(model):
+        delay = 0.5 if model == 'gpt-4o' else 0.0
+        try:
+            time.sleep(delay)
+            yield {'content': model}
+        finally:
+            closed.append(model)
+    return produce
+
+
+def test_hedged_request_wins_and_cancels_slow_model():
+    route = router.Route('fast', ('gpt-4o', 'gpt-3.5-turbo', 'gemini-pro'), True)
+    closed = []
+    started = time.monotonic()
+    events = list(router.route_events(route, _slow_then_fast(closed), hedge_after=0.05))
+
+    assert time.monotonic() - started < 0.4
+    # The hedge goes to the other provider first.
+    assert events == [{'model': 'gemini-pro'}, {'content': 'gemini-pro'}]
+    time.sleep(0.6)
+    assert 'gpt-4o' in closed
+
+
+def test_hedged_request_closes_stalled_upstream():
+    from app.providers import closable
+    route = router.Route('fast', ('gpt-4o', 'gemini-pro'), True)
+    closed = threading.Event()
+
+    class Upstream:
+        def close(self):
+            closed.set()
+
+    def produce(model):
+        if model == 'gpt-4o':
+            closable(Upstream())
+            # A stalled read, unblocked only by closing the response.
+            assert closed.wait(5)
+            raise ConnectionError('closed')
+        yield {'content': model}
+
+    events = list(router.route_events(route, produce, hedge_after=0.05))
+    assert events == [{'model': 'gemini-pro'}, {'content': 'gemini-pro'}]
+    assert closed.wait(1)
+
+
+def test_completions_are_not_hedged(app, auth_client):
+    app.config['ROUTER_HEDGE_AFTER'] = 0.01
+    with patch('app.openai_client.chat.completions.create') as mock_openai, \
+            patch('app.gemini_client.generate_content') as mock_gemini:
+        mock_openai.side_effect = lambda **kwargs: time.sleep(0.1) or MagicMock(
+            choices=[MagicMock(message=MagicMock(content="Slow"))], usage=None)
+        response = auth_client.post('/api/chat', json={'message': 'Hello', 'model': 'cheap'})
+    assert response.get_json()['response'] == "Slow"
+    mock_gemini.assert_not_called()
+
+
+def test_async_hedged_request_cancels_slow_model():
+    route = router.Route('fast', ('gpt-4o', 'gemini-pro'), True)
+    cancelled = []
+
+    async def produce(model):
+        try:
+            await asyncio.sleep(5 if model == 'gpt-4o' else 0)
+            yield {'content': model}
+        except asyncio.CancelledError:
+            cancelled.append(model)
+            raise
+
+    async def run():
+        events = [event async for event in router.aroute_events(route, produce, hedge_after=0.05)]
+        await asyncio.sleep(0)
+        return events
+
+    assert asyncio.run(run()) == [{'model': 'gemini-pro'}, {'content': 'gemini-pro'}]
+    assert cancelled == ['gpt-4o']
+
+
+def test_models_lists_aliases_and_stats(client):
+    router.stats.record('gpt-4o', 0.2)
+    data = client.get('/models').get_json()
+    assert data['models']['openai'] == ['gpt-4o', 'gpt-4-turbo', 'gpt-3.5-turbo']
+    assert set(data['aliases']) == {'fast', 'cheap'}
+    assert data['stats']['gpt-4o']['p50'] == 0.2
@@ -0,0 +1,83 @@
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import text
+
+from app.chat import record_turn
+from app.migrations import upgrade
+from app.models import User
+
+
+def _turn(user_id, question, answer):
+    record_turn(user_id, None, [], [
+        {"role": "user", "content": question},
+        {"role": "assistant", "content": answer}
+    ])
+
+
+def _search(client, query, **params):
+    return client.get('/api/chat/search', query_string={'q': query, **params})
+
+
+def test_search_ranks_conversations_with_snippets(auth_client, db, user):
+    other = User(name="Other", email="other@example.com", phone="555")
+    other.set_password("password")
+    db.session.add(other)
+    db.session.commit()
+
+    _turn(user.id, "How do I rotate <secret> keys?", "Rotate keys with a key management service.")
+    _turn(user.id, "Lunch ideas", "Try a salad. Rotating menus help too.")
+    _turn(user.id, "Unrelated", "Nothing to see here.")
+    _turn(other.id, "Rotate keys for me", "Rotate the keys of another account.")
+
+    page = _search(auth_client, 'rotate').get_json()
+    assert [item['title'] for item in page['items']] == ["How do I rotate <secret> keys?", "Lunch ideas"]
+    best = page['items'][0]
+    assert best['matches'] == 2
+    assert best['message_count'] == 2
+    assert best['message'] == {"seq": 0, "role": "user", "snippet": "How do I <mark>rotate</mark> &lt;secret&gt; keys?"}
+    assert page['next_cursor'] is None
+
+    phrase = _search(auth_client, '"key management"').get_json()['items']
+    assert [item['message']['seq'] for item in phrase] == [1]
+    assert [item['title'] for item in _search(auth_client, 'sal*').get_json()['items']] == ["Lunch ideas"]
+    assert _search(auth_client, 'another').get_json()['items'] == []
+
+    assert _search(auth_client, '  ').status_code == 400
+    assert _search(auth_client, 'rotate', cursor='not-a-cursor').status_code == 400
+
+
+def test_search_indexes_new_turns_and_paginates(auth_client, db, user):
+    for i in range(5):
+        _turn(user.id, f"Question {i} about deployment", f"Answer {i}")
+
+    with patch('app.openai_client.chat.completions.create') as mock_create:
+        mock_create.return_value = MagicMock(
+            choices=[MagicMock(message=MagicMock(content="Blue-green deployment swaps traffic."))], usage=None
+        )
+        auth_client.post('/api/chat', json={'message': 'Explain blue-green', 'model': 'gpt-4o'})
+    assert [item['title'] for item in _search(auth_client, 'blue green').get_json()['items']] == [
+        "Explain blue-green"
+    ]
+
+    titles, cursor = [], None
+    while True:
+        page = _search(auth_client, 'deployment', limit=2, **({'cursor': cursor} if cursor else {})).get_json()
+        assert len(page['items']) <= 2
+        titles += [item['title'] for item in page['items']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert len(titles) == len(set(titles)) == 6
+
+
+def test_migrate_indexes_existing_messages(auth_client, db, user):
+    _turn(user.id, "Kubernetes ingress", "Use an ingress controller.")
+    with db.engine.begin() as connection:
+        connection.execute(text('DROP TABLE message_search'))
+        connection.execute(text('DROP TRIGGER messages_search_insert'))
+    assert _search(auth_client, 'ingress').status_code == 501
+
+    upgrade()
+    assert _search(auth_client, 'ingress').get_json()['items'][0]['matches'] == 2
+    _turn(user.id, "Ingress TLS", "Terminate TLS at the ingress.")
+    assert len(_search(auth_client, 'ingress').get_json()['items']) == 2
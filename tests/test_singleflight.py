@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+
+from app.singleflight import FlightBoard, FlightFailed, coalesced
+
+
+@pytest.fixture
+def board(tmp_path):
+    return FlightBoard(str(tmp_path / 'flights.sqlite3'), timeout=5, poll_interval=0.005, flush_interval=0)
+
+
+def _run(results, board, produce):
+    try:
+        results.append(list(coalesced(board, 'key', produce)))
+    except FlightFailed as e:
+        results.append(e)
+
+
+def test_identical_requests_share_one_generation(board):
+    calls = []
+
+    def produce():
+        calls.append(1)
+        for i in range(5):
+            time.sleep(0.02)
+            yield {'content': str(i)}
+
+    results = []
+    threads = [threading.Thread(target=_run, args=(results, board, produce)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [[{'content': str(i)} for i in range(5)]] * 3
+
+
+def test_followers_see_leader_failure(board):
+    follower_joined = threading.Event()
+
+    def produce():
+        yield {'content': 'partial'}
+        follower_joined.wait(2)
+        raise RuntimeError('upstream exploded')
+
+    leader = coalesced(board, 'key', produce)
+    assert next(leader) == {'content': 'partial'}
+
+    results = []
+    follower = threading.Thread(target=lambda: _run(results, board, lambda: iter(())))
+    follower.start()
+    time.sleep(0.05)
+    follower_joined.set()
+    with pytest.raises(RuntimeError):
+        list(leader)
+    follower.join()
+
+    assert isinstance(results[0], FlightFailed)
+    assert str(results[0]) == 'upstream exploded'
+
+
+def test_follower_restarts_when_leader_leaves(board):
+    board.flush_interval = 60
+    leader = coalesced(board, 'key', lambda: iter([{'content': 'a'}, {'content': 'b'}]))
+    next(leader)
+
+    results = []
+    follower = threading.Thread(target=lambda: _run(results, board, lambda: iter([{'content': 'own'}])))
+    follower.start()
+    time.sleep(0.05)
+    leader.close()
+    follower.join()
+
+    assert results == [[{'content': 'own'}]]
+
+
+def test_follower_restarts_when_leader_process_is_gone(board):
+    flight_id, leading = board.join('key')
+    assert leading
+    with board.transaction() as connection:
+        connection.execute('UPDATE flights SET owner = ? WHERE id = ?', (f'{board.host}:999999999', flight_id))
+
+    results = []
+    _run(results, board, lambda: iter([{'content': 'own'}]))
+    assert results == [[{'content': 'own'}]]
+
+
+def test_heartbeat_keeps_a_slow_leader_followed(tmp_path):
+    board = FlightBoard(str(tmp_path / 'flights.sqlite3'), timeout=0.15, poll_interval=0.005, flush_interval=0)
+    calls = []
+
+    def produce():
+        calls.append(1)
+        time.sleep(0.5)
+        yield {'content': 'done'}
+
+    results = []
+    threads = [threading.Thread(target=_run, args=(results, board, produce)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [[{'content': 'done'}]] * 2
@@ -0,0 +1,119 @@
+import time
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app.models import UsageRecord, UsageRollup
+from app import usage
+from app.usage import UsageLedger, report_range
+
+
+def _completion():
+    response = MagicMock()
+    response.choices = [MagicMock(message=MagicMock(content="Hi"))]
+    response.usage.prompt_tokens = 10
+    response.usage.completion_tokens = 5
+    response.usage.total_tokens = 15
+    return response
+
+
+def test_chat_usage_is_recorded_and_rolled_up(app, auth_client):
+    app.config['COMPLETION_CACHE_ENABLED'] = True
+    chunk = MagicMock(usage=None)
+    chunk.choices = [MagicMock(delta=MagicMock(content="Streamed"))]
+    with patch('app.openai_client.chat.completions.create', return_value=_completion()):
+        for _ in range(2):
+            assert auth_client.post('/api/chat', json={'message': 'Hello', 'model': 'gpt-4o'}).status_code == 200
+    with patch('app.providers.openai_client.chat.completions.create', return_value=iter([chunk])):
+        auth_client.post('/api/chat/stream', json={'message': 'Other', 'model': 'gpt-4o'}).get_data()
+
+    records = UsageRecord.query.order_by(UsageRecord.id).all()
+    assert [(r.endpoint, r.cached, r.total_tokens) for r in records][:2] == [('chat', False, 15), ('chat', True, 0)]
+    assert records[2].endpoint == 'chat_stream' and records[2].completion_tokens > 0
+
+    data = auth_client.get('/api/usage?period=hour').get_json()
+    assert data['period'] == 'hour'
+    assert len(data['buckets']) == 1
+    assert data['buckets'][0]['model'] == 'gpt-4o'
+    assert data['totals']['requests'] == 3
+    assert data['totals']['cached_requests'] == 1
+    assert data['totals']['total_tokens'] == 15 + records[2].total_tokens
+    assert auth_client.get('/api/usage').get_json()['totals']['requests'] == 3
+
+
+def test_ledger_writes_in_batches(app, user):
+    ledger = UsageLedger(app, batch_size=3, flush_interval=60)
+    counts = {'prompt_tokens': 1, 'completion_tokens': 2, 'total_tokens': 3}
+    for _ in range(2):
+        ledger.record(user.id, 'gpt-4o', 'chat', counts, 0.25, False)
+    time.sleep(0.1)
+    assert UsageRecord.query.count() == 0
+
+    ledger.record(user.id, 'gpt-4o', 'chat', counts, 0.25, False)
+    deadline = time.monotonic() + 5
+    while UsageRecord.query.count() < 3 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    ledger.close()
+
+    daily = UsageRollup.query.filter_by(period='day').one()
+    assert (daily.requests, daily.total_tokens, daily.latency_ms) == (3, 9, 750)
+
+
+def test_ledger_drops_records_it_cannot_write(app, user):
+    ledger = UsageLedger(app, batch_size=10, flush_interval=60, max_queue=4, max_attempts=2)
+    counts = {'prompt_tokens': 1, 'completion_tokens': 2, 'total_tokens': 3}
+    for model in ('gpt-4o', 'bad', 'gpt-4o', 'gpt-4o', 'gpt-4o'):
+        ledger.record(user.id, model, 'chat', counts, 0.25, False)
+    assert len(ledger._queue) == 4
+
+    write = usage.write_usage
+
+    def fail_on_bad(entries):
+        if any(entry['model'] == 'bad' for entry in entries):
+            raise RuntimeError('constraint violated')
+        write(entries)
+
+    with patch('app.usage.write_usage', side_effect=fail_on_bad):
+        with pytest.raises(RuntimeError):
+            ledger.flush()
+        assert UsageRecord.query.count() == 0
+        assert ledger.flush() == 3
+    ledger.close()
+
+    assert [record.model for record in UsageRecord.query.all()] == ['gpt-4o'] * 3
+    assert ledger._queue == []
+
+
+def test_usage_range_validation(auth_client):
+    assert auth_client.get('/api/usage?period=week').status_code == 400
+    assert auth_client.get('/api/usage?period=hour&from=2026-01-01&to=2026-03-01').status_code == 400
+    assert auth_client.get('/api/usage?from=2026-02-01&to=2026-01-01').status_code == 400
+
+    start, end = report_range('day', '2026-01-01T05:00:00+02:00', '2026-01-03', now=datetime(2026, 1, 5))
+    assert (start, end) == (datetime(2026, 1, 1), datetime(2026, 1, 3))
+    # A 'to' inside a bucket keeps that partial bucket.
+    assert report_range('hour', '2026-01-01T00:00', '2026-01-01T10:30')[1] == datetime(2026, 1, 1, 11)
+
+
+def test_admin_usage_by_user_and_model(app, auth_client, user, db):
+    from app.models import User
+    other = User(name="Other", email="other@example.com", phone="555")
+    other.set_password("password")
+    db.session.add(other)
+    db.session.commit()
+    ledger = UsageLedger(app, batch_size=100, flush_interval=60, background=False)
+    counts = {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2}
+    for user_id, model, times in ((user.id, 'gpt-4o', 1), (other.id, 'gpt-4o', 3), (other.id, 'gemini-pro', 2)):
+        for _ in range(times):
+            ledger.record(user_id, model, 'chat', counts, 0.1, False)
+    ledger.close()
+
+    assert auth_client.get('/admin/usage').status_code == 403
+    app.config['ADMIN_EMAILS'] = {'test@example.com'}
+    data = auth_client.get('/admin/usage?period=hour').get_json()
+    assert [(row['email'], row['model'], row['total_tokens']) for row in data['users']] == [
+        ('other@example.com', 'gpt-4o', 6), ('other@example.com', 'gemini-pro', 4), ('test@example.com', 'gpt-4o', 2)
+    ]
+    assert data['totals']['requests'] == 6
+    assert len(auth_client.get('/admin/usage?period=hour&limit=1').get_json()['users']) == 1
@@ -0,0 +1,51 @@
+from flask import g
+
+from app import metrics
+from app.users import UserVersions
+
+
+def _get(client):
+    # The test app context outlives requests, so drop the user Flask-Login keeps on g.
+    g.pop('_login_user', None)
+    return client.get('/api/chat/history')
+
+
+def _lookups():
+    return {result: metrics.value('user_cache_requests_total', result=result) for result in ('hit', 'miss', 'stale')}
+
+
+def test_user_loader_is_cached(auth_client):
+    before = _lookups()
+    for _ in range(3):
+        assert _get(auth_client).status_code == 200
+    after = _lookups()
+    assert after['miss'] - before['miss'] == 1
+    assert after['hit'] - before['hit'] == 2
+
+
+def test_password_change_invalidates_cached_user(auth_client, db, user):
+    _get(auth_client)
+    user.set_password('changed-password')
+    db.session.commit()
+
+    before = _lookups()
+    assert _get(auth_client).status_code == 200
+    after = _lookups()
+    assert after['hit'] == before['hit']
+    assert after['miss'] - before['miss'] == 1
+
+
+def test_other_worker_bump_invalidates_cached_user(app, auth_client, user):
+    _get(auth_client)
+    # Another worker sharing the versions file saw the user change.
+    UserVersions(app.config['USER_VERSIONS_PATH']).bump([user.id])
+
+    before = _lookups()
+    _get(auth_client)
+    assert _lookups()['stale'] - before['stale'] == 1
+
+
+def test_logout_forgets_cached_user(auth_client, user):
+    _get(auth_client)
+    auth_client.get('/logout')
+    assert _get(auth_client).status_code == 302